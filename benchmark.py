@@ -0,0 +1,335 @@
+import os
+import glob
+import time
+import pickle
+import argparse
+import numpy as np
+import torch
+from torch.distributions import Categorical, Independent, Normal, MixtureSameFamily
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+from graphtern.model import graph_tern, generate_adjacency_matrix
+from graphtern.normalizer import normalized_adjacency_tilde_matrix
+from graphtern.dropedge import drop_edge
+from graphtern.loss import gaussian_mixture_loss
+from graphtern.endpoint import endpoint_reducers
+from graphtern.online import OnlinePredictor
+from utils.dataloader import TrajectoryDataset, scene_collate
+from functools import partial
+from utils.sampler import BucketBatchSampler
+from utils.augmentor import data_sampler, random_scale, random_flip, random_rotation
+from test import load_args, load_model, load_test_dataset, set_precision, test
+from torch.utils.data import DataLoader
+
+
+class AllocationCounter(TorchDispatchMode):
+    r"""Counts the tensors freshly allocated by aten ops, views and in-place results excluded."""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.nbytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = {t.untyped_storage().data_ptr() for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                inputs.add(t.untyped_storage().data_ptr())
+                self.count += 1
+                self.nbytes += t.untyped_storage().nbytes()
+        return out
+
+
+def measure(fn, repeat=100):
+    r"""Returns the allocation count, allocated bytes and mean latency (ms) of fn()."""
+
+    with AllocationCounter() as counter:
+        fn()
+    for _ in range(3):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return counter.count, counter.nbytes, (time.perf_counter() - start) / repeat * 1000
+
+
+def reference_adjacency_matrix(V):
+    r"""Previous generate_adjacency_matrix(), materializing the NATVVC tensor."""
+
+    temp = V.unsqueeze(dim=3).repeat_interleave(repeats=V.size(3), dim=3)
+    A = (temp - temp.transpose(3, 4)).norm(p=2, dim=5)
+    A_inv = 1. / A
+    A_inv[A == 0] = 0
+    return torch.cat([A, A_inv], dim=1)
+
+
+def reference_adjacency_tilde_matrix(A):
+    r"""Previous normalized_adjacency_tilde_matrix(), with identity and diagonal degree matmuls."""
+
+    eye = torch.eye(A.size(-1), device=A.device)
+    A_t = A + eye
+    degs_inv_sqrt = torch.pow(A_t.sum(-1).unsqueeze(dim=-1), -0.5)
+    degs_inv_sqrt[torch.isinf(degs_inv_sqrt)] = 0
+    norm_degs_matrix = eye * degs_inv_sqrt
+    return norm_degs_matrix @ A_t @ norm_degs_matrix
+
+
+def reference_drop_edge(A, percent):
+    r"""Previous drop_edge()."""
+
+    A_prime = torch.rand_like(A)
+    A_drop = A.clone()
+    A_drop[A_prime > percent] = 0
+    return A_drop
+
+
+def reference_data_sampler(S_obs, S_trgt, batch=4):
+    r"""Previous data_sampler(), augmenting one cloned copy at a time with host-side random parameters."""
+
+    aug_So, aug_Sg = [], []
+    for i in range(batch):
+        S_obs_t, S_tr_t = random_scale(S_obs.clone(), S_trgt.clone(), min=0.8, max=1.2)
+        S_obs_t, S_tr_t = random_rotation(*random_flip(S_obs_t, S_tr_t))
+        aug_So.append(S_obs_t.squeeze(dim=0))
+        aug_Sg.append(S_tr_t.squeeze(dim=0))
+    return torch.stack(aug_So).detach(), torch.stack(aug_Sg).detach()
+
+
+def reference_gaussian_mixture_loss(W_pred, S_trgt, n_stop):
+    r"""Previous gaussian_mixture_loss(), building a torch.distributions mixture per control point."""
+
+    W_pred = W_pred.transpose(1, 2).contiguous()
+    W_trgt_list = [i.mean(dim=1) for i in S_trgt.chunk(chunks=n_stop, dim=1)]
+    W_pred_list = W_pred.chunk(chunks=n_stop, dim=-1)
+    loss_list = []
+    for i in range(n_stop):
+        mix = Categorical(torch.nn.functional.softmax(W_pred_list[i][:, :, :, 4], dim=-1))
+        comp = Independent(Normal(W_pred_list[i][:, :, :, 0:2], W_pred_list[i][:, :, :, 2:4].exp()), 1)
+        loss_list.append(-MixtureSameFamily(mix, comp).log_prob(W_trgt_list[i]))
+    return torch.cat(loss_list, dim=0).mean()
+
+
+def bench_adjacency(args, device):
+    r"""Adjacency generation and GCN normalization, previous kernels vs fused kernels."""
+
+    V = torch.randn(args.n_smpl, 2, args.seq_len, args.n_peds, 2, device=device)
+    A = generate_adjacency_matrix(V)
+    assert torch.allclose(A, reference_adjacency_matrix(V), atol=1e-5)
+    assert torch.allclose(normalized_adjacency_tilde_matrix(A), reference_adjacency_tilde_matrix(A), atol=1e-5)
+
+    cases = [('generate_adjacency_matrix', lambda: reference_adjacency_matrix(V), lambda: generate_adjacency_matrix(V)),
+             ('normalized_adjacency_tilde', lambda: reference_adjacency_tilde_matrix(A),
+              lambda: normalized_adjacency_tilde_matrix(A)),
+             ('drop_edge + normalize', lambda: reference_adjacency_tilde_matrix(reference_drop_edge(A, 0.8)),
+              lambda: normalized_adjacency_tilde_matrix(drop_edge(A, 0.8), inplace=True))]
+
+    print('Adjacency kernels, V[{0}, 2, {1}, {2}, 2] on {3}'.format(args.n_smpl, args.seq_len, args.n_peds, device))
+    for name, reference, fused in cases:
+        for tag, fn in [('previous', reference), ('fused', fused)]:
+            count, nbytes, latency = measure(fn, args.repeat)
+            print('{0:28s} {1:8s} allocs: {2:3d}  bytes: {3:10d}  latency: {4:.3f} ms'.format(
+                name, tag, count, nbytes, latency))
+
+
+def bench_forward(args, device):
+    r"""graph_tern forward latency in each sampling mode on a random scene."""
+
+    model = graph_tern(seq_len=8, pred_seq_len=12, n_smpl=args.n_smpl // 2).to(device)
+    S_obs = torch.randn(1, 2, 8, args.n_peds, 2, device=device).cumsum(dim=2) * 0.1
+    S_trgt = torch.randn(1, 2, 12, args.n_peds, 2, device=device).cumsum(dim=2) * 0.1
+
+    cases = [('train', True, dict(S_trgt=S_trgt)),
+             ('eval', False, dict()),
+             ('eval pruning', False, dict(pruning=4)),
+             ('eval clustering', False, dict(pruning=4, clustering=True))]
+
+    print('graph_tern forward, {0} pedestrians, n_smpl={1} on {2}'.format(args.n_peds, model.n_smpl, device))
+    for name, training, kwargs in cases:
+        model.train(training)
+        with torch.set_grad_enabled(training):
+            count, nbytes, latency = measure(lambda: model(S_obs, **kwargs), args.repeat)
+        print('{0:28s} allocs: {1:5d}  bytes: {2:11d}  latency: {3:.3f} ms'.format(name, count, nbytes, latency))
+
+
+def bench_loss(args, device):
+    r"""Gaussian mixture loss forward and backward, distribution objects vs tensorized vs fused."""
+
+    W_pred = torch.randn(1, 8, args.n_peds, 15, device=device, requires_grad=True)
+    S_trgt = torch.randn(1, 12, args.n_peds, 2, device=device)
+    assert torch.allclose(gaussian_mixture_loss(W_pred, S_trgt, 3), reference_gaussian_mixture_loss(W_pred, S_trgt, 3))
+
+    cases = [('previous', lambda: reference_gaussian_mixture_loss(W_pred, S_trgt, 3).backward()),
+             ('tensorized', lambda: gaussian_mixture_loss(W_pred, S_trgt, 3).backward()),
+             ('fused', lambda: gaussian_mixture_loss(W_pred, S_trgt, 3, fused=True).backward())]
+
+    print('gaussian_mixture_loss, {0} pedestrians on {1}'.format(args.n_peds, device))
+    for name, fn in cases:
+        count, nbytes, latency = measure(fn, args.repeat)
+        print('{0:28s} allocs: {1:5d}  bytes: {2:11d}  latency: {3:.3f} ms'.format(name, count, nbytes, latency))
+
+
+def bench_augment(args, device):
+    r"""Training augmentation of n_smpl copies, one copy at a time vs one batched affine."""
+
+    S_obs = torch.randn(1, 2, 8, args.n_peds, 2, device=device)
+    S_trgt = torch.randn(1, 2, 12, args.n_peds, 2, device=device)
+    generator = torch.Generator(device).manual_seed(0)
+    seq_start_end = [[start, min(start + 4, args.n_peds)] for start in range(0, args.n_peds, 4)]
+
+    cases = [('previous', lambda: reference_data_sampler(S_obs, S_trgt, batch=args.n_smpl)),
+             ('batched', lambda: data_sampler(S_obs, S_trgt, batch=args.n_smpl, generator=generator)),
+             ('batched per scene', lambda: data_sampler(S_obs, S_trgt, batch=args.n_smpl, generator=generator,
+                                                        seq_start_end=seq_start_end))]
+
+    print('data_sampler, {0} copies of {1} pedestrians on {2}'.format(args.n_smpl, args.n_peds, device))
+    for name, fn in cases:
+        count, nbytes, latency = measure(fn, args.repeat)
+        print('{0:28s} allocs: {1:5d}  bytes: {2:11d}  latency: {3:.3f} ms'.format(name, count, nbytes, latency))
+
+
+def bench_reducer(args, device):
+    r"""Accuracy (ADE/FDE) against latency of each test-time endpoint reducer on a trained checkpoint."""
+
+    checkpoint_dir = './checkpoint/' + args.tag + '/'
+    with open(checkpoint_dir + 'args.pkl', 'rb') as f:
+        train_args = pickle.load(f)
+    model = graph_tern(n_epgcn=train_args.n_epgcn, n_epcnn=train_args.n_epcnn, n_trgcn=train_args.n_trgcn,
+                       n_trcnn=train_args.n_trcnn, seq_len=train_args.obs_seq_len, pred_seq_len=train_args.pred_seq_len,
+                       n_ways=train_args.n_ways, n_smpl=20).to(device).eval()
+    model.load_state_dict(torch.load(checkpoint_dir + train_args.dataset + '_best.pth', map_location=device), strict=False)
+
+    dataset = TrajectoryDataset('./datasets/' + train_args.dataset + '/test/', obs_len=train_args.obs_seq_len,
+                                pred_len=train_args.pred_seq_len, skip=1, fields=['S_obs', 'S_trgt'])
+    sampler = BucketBatchSampler(dataset.seq_start_end, batch_size=16, shuffle=False)
+    loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=partial(scene_collate, fields=dataset.fields))
+    batches = [([tensor.to(device) for tensor in batch[:2]], batch[-1]) for batch in loader]
+
+    print('Endpoint reducers on {0} test ({1} scenes, {2} batches) on {3}'.format(
+        train_args.dataset, len(dataset), len(batches), device))
+    for name in endpoint_reducers:
+        ade, fde, elapsed = [], [], 0.
+        with torch.no_grad():
+            for (S_obs, S_trgt), seq_start_end in batches:
+                start = time.perf_counter()
+                V_refi = model(S_obs, pruning=4, clustering=name, seq_start_end=seq_start_end)[2]
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                elapsed += time.perf_counter() - start
+                error = (V_refi - S_trgt[:, 0].squeeze(dim=0)).norm(p=2, dim=-1)
+                ade.append(error.mean(dim=1).min(dim=0)[0])
+                fde.append(error[:, -1].min(dim=0)[0])
+        print('{0:28s} ADE: {1:.4f}  FDE: {2:.4f}  latency: {3:.3f} ms/batch'.format(
+            name, torch.cat(ade).mean().item(), torch.cat(fde).mean().item(), elapsed / len(batches) * 1000))
+
+
+def bench_online(args, device):
+    r"""Per-tick latency of the online predictor against rebuilding the scene from raw frames, on a random crowd.
+
+    Both are timed with the previous 'kmeans' endpoint reducer and with the default 'quantile' reducer."""
+
+    model = graph_tern(seq_len=8, pred_seq_len=12, n_smpl=20).to(device).eval()
+    predictors = {name: OnlinePredictor(model, max_peds=args.n_peds * 2, clustering=name)
+                  for name in ['kmeans', 'quantile']}
+
+    # Random walkers, one of them is replaced every 10 frames
+    positions = torch.randn(args.n_peds, 2) * 5
+    ped_ids = list(range(args.n_peds))
+    frames = []
+    for t in range(args.repeat + 8):
+        if t % 10 == 9:
+            ped_ids = ped_ids[1:] + [ped_ids[-1] + 1]
+            positions = torch.cat([positions[1:], torch.randn(1, 2) * 5])
+        positions = positions + torch.randn(args.n_peds, 2) * 0.1
+        frames.append((list(ped_ids), positions.clone()))
+
+    # Parity with graph_tern on the window rebuilt from raw frames, under the deterministic reducer.
+    # Entering pedestrians are padded with their first position, as in the online buffer.
+    reference = OnlinePredictor(model, max_peds=args.n_peds * 2, clustering='quantile')
+    with torch.no_grad():
+        for t, (ids, pos) in enumerate(frames[:32]):
+            ped_ids, V_refi = reference.step(ids, pos)
+            if t < 7:
+                continue
+            tracks = [dict(zip(*frame)) for frame in frames[t - 7:t + 1]]
+            first = {i: next(track[i] for track in tracks if i in track) for i in ped_ids}
+            V_abs = torch.stack([torch.stack([track.get(i, first[i]) for i in ped_ids]) for track in tracks])
+            V_rel = torch.cat([torch.zeros_like(V_abs[:1]), V_abs[1:] - V_abs[:-1]])
+            S_obs = torch.stack([V_abs, V_rel]).unsqueeze(dim=0).to(device)
+            assert torch.allclose(V_refi, model(S_obs, pruning=4, clustering='quantile')[2], atol=1e-4)
+
+    rebuild = {name: [] for name in predictors}
+    with torch.no_grad():
+        for t, (ids, pos) in enumerate(frames):
+            for predictor in predictors.values():
+                predictor.step(ids, pos)
+            if t < 8:
+                continue
+            # Previous entry point, S_obs[1, 2, 8, V, 2] rebuilt from the last 8 raw frames
+            for name in predictors:
+                start = time.perf_counter()
+                tracks = [dict(zip(*frame)) for frame in frames[t - 7:t + 1]]
+                V_abs = torch.stack([torch.stack([track.get(i, tracks[-1][i]) for i in ids]) for track in tracks])
+                V_rel = torch.cat([torch.zeros_like(V_abs[:1]), V_abs[1:] - V_abs[:-1]])
+                S_obs = torch.stack([V_abs, V_rel]).unsqueeze(dim=0).to(device)
+                model(S_obs, pruning=4, clustering=name)
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                rebuild[name].append((time.perf_counter() - start) * 1000)
+
+    print('Online inference, {0} pedestrians, n_smpl={1} on {2}'.format(args.n_peds, model.n_smpl, device))
+    for name, predictor in predictors.items():
+        online = [latency * 1000 for latency in list(predictor.latencies)[8:]]
+        for tag, latencies in [('rebuild', rebuild[name]), ('online', online)]:
+            print('{0:28s} p50: {1:.3f} ms  p99: {2:.3f} ms'.format(
+                tag + ' ' + name, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+def bench_precision(args, device):
+    r"""ADE/FDE drift against speedup of each inference precision over float32, on every ETH/UCY split.
+
+    The deterministic 'quantile' endpoint reducer is used, so that the drift only comes from the precision."""
+
+    modes = ['fp32', 'bf16', 'fp16'] + (['int8'] if device.type == 'cpu' else [])
+    print('{0:36s} {1:>6s} {2:>8s} {3:>8s} {4:>10s} {5:>10s} {6:>8s}'.format(
+        'tag', 'mode', 'ADE', 'FDE', 'dADE', 'dFDE', 'speedup'))
+    for tag in sorted(glob.glob('./checkpoint/*/args.pkl')):
+        tag = os.path.basename(os.path.dirname(tag))
+        test_dataset = load_test_dataset(load_args(tag))
+        for mode in modes:
+            model, train_args = load_model(tag, device)
+            set_precision(model, train_args, mode)
+            start = time.perf_counter()
+            ade, fde, _ = test(model, test_dataset, device, repeat=1, clustering='quantile', progress=False)
+            elapsed = time.perf_counter() - start
+            if mode == 'fp32':
+                reference = (ade, fde, elapsed)
+            print('{0:36s} {1:>6s} {2:8.4f} {3:8.4f} {4:+10.2e} {5:+10.2e} {6:7.2f}x'.format(
+                tag, mode, ade, fde, ade - reference[0], fde - reference[1], reference[2] / elapsed))
+
+
+benchmarks = {'adjacency': bench_adjacency, 'forward': bench_forward, 'loss': bench_loss, 'reducer': bench_reducer,
+              'online': bench_online, 'precision': bench_precision, 'augment': bench_augment}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', default='adjacency', choices=list(benchmarks.keys()))
+    parser.add_argument('--n_smpl', type=int, default=40, help='Number of samples (graph batch size)')
+    parser.add_argument('--seq_len', type=int, default=20, help='Number of frames')
+    parser.add_argument('--n_peds', type=int, default=16, help='Number of pedestrians')
+    parser.add_argument('--repeat', type=int, default=100, help='Number of timed repetitions')
+    parser.add_argument('--tag', default='graph-tern_eth_experiment', help='Checkpoint tag for accuracy benchmarks')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    benchmarks[args.bench](args, torch.device(args.device))
+
+
+if __name__ == "__main__":
+    main()
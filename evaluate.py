@@ -0,0 +1,93 @@
+import os
+import glob
+import time
+import argparse
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from graphtern.endpoint import endpoint_reducers
+from graphtern.quantization import precision_modes
+from test import load_args, load_model, load_test_dataset, set_precision, test, export
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tags', nargs='*', default=None, help='Checkpoint tags to evaluate, every checkpoint by default')
+parser.add_argument('--n_samples', type=int, default=20, help='Number of samples')
+parser.add_argument('--clustering', default='kmeans', choices=list(endpoint_reducers.keys()),
+                    help='Reducer of the pruned endpoint GMMs to n_samples endpoints')
+parser.add_argument('--repeat', type=int, default=10, help='Number of evaluation repeats, run in a single pass')
+parser.add_argument('--seed', type=int, default=None, help='Random seed for a reproducible evaluation')
+parser.add_argument('--batch_size', type=int, default=16, help='Number of scenes per forward pass')
+parser.add_argument('--max_nodes', type=int, default=None, help='Maximum number of padded pedestrian nodes per batch')
+parser.add_argument('--max_edges', type=int, default=65536,
+                    help='Maximum number of padded pedestrian edges per forward pass, counting every repeat')
+parser.add_argument('--precision', default='fp32', choices=list(precision_modes.keys()) + ['int8'],
+                    help='Inference precision, int8 quantizes the convolutions for CPU inference')
+parser.add_argument('--calibration', type=int, default=32, help='Number of training batches calibrating int8')
+parser.add_argument('--devices', nargs='+', default=['cpu'],
+                    help='Devices the checkpoints are spread over round-robin (e.g. cpu, or cuda:0 cuda:1)')
+parser.add_argument('--workers', type=int, default=None,
+                    help='Number of evaluation processes, one per checkpoint by default')
+parser.add_argument('--output', default='results.csv', help='Consolidated .csv or .parquet results table')
+
+
+def evaluate_checkpoint(task):
+    r"""Evaluates one checkpoint in a worker process and returns its results row."""
+
+    tag, device, num_threads, options = task
+    torch.set_num_threads(num_threads)
+    device = torch.device(device)
+
+    start = time.time()
+    model, args = load_model(tag, device)
+    set_precision(model, args, options.precision, options.calibration)
+    test_dataset = load_test_dataset(args)  # memory-mapped from the cache built by the parent process
+    if options.seed is not None:
+        torch.manual_seed(options.seed)
+        np.random.seed(options.seed)
+
+    ade, fde, _ = test(model, test_dataset, device, KSTEPS=options.n_samples, repeat=options.repeat,
+                       clustering=options.clustering, batch_size=options.batch_size, max_nodes=options.max_nodes,
+                       max_edges=options.max_edges, progress=False)
+    print('Evaluated {0}: ADE {1:.4f}, FDE {2:.4f}'.format(tag, ade, fde), flush=True)
+    return [tag, args.dataset, len(test_dataset), ade, fde, time.time() - start]
+
+
+def main():
+    options = parser.parse_args()
+
+    tags = options.tags
+    if tags is None:
+        tags = sorted(os.path.basename(os.path.dirname(path))
+                      for path in glob.glob('./checkpoint/*/args.pkl'))
+    assert len(tags) > 0, "no checkpoint found in ./checkpoint/"
+    assert options.precision != 'int8' or set(options.devices) == {'cpu'}, "int8 inference runs on CPU"
+
+    # Parse every dataset once here, so that the workers only memory-map the shared cache
+    for tag in tags:
+        load_test_dataset(load_args(tag))
+
+    workers = min(options.workers or len(tags), len(tags))
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    tasks = [(tag, options.devices[i % len(options.devices)], num_threads, options) for i, tag in enumerate(tags)]
+
+    # Workers fork from a server that has not touched OpenMP or CUDA, a crashed worker raises BrokenProcessPool
+    start = time.time()
+    context = mp.get_context('forkserver')
+    context.set_forkserver_preload(['test'])
+    with ProcessPoolExecutor(workers, mp_context=context) as pool:
+        rows = list(pool.map(evaluate_checkpoint, tasks))
+
+    header = ('tag', 'dataset', 'num_scenes', 'ade', 'fde', 'seconds')
+    rows.append(['AVG', '-', sum(row[2] for row in rows), float(np.mean([row[3] for row in rows])),
+                 float(np.mean([row[4] for row in rows])), time.time() - start])
+    export(options.output, rows, header)
+
+    print('{0:40s} {1:>8s} {2:>10s} {3:>8s} {4:>8s} {5:>8s}'.format(*header))
+    for row in rows:
+        print('{0:40s} {1:>8s} {2:10d} {3:8.4f} {4:8.4f} {5:8.1f}'.format(*row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+import argparse
+import numpy as np
+import torch
+from graphtern.export import graph_tern_inference, quantile_noise
+from test import load_model, load_test_dataset
+from runtime import ExportedPredictor
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tag', default='graph-tern_eth_experiment', help='Checkpoint tag of the exported model')
+parser.add_argument('--format', default='onnx', choices=['onnx', 'torchscript'], help='Export format')
+parser.add_argument('--output', default=None, help='Output path, <checkpoint_dir>/<dataset>_best.{onnx,pt} by default')
+parser.add_argument('--n_samples', type=int, default=20, help='Default number of samples of the runtime')
+parser.add_argument('--pruning', type=int, default=4, help='Number of pruned GMM components')
+parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+parser.add_argument('--n_check', type=int, default=20, help='Number of test scenes of the parity check')
+parser.add_argument('--atol', type=float, default=1e-3, help='Tolerance of the parity check')
+
+
+def main():
+    export_args = parser.parse_args()
+    model, args = load_model(export_args.tag, torch.device('cpu'))
+    module = graph_tern_inference(model, pruning=export_args.pruning)
+    meta = {'obs_len': args.obs_seq_len, 'pred_len': args.pred_seq_len, 'n_ways': args.n_ways,
+            'n_samples': export_args.n_samples}
+
+    output = export_args.output
+    if output is None:
+        extension = '.onnx' if export_args.format == 'onnx' else '.pt'
+        output = './checkpoint/' + export_args.tag + '/' + args.dataset + '_best' + extension
+
+    # Example inputs, the number of pedestrians and samples stay dynamic.
+    # The noise is drawn per pedestrian, or has a single pedestrian broadcast to all of them.
+    S_obs = torch.randn(1, 2, args.obs_seq_len, 3, 2).cumsum(dim=2)
+    noise = torch.cat([torch.rand(export_args.n_samples, args.n_ways, 3, 1),
+                       torch.randn(export_args.n_samples, args.n_ways, 3, 2)], dim=-1)
+    with torch.no_grad():
+        if export_args.format == 'onnx':
+            import onnx
+            torch.onnx.export(module, (S_obs, noise), output, dynamo=False, opset_version=export_args.opset,
+                              input_names=['S_obs', 'noise'], output_names=['V_refi'],
+                              dynamic_axes={'S_obs': {3: 'num_peds'}, 'noise': {0: 'n_samples', 2: 'noise_peds'},
+                                            'V_refi': {0: 'n_samples', 2: 'num_peds'}})
+            exported = onnx.load(output)
+            onnx.helper.set_model_props(exported, {key: str(value) for key, value in meta.items()})
+            onnx.save(exported, output)
+        else:
+            traced = torch.jit.trace(module, (S_obs, noise))
+            torch.jit.save(traced, output, _extra_files={'meta.json': json.dumps(meta)})
+    print('Exported {0} to {1}'.format(export_args.tag, output))
+
+    # Parity check of the exported runtime against the eager model, with the 'quantile' endpoint reducer
+    # and with the random per-pedestrian noise of the runtime
+    runtime = ExportedPredictor(output, seed=0)
+    test_dataset = load_test_dataset(args)
+    model.n_smpl = export_args.n_samples
+    noise = quantile_noise(export_args.n_samples, args.n_ways)
+    max_error = {'quantile': 0., 'random': 0.}
+    with torch.no_grad():
+        for index in range(min(export_args.n_check, len(test_dataset))):
+            S_obs = test_dataset[index][0].unsqueeze(dim=0)
+            V_refi = model(S_obs, pruning=export_args.pruning, clustering='quantile')[2].numpy()
+            V_export = runtime.predict(S_obs[0, 0].numpy(), noise.numpy())
+            max_error['quantile'] = max(max_error['quantile'], float(np.abs(V_refi - V_export).max()))
+
+            random_noise = runtime.sample_noise(S_obs.size(3))
+            V_refi = module(S_obs, torch.from_numpy(random_noise)).numpy()
+            V_export = runtime.predict(S_obs[0, 0].numpy(), random_noise)
+            max_error['random'] = max(max_error['random'], float(np.abs(V_refi - V_export).max()))
+    for name, error in max_error.items():
+        print('Parity check on {0} test scenes with {1} noise, max abs error: {2:.2e}'.format(index + 1, name, error))
+        assert error < export_args.atol, "exported model diverges from the eager model"
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
 from .model import graph_tern
-from .loss import gaussian_mixture_loss, mse_loss
-from .saits import saits_model
+from .loss import gaussian_mixture_loss, mse_loss, scene_mask
+from .saits import SaitsImputer, mcar_mask
+from .online import OnlinePredictor
@@ -0,0 +1,22 @@
+import torch
+
+
+class SharedAdjacency:
+    r"""Refinement adjacency whose observed frames are shared by every sample.
+
+    obs[1, R, T_obs, V, V] holds the observed graph once and pred[N, R, T_pred, V, V] the
+    per-sample predicted graph, standing for their concatenation along time with obs
+    repeated N times. Either part may also be a SparseAdjacency.
+    """
+
+    def __init__(self, obs, pred):
+        assert obs.size(0) == 1, "the observed graph is shared by all samples"
+        self.obs = obs
+        self.pred = pred
+        self.shape = torch.Size((pred.size(0), pred.size(1), obs.size(2) + pred.size(2), *pred.shape[3:]))
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def detach(self):
+        return SharedAdjacency(self.obs.detach(), self.pred.detach())
@@ -0,0 +1,68 @@
+import torch
+
+
+class SceneBatch:
+    r"""Index bookkeeping for a mini-batch of scenes concatenated along the pedestrian axis.
+
+    Node features stay concatenated as [..., V] with V the total number of pedestrians.
+    Graph operations and convolutions mixing neighbouring pedestrians run on a padded
+    [..., B, V_max] layout, where the padding slots of each scene replicate its last
+    pedestrian so that replicate-padded convolutions never see another scene.
+    """
+
+    def __init__(self, seq_start_end, device=None):
+        seq_start_end = torch.as_tensor(seq_start_end, dtype=torch.long).cpu()
+        start, end = seq_start_end[:, 0], seq_start_end[:, 1]
+        counts = end - start
+
+        self.seq_start_end = seq_start_end
+        self.n_scenes = len(counts)
+        self.n_nodes = int(counts.sum())
+        self.max_nodes = int(counts.max())
+
+        local = torch.arange(self.max_nodes)
+        node_mask = local.unsqueeze(dim=0) < counts.unsqueeze(dim=1)  # [B, V_max]
+        pad_index = torch.minimum(start.unsqueeze(dim=1) + local, end.unsqueeze(dim=1) - 1)  # [B, V_max]
+        scene_index = torch.repeat_interleave(torch.arange(self.n_scenes), counts)  # [V]
+        unpad_index = scene_index * self.max_nodes + torch.arange(self.n_nodes) - start[scene_index]  # [V]
+
+        self.counts = counts.to(device)
+        self.node_mask = node_mask.to(device)
+        self.edge_mask = (node_mask.unsqueeze(dim=-1) & node_mask.unsqueeze(dim=-2)).to(device)  # [B, V_max, V_max]
+        self.pad_index = pad_index.flatten().to(device)
+        self.unpad_index = unpad_index.to(device)
+        self.scene_index = scene_index.to(device)
+
+    def to_padded(self, x, dim=-1):
+        r"""Returns x with its pedestrian axis [V] at dim expanded to [B, V_max]."""
+
+        dim = dim % x.dim()
+        return x.index_select(dim, self.pad_index).unflatten(dim, (self.n_scenes, self.max_nodes))
+
+    def from_padded(self, x, dim=-2):
+        r"""Returns x with its [B, V_max] axes starting at dim collapsed back to the pedestrian axis [V]."""
+
+        dim = dim % x.dim()
+        return x.flatten(dim, dim + 1).index_select(dim, self.unpad_index)
+
+    def apply(self, module, x):
+        r"""Applies a 2D conv block to x[N, C, H, V] with replicate padding confined to each scene."""
+
+        N = x.size(0)
+        x = self.to_padded(x).movedim(-2, 1).flatten(0, 1)  # [N*B, C, H, V_max]
+        x = module(x)
+        x = x.unflatten(0, (N, self.n_scenes)).movedim(1, -2)  # [N, C, H, B, V_max]
+        return self.from_padded(x)
+
+    def mean(self, x):
+        r"""Returns the per-scene mean of x[..., V] over every element belonging to each scene."""
+
+        x = x.reshape(-1, x.size(-1)).mean(dim=0)
+        out = torch.zeros(self.n_scenes, device=x.device, dtype=x.dtype).index_add_(0, self.scene_index, x)
+        return out / self.counts
+
+
+def scene_apply(module, x, batch=None):
+    r"""Applies module to x, keeping scenes of a SceneBatch apart along the pedestrian axis."""
+
+    return module(x) if batch is None else batch.apply(module, x)
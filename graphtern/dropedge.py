@@ -7,7 +7,6 @@ def drop_edge(A, percent, training=True, inplace=False):
     assert 0 <= percent <= 1.0
     if not training:
         return A
-    A_prime = torch.rand_like(A)
-    A_drop = A if inplace else A.clone()
-    A_drop[A_prime > percent] = 0
-    return A_drop
+    # A single buffer holds the random draw, the keep mask and the result
+    keep = torch.rand_like(A).le_(percent)
+    return A.mul_(keep) if inplace else keep.mul_(A)
@@ -0,0 +1,80 @@
+import math
+import torch
+from torch.quasirandom import SobolEngine
+from .kmeans import BatchKMeans
+
+
+# Bounds of the predicted log standard deviations, a diverging GMM stays finite when sampled or scored
+LOG_STD_MIN, LOG_STD_MAX = -10., 10.
+
+
+def sample_endpoints(V_init, n_ways, sample_shape, pruning=None, uniform=None):
+    r"""Draws endpoints from the n_ways GMMs of V_init[N, M, V, C*K], averaged over the ways.
+
+    All ways and samples are drawn at once with the Gumbel-max trick for the mixture index
+    and a reparameterized normal for the component, giving samples[*sample_shape, V, 2].
+    With pruning, the pruning least likely components of each GMM are discarded.
+    With uniform[*sample_shape, K, 3], samples are the inverse CDF transform of these
+    uniform numbers instead, shared by every pedestrian (e.g. quasi-Monte-Carlo points)."""
+
+    # NMV(C*K) -> KNVMC (C: [mu_x, mu_y, std_x, std_y, pi])
+    params = V_init.detach().unflatten(-1, (n_ways, -1)).permute(3, 0, 2, 1, 4)
+    logits = params[..., 4]
+    if pruning is not None:
+        logits = logits.scatter(-1, logits.argsort(dim=-1)[..., :pruning], -1e8)
+
+    shape = (*sample_shape, *logits.shape)
+    if uniform is None:
+        # Mixture index k = argmax(logits + Gumbel noise) [*S, K, N, V]
+        gumbel = torch.rand(shape, device=logits.device, dtype=logits.dtype).log_().neg_().log_().neg_()
+        index = gumbel.add_(logits).argmax(dim=-1, keepdim=True)
+        eps = torch.randn(*shape[:-1], 2, device=logits.device, dtype=logits.dtype)
+    else:
+        # Mixture index from the cumulative mixture weights, normal from the inverse error function
+        uniform = uniform.to(logits).clamp(1e-6, 1 - 1e-6)[..., None, None, :]  # [*S, K, 1, 1, 3]
+        cdf = logits.softmax(dim=-1).cumsum(dim=-1)
+        cdf = cdf / cdf[..., -1:]
+        index = (cdf < uniform[..., :1]).sum(dim=-1, keepdim=True).clamp_(max=logits.size(-1) - 1)
+        eps = torch.erfinv(uniform[..., 1:] * 2 - 1).mul_(math.sqrt(2)).expand(*shape[:-1], 2)
+
+    index = index.unsqueeze(dim=-1).expand(*shape[:-1], 1, 4)
+    comp = params[..., :4].expand(*shape, 4).gather(-2, index).squeeze(dim=-2)  # [*S, K, N, V, 4]
+
+    # Reparameterized component sample mu + std * eps, averaged over the ways
+    endpoint = eps * comp[..., 2:].clamp(LOG_STD_MIN, LOG_STD_MAX).exp() + comp[..., :2]
+    return endpoint.mean(dim=-4).squeeze(dim=-3)
+
+
+def kmeans_endpoints(V_init, n_ways, n_smpl, pruning=None, n_repeat=1, n_candidates=1000):
+    r"""Reduces n_candidates GMM samples per pedestrian to the centroids of n_smpl k-means clusters.
+
+    Returns endpoints[n_repeat * n_smpl, V, 2], from n_repeat independent draws and clusterings."""
+
+    endpoint_set_prune = sample_endpoints(V_init, n_ways, (n_repeat, n_candidates), pruning)
+    # convergence checks sync with the device, so accelerators only check every 10 iterations
+    batch_k_means = BatchKMeans(n_clusters=n_smpl, n_redo=1, check_every=1 if V_init.device.type == 'cpu' else 10)
+    batch_k_means.fit(endpoint_set_prune.permute(0, 2, 3, 1).contiguous())
+    return batch_k_means.centroids.permute(0, 3, 1, 2).flatten(0, 1)
+
+
+def farthest_point_endpoints(V_init, n_ways, n_smpl, pruning=None, n_repeat=1, n_candidates=1000):
+    r"""Selects n_smpl mutually distant endpoints among n_candidates quasi-Monte-Carlo GMM samples."""
+
+    uniform = SobolEngine(3 * n_ways, scramble=True).draw(n_repeat * n_candidates)
+    endpoint_set_prune = sample_endpoints(V_init, n_ways, (n_repeat, n_candidates), pruning,
+                                          uniform.view(n_repeat, n_candidates, n_ways, 3))
+    # Farthest point sampling is the k-means++ seeding of BatchKMeans
+    centroids = BatchKMeans(n_clusters=n_smpl).kmeanspp(endpoint_set_prune.permute(0, 2, 3, 1).contiguous())
+    return centroids.permute(0, 3, 1, 2).flatten(0, 1)
+
+
+def quantile_endpoints(V_init, n_ways, n_smpl, pruning=None, n_repeat=1):
+    r"""Returns n_smpl deterministic endpoints at fixed low-discrepancy quantiles of the GMMs, without sampling."""
+
+    uniform = SobolEngine(3 * n_ways, scramble=False).draw(n_smpl).add_(0.5 / n_smpl).remainder_(1)
+    endpoint_set = sample_endpoints(V_init, n_ways, (n_smpl,), pruning, uniform.view(n_smpl, n_ways, 3))
+    return endpoint_set.repeat(n_repeat, 1, 1)
+
+
+# Test-time reducers of the endpoint GMMs to n_smpl endpoints per pedestrian
+endpoint_reducers = {'kmeans': kmeans_endpoints, 'fps': farthest_point_endpoints, 'quantile': quantile_endpoints}
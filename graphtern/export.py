@@ -0,0 +1,64 @@
+import math
+import torch
+import torch.nn as nn
+from torch.quasirandom import SobolEngine
+from .endpoint import LOG_STD_MIN, LOG_STD_MAX
+
+
+def mixture_endpoints(V_init, n_ways, noise, pruning=None):
+    r"""Tensor-only endpoint sampler of the n_ways GMMs of V_init[1, M, V, C*K], averaged over the ways.
+
+    noise[S, K, V, 3] holds per sample, way and pedestrian a uniform number choosing the mixture
+    component by inverse CDF and two standard normals for the component. noise[S, K, 1, 3] is
+    broadcast to every pedestrian, and then equals sample_endpoints() with uniform = (u, Phi(z_x),
+    Phi(z_y)), without gather or erfinv ops."""
+
+    # 1MV(C*K) -> KVMC (C: [mu_x, mu_y, std_x, std_y, pi])
+    params = V_init.squeeze(dim=0).unflatten(-1, (n_ways, -1)).permute(2, 1, 0, 3)
+    logits = params[..., 4]
+    if pruning is not None:
+        logits = logits.scatter(-1, logits.argsort(dim=-1)[..., :pruning], -1e8)
+
+    # Mixture component from the cumulative mixture weights, as a one-hot [S, K, V, M]
+    cdf = logits.softmax(dim=-1).cumsum(dim=-1)
+    cdf = cdf / cdf[..., -1:]
+    n_mix = logits.size(-1)
+    index = (cdf < noise[..., :1]).sum(dim=-1, keepdim=True).clamp(max=n_mix - 1)
+    one_hot = (index == torch.arange(n_mix, device=index.device)).to(params.dtype)
+    comp = (one_hot.unsqueeze(dim=-1) * params[..., :4]).sum(dim=-2)  # [S, K, V, 4]
+
+    # Reparameterized component sample mu + std * eps, averaged over the ways
+    endpoint = noise[..., 1:] * comp[..., 2:].clamp(LOG_STD_MIN, LOG_STD_MAX).exp() + comp[..., :2]
+    return endpoint.mean(dim=1)
+
+
+def quantile_noise(n_smpl, n_ways):
+    r"""Returns the noise[n_smpl, n_ways, 1, 3] of mixture_endpoints() reproducing the 'quantile' endpoint reducer."""
+
+    uniform = SobolEngine(3 * n_ways, scramble=False).draw(n_smpl).add_(0.5 / n_smpl).remainder_(1)
+    uniform = uniform.view(n_smpl, n_ways, 3).clamp(1e-6, 1 - 1e-6)
+    noise = torch.cat([uniform[..., :1], torch.erfinv(uniform[..., 1:] * 2 - 1) * math.sqrt(2)], dim=-1)
+    return noise.unsqueeze(dim=2)
+
+
+class graph_tern_inference(nn.Module):
+    r"""Trace-friendly test-time Graph-TERN for a single scene.
+
+    Maps S_obs[1, 2, T_obs, V, 2] and the sampling noise[n_smpl, n_ways, V or 1, 3] of
+    mixture_endpoints() to the refined trajectories V_refi[n_smpl, T_pred, V, 2]. There is no
+    data-dependent control flow left, so torch.jit.trace and torch.onnx.export record it with a
+    dynamic number of pedestrians and samples.
+    """
+
+    def __init__(self, model, pruning=4):
+        super().__init__()
+        assert model.sparse_radius is None and model.sparse_knn is None, "only the dense graph can be exported"
+        self.model = model
+        self.pruning = pruning
+        self.eval()
+
+    def forward(self, S_obs, noise):
+        A_obs = self.model.adjacency(S_obs)
+        V_init = self.model.control_points(S_obs, A_obs)
+        endpoint_set = mixture_endpoints(V_init, self.model.n_ways, noise, self.pruning)
+        return self.model.refine(S_obs, A_obs, endpoint_set)[1]
@@ -4,13 +4,20 @@ import numpy as np
 
 
 class BatchKMeans(nn.Module):
-    def __init__(self, n_clusters, n_redo=1, max_iter=100, tol=1e-4, init_mode="kmeans++"):
+    def __init__(self, n_clusters, n_redo=1, max_iter=100, tol=1e-4, init_mode="kmeans++", batch_size=None,
+                 check_every=1):
+        r"""Batched k-means over data[..., d_vector, n_data], one clustering per leading index.
+
+        With batch_size, mini-batch k-means updates the centroids from batch_size random points
+        per iteration. Convergence is checked on the host only every check_every iterations."""
         super(BatchKMeans, self).__init__()
         self.n_redo = n_redo
         self.n_clusters = n_clusters
         self.max_iter = max_iter
         self.tol = tol
         self.init_mode = init_mode
+        self.batch_size = batch_size
+        self.check_every = check_every
         self.register_buffer("centroids", None)
 
     def load_state_dict(self, state_dict, **kwargs):
@@ -28,11 +35,11 @@ class BatchKMeans(nn.Module):
     def calculate_error(a, b):
         diff = a - b
         diff.pow_(2)
-        return diff.sum()
+        return diff.flatten(-2).sum(dim=-1)
 
     @staticmethod
     def calculate_inertia(a):
-        return (-a).mean()
+        return (-a).mean(dim=-1)
 
     @staticmethod
     def euc_sim(a, b):
@@ -42,39 +49,32 @@ class BatchKMeans(nn.Module):
         y.sub_(b.pow(2).sum(dim=-2)[..., None, :])
         return y
 
+    @staticmethod
+    def gather_points(data, index):
+        r"""Returns the points data[..., :, index] for an index[..., m] per leading index."""
+        return data.gather(-1, index.unsqueeze(dim=-2).expand(*data.shape[:-1], index.size(-1)))
+
     def kmeanspp(self, data):
         d_vector, n_data = data.shape[-2:]
-        centroids = torch.zeros(*data.shape[:-2], d_vector, self.n_clusters, device=data.device, dtype=data.dtype)
+        centroids = data.new_zeros(*data.shape[:-2], d_vector, self.n_clusters)
         # Select initial centroid
         centroids[..., 0] = data[..., np.random.randint(n_data)]
+        # Similarity to the nearest centroid, updated with the newest centroid only
+        max_sims_v = self.euc_sim(data, centroids[..., :1]).squeeze(dim=-1)  # [l,m]
         for i in range(1, self.n_clusters):
-            current_centroids = centroids[..., :i].contiguous()
-            sims = self.euc_sim(data, current_centroids)  # [l,m,n]
-            max_sims_v, max_sims_i = sims.max(dim=-1)  # [l,m]
-            index = max_sims_v.argmin(dim=-1)  # [l]
-
-            if len(data.shape) == 2:
-                new_centroid = data[:, index]
-            elif len(data.shape) == 3:
-                arange = torch.arange(data.size(0), device=data.device)
-                new_centroid = data[arange, :, index]  # [l, d_vector]
-            elif len(data.shape) == 4:
-                arange_w = torch.arange(data.size(0), device=data.device).unsqueeze(dim=1)
-                arange_h = torch.arange(data.size(1), device=data.device).unsqueeze(dim=0)
-                new_centroid = data[arange_w, arange_h, :, index]
-            else:
-                raise NotImplementedError
-
-            centroids[..., i] = new_centroid
+            index = max_sims_v.argmin(dim=-1, keepdim=True)  # [l,1]
+            centroids[..., i:i + 1] = self.gather_points(data, index)
+            sims = self.euc_sim(data, centroids[..., i:i + 1]).squeeze(dim=-1)
+            torch.maximum(max_sims_v, sims, out=max_sims_v)
         return centroids
 
     def initialize_centroids(self, data):
         n_data = data.size(-1)
         if self.init_mode == "random":
             random_index = np.random.choice(n_data, size=[self.n_clusters], replace=False)
-            centroids = data[:, :, random_index].clone()
+            centroids = data[..., random_index].clone()
         elif self.init_mode == "kmeans++":
-            centroids = self.kmeanspp(data).clone()
+            centroids = self.kmeanspp(data)
         return centroids
 
     def get_labels(self, data, centroids):
@@ -82,53 +82,93 @@ class BatchKMeans(nn.Module):
         maxsims, labels = sims.max(dim=-1)  # [l, sub_m]
         return maxsims, labels
 
-    def compute_centroids_loop(self, data, labels):
-        mask = [labels == i for i in range(self.n_clusters)]
-        mask = torch.stack(mask, dim=-1)  # l d n_clusters
-        centroids = (data.unsqueeze(dim=-1) * mask.unsqueeze(dim=-3)).sum(dim=-2) / mask.sum(dim=-2, keepdim=True)
-        return centroids
+    def cluster_sums(self, data, labels):
+        r"""Returns the per-cluster sums [..., d, n_clusters] and point counts [..., 1, n_clusters] of data."""
+        sums = data.new_zeros(*data.shape[:-1], self.n_clusters)
+        sums.scatter_add_(-1, labels.unsqueeze(dim=-2).expand_as(data), data)
+        counts = data.new_zeros(*labels.shape[:-1], 1, self.n_clusters)
+        counts.scatter_add_(-1, labels.unsqueeze(dim=-2), data.new_ones(()).expand(*labels.shape[:-1], 1, labels.size(-1)))
+        return sums, counts
 
-    def compute_centroids(self, data, labels):
-        centroids = self.compute_centroids_loop(data, labels)
-        return centroids
+    def compute_centroids(self, data, labels, centroids):
+        sums, counts = self.cluster_sums(data, labels)
+        # Empty clusters keep their previous centroid
+        return torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
 
     def fit(self, data, centroids=None):
         assert data.is_contiguous(), "use .contiguous()"
 
         best_centroids = None
-        best_error = 1e32
         best_labels = None
-        best_inertia = 1e32
+        best_inertia = None
         for i in range(self.n_redo):
             if centroids is None:
                 centroids = self.initialize_centroids(data)
-            for j in range(self.max_iter):
-                # 1 iteration of clustering
-                maxsims, labels = self.get_labels(data, centroids)  # top1 search
-                new_centroids = self.compute_centroids(data, labels)
-                error = self.calculate_error(centroids, new_centroids)
-                centroids = new_centroids
-                inertia = self.calculate_inertia(maxsims)
-                if error <= self.tol:
-                    break
-
-            if inertia < best_inertia:
-                best_centroids = centroids
-                best_error = error
-                best_labels = labels
-                best_inertia = inertia
+            centroids = self.lloyd(data, centroids) if self.batch_size is None else self.mini_batch(data, centroids)
+            maxsims, labels = self.get_labels(data, centroids)
+            inertia = self.calculate_inertia(maxsims)
+
+            # Keep the best run for every clustering of the batch
+            if best_inertia is None:
+                best_centroids, best_labels, best_inertia = centroids, labels, inertia
+            else:
+                better = inertia < best_inertia
+                best_centroids = torch.where(better[..., None, None], centroids, best_centroids)
+                best_labels = torch.where(better[..., None], labels, best_labels)
+                best_inertia = torch.where(better, inertia, best_inertia)
             centroids = None
 
         self.register_buffer("centroids", best_centroids)
         return best_labels
 
+    def lloyd(self, data, centroids):
+        r"""Runs Lloyd iterations until each clustering of the batch moves less than tol.
+
+        Converged clusterings are dropped from the batch at every convergence check."""
+        shape = centroids.shape
+        data = data.reshape(-1, *data.shape[-2:])
+        centroids = centroids.reshape(-1, *shape[-2:]).clone()
+        active = torch.arange(centroids.size(0), device=data.device)
+        x, c = data, centroids
+        for j in range(self.max_iter):
+            # 1 iteration of clustering
+            _, labels = self.get_labels(x, c)  # top1 search
+            new_c = self.compute_centroids(x, labels, c)
+            error = self.calculate_error(c, new_c)
+            c = new_c
+            if (j + 1) % self.check_every == 0:
+                converged = error <= self.tol
+                if bool(converged.any()):
+                    centroids[active[converged]] = c[converged]
+                    active, x, c = active[~converged], x[~converged], c[~converged]
+                    if len(active) == 0:
+                        break
+        centroids[active] = c
+        return centroids.view(shape)
+
+    def mini_batch(self, data, centroids):
+        r"""Runs mini-batch k-means, moving each centroid by the mean of its batch points at rate 1 / count."""
+        total = data.new_zeros(*data.shape[:-2], 1, self.n_clusters)
+        for j in range(self.max_iter):
+            index = torch.randint(data.size(-1), (self.batch_size,), device=data.device)
+            batch = data.index_select(-1, index)
+            _, labels = self.get_labels(batch, centroids)
+            sums, counts = self.cluster_sums(batch, labels)
+            total += counts
+            new_centroids = centroids + (sums - counts * centroids) / total.clamp(min=1)
+            error = self.calculate_error(centroids, new_centroids)
+            centroids = new_centroids
+            if (j + 1) % self.check_every == 0 and bool((error <= self.tol).all()):
+                break
+        return centroids
+
     def predict(self, query):
         _, labels = self.get_labels(query, self.centroids)
         return labels
 
 
 if __name__ == "__main__":
-    x = torch.randn(13, 29, 2, 1000).cuda()
+    x = torch.randn(13, 29, 2, 1000, device='cuda' if torch.cuda.is_available() else 'cpu')
     multi_k_means = BatchKMeans(n_clusters=20, n_redo=1)
     multi_k_means.fit(x)
     print(multi_k_means.centroids.shape)
@@ -1,35 +1,82 @@
+import math
 import torch
-from torch.distributions import Categorical, Normal, Independent, MixtureSameFamily
+from .batching import SceneBatch
+from .endpoint import LOG_STD_MIN, LOG_STD_MAX
 
 
-def gaussian_mixture_loss(W_pred, S_trgt, n_stop):
-    r"""Batch gaussian mixture loss"""
-    # NMV(C*K) -> NVM(C*K)
-    W_pred = W_pred.transpose(1, 2).contiguous()
+LOG_SQRT_2PI = 0.5 * math.log(2 * math.pi)
+
+
+def scene_reduce(loss, seq_start_end=None):
+    r"""Returns the mean loss, or the per-scene mean losses when seq_start_end is given."""
+
+    if seq_start_end is None:
+        return loss.mean()
+    return SceneBatch(seq_start_end, device=loss.device).mean(loss)
+
+
+def scene_mask(loss, max_loss=None):
+    r"""Returns the mask of the per-scene losses that are finite and at most max_loss, the others are outliers."""
+
+    mask = torch.isfinite(loss)
+    if max_loss is not None:
+        mask = mask & loss.le(max_loss)
+    return mask
+
 
-    temp = S_trgt.chunk(chunks=n_stop, dim=1)
-    W_trgt_list = [i.mean(dim=1) for i in temp]
-    W_pred_list = W_pred.chunk(chunks=n_stop, dim=-1)
+def gaussian_mixture_nll(W_pred, W_trgt):
+    r"""Negative log-likelihood of W_trgt[..., C] under the GMMs W_pred[..., M, C+3]"""
+    # W_pred C: [mu_x, mu_y, log_std_x, log_std_y, pi]
+    log_std = W_pred[..., 2:4].clamp(LOG_STD_MIN, LOG_STD_MAX)
+    z = (W_trgt.unsqueeze(dim=-2) - W_pred[..., 0:2]) * (-log_std).exp()
+    log_prob = -0.5 * z.pow(2) - log_std - LOG_SQRT_2PI
+    log_prob = log_prob.sum(dim=-1) + W_pred[..., 4].log_softmax(dim=-1)
+    return -log_prob.logsumexp(dim=-1)
+
+
+class GaussianMixtureNLL(torch.autograd.Function):
+    r"""gaussian_mixture_nll() with a closed-form backward recomputing the component terms"""
+
+    @staticmethod
+    def forward(ctx, W_pred, W_trgt):
+        ctx.save_for_backward(W_pred, W_trgt)
+        return gaussian_mixture_nll(W_pred, W_trgt)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        W_pred, W_trgt = ctx.saved_tensors
+        log_std = W_pred[..., 2:4].clamp(LOG_STD_MIN, LOG_STD_MAX)
+        inv_std = (-log_std).exp()
+        z = (W_trgt.unsqueeze(dim=-2) - W_pred[..., 0:2]) * inv_std
+        log_mix = W_pred[..., 4].log_softmax(dim=-1)
+        log_prob = (-0.5 * z.pow(2) - log_std - LOG_SQRT_2PI).sum(dim=-1) + log_mix
+
+        # Posterior responsibility of each component, scaled by the incoming gradient
+        resp = log_prob.softmax(dim=-1) * grad_output.unsqueeze(dim=-1)
+        grad_pred = torch.cat([-resp.unsqueeze(dim=-1) * z * inv_std,
+                               -resp.unsqueeze(dim=-1) * (z.pow(2) - 1) * (log_std == W_pred[..., 2:4]),
+                               (log_mix.exp() * grad_output.unsqueeze(dim=-1) - resp).unsqueeze(dim=-1)], dim=-1)
+        grad_trgt = (resp.unsqueeze(dim=-1) * z * inv_std).sum(dim=-2) if ctx.needs_input_grad[1] else None
+        return grad_pred, grad_trgt
+
+
+def gaussian_mixture_loss(W_pred, S_trgt, n_stop, seq_start_end=None, fused=False):
+    r"""Batch gaussian mixture loss"""
+    # NMV(C*K) -> KNVMC
+    W_pred = W_pred.unflatten(-1, (n_stop, -1)).permute(3, 0, 2, 1, 4)
 
-    loss_list = []
-    for i in range(n_stop):
-        # NVMC
-        W_pred_one = W_pred_list[i]
-        W_trgt_one = W_trgt_list[i]
-        mix = Categorical(torch.nn.functional.softmax(W_pred_one[:, :, :, 4], dim=-1))
-        comp = Independent(Normal(W_pred_one[:, :, :, 0:2], W_pred_one[:, :, :, 2:4].exp()), 1)
-        gmm = MixtureSameFamily(mix, comp)
-        loss_list.append(-gmm.log_prob(W_trgt_one))
+    # NTVC -> KNVC, mean position over the frames of each control point
+    W_trgt = S_trgt.unflatten(1, (n_stop, -1)).mean(dim=2).transpose(0, 1)
 
-    loss = torch.cat(loss_list, dim=0)
-    return loss.mean()
+    loss = GaussianMixtureNLL.apply(W_pred, W_trgt) if fused else gaussian_mixture_nll(W_pred, W_trgt)
+    return scene_reduce(loss.flatten(0, 1), seq_start_end)
 
 
-def mse_loss(S_pred, S_trgt, loss_mask, training=True):
+def mse_loss(S_pred, S_trgt, loss_mask, training=True, seq_start_end=None):
     r"""Batch mean square error loss"""
     # NTVC
     loss = (S_pred - S_trgt).norm(p=2, dim=3) ** 2
     loss = loss.mean(dim=1) * loss_mask
     if training:
         loss[loss > 1] = 0
-    return loss.mean()
+    return scene_reduce(loss, seq_start_end)
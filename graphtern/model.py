@@ -1,24 +1,89 @@
 import torch
 import torch.nn as nn
-from torch.distributions import Categorical, Independent, Normal, MixtureSameFamily
 from .stmrgcn import st_mrgcn, epcnn, trcnn
-from .kmeans import BatchKMeans
+from .endpoint import sample_endpoints, endpoint_reducers
+from .batching import SceneBatch
+from .sparse import SparseAdjacency
+from .adjacency import SharedAdjacency
+
+
+def generate_adjacency_matrix(V, batch=None, out=None):
+    if batch is not None:
+        # V[NATVC] -> V[NATBVC] padded per scene
+        V = batch.to_padded(V, dim=3)
+    # V[NAT...VC] -> A[N(2A)T...VV], distances are written straight into the output buffer
+    n_attr = V.size(1)
+    shape = (V.size(0), n_attr * 2, *V.shape[2:-1], V.size(-2))
+    if out is None:
+        out = V.new_empty(shape)
+    A, A_inv = out[:, :n_attr], out[:, n_attr:]
+    A.copy_(torch.cdist(V, V, compute_mode='donot_use_mm_for_euclid_dist'))
+    if batch is not None:
+        # Remove edges between scenes and to padding slots
+        A.mul_(batch.edge_mask)
+    torch.reciprocal(A, out=A_inv)
+    A_inv.nan_to_num_(nan=float('nan'), posinf=0.)
+    # [A_dist, A_disp, A_dist_inv, A_disp_inv]
+    return out
+
+
+def broadcast_adjacency_matrix(V):
+    r"""Returns generate_adjacency_matrix(V) of a single scene from broadcast elementwise ops only.
+
+    Used for ONNX export, which drops the writes of generate_adjacency_matrix into its output buffer."""
+
+    A = (V.unsqueeze(dim=-2) - V.unsqueeze(dim=-3)).pow(2).sum(dim=-1).sqrt()
+    A_inv = torch.where(A == 0, torch.zeros_like(A), 1. / A)
+    return torch.cat([A, A_inv], dim=1)
 
 
-def generate_adjacency_matrix(V):
-    # V[NATVC] -> temp[NATVVC]
-    temp = V.unsqueeze(dim=3).repeat_interleave(repeats=V.size(3), dim=3)
-    # temp[NATVVC] -> A[NATVV]
-    A = (temp - temp.transpose(3, 4)).norm(p=2, dim=5)
+def generate_sparse_adjacency_matrix(V, radius=None, knn=None, batch=None):
+    r"""Returns the adjacency of generate_adjacency_matrix() restricted to spatial neighbours.
+
+    An edge w -> v is kept when v lies within radius of w and/or is among the knn nearest
+    pedestrians of w in the same frame. Weights are only computed for the kept edges."""
+
+    N, _, T, n_nodes, _ = V.shape
+    # V[NATVC] -> pos[NTVC] or pos[NTBVC] padded per scene
+    pos = V[:, 0] if batch is None else batch.to_padded(V[:, 0], dim=2)
+    dist = torch.cdist(pos, pos)
+    eye = torch.eye(dist.size(-1), dtype=torch.bool, device=V.device)
+    mask = ~eye if batch is None else batch.edge_mask & ~eye
+
+    dist = dist.masked_fill(~mask, float('inf'))
+    keep = torch.zeros_like(dist, dtype=torch.bool)
+    if radius is not None:
+        keep = keep | dist.le(radius)
+    if knn is not None and dist.size(-1) > 1:
+        kth = dist.topk(min(knn, dist.size(-1) - 1), dim=-1, largest=False)[0][..., -1:]
+        keep = keep | (dist.le(kth) & dist.isfinite())
+
+    index = keep.nonzero().t()
+    if batch is None:
+        n, t, w, v = index
+    else:
+        n, t, b, w, v = index
+        pad_index = batch.pad_index.view(batch.n_scenes, batch.max_nodes)
+        w, v = pad_index[b, w], pad_index[b, v]
+
+    # Edge weights [A_dist, A_disp, A_dist_inv, A_disp_inv]
+    A = (V[n, :, t, w] - V[n, :, t, v]).norm(p=2, dim=-1).t()
     A_inv = 1. / A
     A_inv[A == 0] = 0
-    # [A_dist, A_disp, A_dist_inv, A_disp_inv]
-    return torch.cat([A, A_inv], dim=1)
+    return SparseAdjacency(torch.stack([n, t, w, v]), torch.cat([A, A_inv], dim=0), (N, 4, T, n_nodes, n_nodes))
 
 
 class graph_tern(nn.Module):
-    def __init__(self, n_epgcn=1, n_epcnn=6, n_trgcn=1, n_trcnn=4, seq_len=8, pred_seq_len=12, n_ways=3, n_smpl=20):
+    def __init__(self, n_epgcn=1, n_epcnn=6, n_trgcn=1, n_trcnn=4, seq_len=8, pred_seq_len=12, n_ways=3, n_smpl=20,
+                 sparse_radius=None, sparse_knn=None):
         super().__init__()
+        # Sparse pedestrian graph (dense when both are None)
+        self.sparse_radius = sparse_radius
+        self.sparse_knn = sparse_knn
+
+        # Reduced precision (torch.float16 / torch.bfloat16) of the graph and network, sampling stays in float32
+        self.precision = None
+
         # Control Point Prediction
         self.n_epgcn = n_epgcn
         self.n_epcnn = n_epcnn
@@ -65,43 +130,116 @@ class graph_tern(nn.Module):
             self.trcnns.append(trcnn(total_seq_len=total_seq_len, pred_seq_len=total_seq_len, in_channels=hidden_feat, out_channels=hidden_feat, t_ksize=(n_trcnn-j)*2+1))
         self.trcnns.append(trcnn(total_seq_len=total_seq_len, pred_seq_len=pred_seq_len, in_channels=hidden_feat, out_channels=input_feat))
 
-    def forward(self, S_obs, S_trgt=None, pruning=None, clustering=False):
+    def adjacency(self, V, batch=None):
+        if self.sparse_radius is None and self.sparse_knn is None:
+            if torch.onnx.is_in_onnx_export():
+                A = broadcast_adjacency_matrix(V)
+            else:
+                A = generate_adjacency_matrix(V, batch)
+        else:
+            A = generate_sparse_adjacency_matrix(V, self.sparse_radius, self.sparse_knn, batch)
+        # Distances are computed in float32, the normalization runs in the reduced precision,
+        # where inverse distances of nearly coincident pedestrians saturate instead of overflowing
+        if self.precision is None:
+            return A
+        return A.clamp(max=torch.finfo(self.precision).max).to(self.precision)
 
-        ##################################################
-        # Control Point Conditioned Endpoint Prediction  #
-        ##################################################
+    def autocast(self, x):
+        r"""Returns the autocast context of the reduced precision mode on the device of x."""
 
-        # Generate multi-relational pedestrian graph
-        # make adjacency matrix for observed 8 frames
-        A_obs = generate_adjacency_matrix(S_obs).detach()
+        return torch.autocast(x.device.type, dtype=self.precision, enabled=self.precision is not None)
+
+    def control_points(self, S_obs, A_obs, batch=None):
+        r"""Returns the endpoint GMM parameters V_init[N, M, V, C*n_ways] predicted from the observed graph."""
 
         # Graph Control Point Prediction
-        V_obs_abs = S_obs[:, 0]
         V_obs_rel = S_obs[:, 1]
 
         # NTVC -> NCTV
         V_init = V_obs_rel.permute(0, 3, 1, 2).contiguous()
-        # print(" here 1" ,V_init)
 
+        with self.autocast(V_init):
+            for k in range(self.n_epgcn):
+                V_init, A_obs = self.tp_mrgcns[k](V_init, A_obs, batch)
+
+            # NCTV -> NTCV
+            V_init = V_init.permute(0, 2, 1, 3).contiguous()
+
+            for k in range(self.n_epcnn):
+                V_init = self.tpcnns[k](V_init, batch)
+
+        # NTCV -> NTVC
+        return V_init.transpose(2, 3).to(S_obs.dtype).contiguous()
+
+    def refine(self, S_obs, A_obs, endpoint_set, batch=None):
+        r"""Returns the linearly interpolated V_pred and the refined absolute V_refi trajectories of endpoint_set[S, V, C]."""
+
+        V_obs_abs = S_obs[:, 0]
+        V_obs_rel = S_obs[:, 1]
 
-        for k in range(self.n_epgcn):
-            V_init, A_obs = self.tp_mrgcns[k](V_init, A_obs)
+        # Initial trajectory prediction
+        # Linear interpolation NVC -> NTVC
+        V_pred = endpoint_set.unsqueeze(dim=1).repeat_interleave(repeats=self.pred_seq_len, dim=1)
+        V_pred_abs = (V_pred.cumsum(dim=1) + V_obs_abs.squeeze(dim=0)[-1, :, :]).detach().clone()
+
+        # repeat to sampled times (batch size)
+        V_obs_rept = V_obs_rel.repeat_interleave(V_pred.size(0), dim=0)
+
+        # Graph Trajectory Refinement
+        # make adjacency matrix for predicted 12 frames (will be iteratively change)
+        A_pred = self.adjacency(torch.stack([V_pred_abs, V_pred], dim=1), batch)
+
+        # concatenate to make full 20 frame sequences
+        # the observed graph is the same for every sample, so it is kept once and shared
+        V = torch.cat([V_obs_rept, V_pred], dim=1).detach()
+        A = SharedAdjacency(A_obs, A_pred).detach()
+
+        # NTVC -> NCTV
+        V_corr = V.permute(0, 3, 1, 2).contiguous()
 
-        # NCTV -> NTCV
-        V_init = V_init.permute(0, 2, 1, 3).contiguous()
+        with self.autocast(V_corr):
+            for k in range(self.n_trgcn):
+                V_corr, A = self.st_mrgcns[k](V_corr, A, batch)
 
+            # NCTV -> NTCV
+            V_corr = V_corr.permute(0, 2, 1, 3).contiguous()
 
-        for k in range(self.n_epcnn):
-            V_init = self.tpcnns[k](V_init)
+            for k in range(self.n_trcnn):
+                V_corr = self.trcnns[k](V_corr, batch)
 
         # NTCV -> NTVC
-        V_init = V_init.transpose(2, 3).contiguous()
+        V_corr = V_corr.transpose(2, 3).to(V.dtype).contiguous()
+
+        # Refine initial trajectory
+        V_refi = V_pred_abs
+        V_refi[:, :-1] += V_corr[:, :-1]
+
+        return V_pred, V_refi
+
+    def forward(self, S_obs, S_trgt=None, pruning=None, clustering=False, seq_start_end=None, n_repeat=1, A_obs=None):
+        # Mini-batch of scenes concatenated along the pedestrian axis
+        batch = None
+        if seq_start_end is not None and len(seq_start_end) > 1:
+            batch = SceneBatch(seq_start_end, device=S_obs.device)
+
+        ##################################################
+        # Control Point Conditioned Endpoint Prediction  #
+        ##################################################
+
+        # Generate multi-relational pedestrian graph
+        # make adjacency matrix for observed 8 frames, unless maintained incrementally by the caller
+        if A_obs is None:
+            A_obs = self.adjacency(S_obs, batch)
+        A_obs = A_obs.detach()
+
+        V_init = self.control_points(S_obs, A_obs, batch)
 
         ##################################################
         #             Trajectory Refinement              #
         ##################################################
 
         # Guided point sampling
+        V_obs_rel = S_obs[:, 1]
         Gamma = V_obs_rel.mean(dim=1).norm(p=2, dim=-1).squeeze(dim=0) / self.gamma
         Gamma /= self.pred_seq_len  # code optimization for linear interpolation (pre-division)
 
@@ -112,27 +250,16 @@ class graph_tern(nn.Module):
             V_dest_rel = V_trgt_rel.mean(dim=1)
 
             # Endpoint sampling & classify positive / negative set
-            # NMV(C*K) (C: [mu_x, mu_y, std_x, std_y, pi])
-            V_init_list = V_init.chunk(chunks=self.n_ways, dim=-1)  # (NMVC)*K
-            dest_s_list = []
-            for i in range(self.n_ways):
-                # NMVC -> NVMC
-                temp = V_init_list[i].transpose(1, 2).contiguous()
-                mix = Categorical(torch.nn.functional.softmax(temp[:, :, :, 4], dim=-1))
-                comp = Independent(Normal(temp[:, :, :, 0:2], temp[:, :, :, 2:4].exp()), 1)
-                gmm = MixtureSameFamily(mix, comp)
-                dest_s_list.append(gmm.sample((self.n_smpl,)).squeeze(dim=1))  # NVC
-            dest_s_list = torch.stack(dest_s_list, dim=3)
-            dest_s = dest_s_list.mean(dim=3)
+            dest_s = sample_endpoints(V_init, self.n_ways, (self.n_smpl,))
             valid_mask_s = (dest_s - V_dest_rel).norm(p=2, dim=-1).le(Gamma).type(torch.float)
 
             # Guided endpoint sampling
-            eps_r = torch.rand(self.n_smpl, V_dest_rel.size(1), device='cuda') * Gamma  # NV
-            eps_t = torch.rand(self.n_smpl, V_dest_rel.size(1), device='cuda')  # NV
+            eps_r = torch.rand(self.n_smpl, V_dest_rel.size(1), device=S_obs.device) * Gamma  # NV
+            eps_t = torch.rand(self.n_smpl, V_dest_rel.size(1), device=S_obs.device)  # NV
             eps_x = eps_r * eps_t.cos()
             eps_y = eps_r * eps_t.sin()
             dest_g = V_dest_rel + torch.stack([eps_x, eps_y], dim=-1)
-            valid_mask_g = torch.ones(self.n_smpl, V_dest_rel.size(1), device='cuda')
+            valid_mask_g = torch.ones(self.n_smpl, V_dest_rel.size(1), device=S_obs.device)
 
             # Concatenate all samples
             endpoint_set = torch.cat([dest_s, dest_g], dim=0)
@@ -140,106 +267,24 @@ class graph_tern(nn.Module):
         elif pruning is None:
             # Validation phase
             # Endpoint sampling
-            # NMV(C*K) (C: [mu_x, mu_y, std_x, std_y, pi])
-            V_init_list = V_init.chunk(chunks=self.n_ways, dim=-1)  # (NMVC)*K
-            dest_s_list = []
-            for i in range(self.n_ways):
-                # NMVC -> NVMC
-                temp = V_init_list[i].transpose(1, 2).contiguous()
-                mix = Categorical(torch.nn.functional.softmax(temp[:, :, :, 4], dim=-1))
-                comp = Independent(Normal(temp[:, :, :, 0:2], temp[:, :, :, 2:4].exp()), 1)
-                gmm = MixtureSameFamily(mix, comp)
-                dest_s_list.append(gmm.sample((self.n_smpl,)).squeeze(dim=1))  # NVC
-
-            dest_s_list = torch.stack(dest_s_list, dim=3)
-            endpoint_set = dest_s_list.mean(dim=3)
-            valid_mask = torch.ones(self.n_smpl, Gamma.size(0), device='cuda')
+            endpoint_set = sample_endpoints(V_init, self.n_ways, (n_repeat * self.n_smpl,))
+            valid_mask = torch.ones(n_repeat * self.n_smpl, Gamma.size(0), device=S_obs.device)
         elif clustering:
             # Test phase
-            # Clustering approach
-            V_init_list = V_init.chunk(chunks=self.n_ways, dim=-1)
-            dest_s_list = []
-            for i in range(self.n_ways):
-                temp = V_init_list[i].transpose(1, 2).contiguous()
-                mix_temp = temp[:, :, :, 4]
-                sort_index = torch.argsort(mix_temp.squeeze(dim=0), dim=-1)
-                mix_temp[:, torch.arange(V_init.size(2)).unsqueeze(dim=1), sort_index[:, :pruning]] = -1e8
-                mix = Categorical(torch.nn.functional.softmax(mix_temp, dim=-1))
-                comp = Independent(Normal(temp[:, :, :, 0:2], temp[:, :, :, 2:4].exp()), 1)
-                gmm = MixtureSameFamily(mix, comp)
-                dest_s_list.append(gmm.sample((1000,)).squeeze(dim=1))
-
-            dest_s_list = torch.stack(dest_s_list, dim=3)
-            endpoint_set_prune = dest_s_list.mean(dim=3)
-            batch_k_means = BatchKMeans(n_clusters=self.n_smpl, n_redo=1)
-            batch_k_means.fit(endpoint_set_prune.permute(1, 2, 0).contiguous())
-            if batch_k_means.centroids is not None:
-                endpoint_set = batch_k_means.centroids.permute(2, 0, 1)
-            else:
-                endpoint_set = endpoint_set_prune[:20]
-            valid_mask = torch.ones(self.n_smpl, Gamma.size(0), device='cuda')
+            # Clustering approach, reduce the pruned GMMs to n_smpl endpoints
+            reducer = endpoint_reducers['kmeans' if clustering is True else clustering]
+            endpoint_set = reducer(V_init, self.n_ways, self.n_smpl, pruning, n_repeat)
+            valid_mask = torch.ones(n_repeat * self.n_smpl, Gamma.size(0), device=S_obs.device)
         else:
             # Test phase
             # Endpoint sampling with GMM pruning
-            # NMV(C*K) (C: [mu_x, mu_y, std_x, std_y, pi])
-            endpoint_set_prune = []
-            for _ in range(self.n_smpl):
-                V_init_list = V_init.chunk(chunks=self.n_ways, dim=-1)  # (NMVC)*K
-                dest_s_list = []
-                for i in range(self.n_ways):
-                    # NMVC -> NVMC
-                    temp = V_init_list[i].transpose(1, 2).contiguous()
-                    mix_temp = temp[:, :, :, 4]
-                    sort_index = torch.argsort(mix_temp.squeeze(dim=0), dim=-1).detach().cpu().numpy()
-                    mix_temp[:, torch.arange(V_init.size(2)).unsqueeze(dim=1), sort_index[:, :pruning]] = -1e8
-                    mix = Categorical(torch.nn.functional.softmax(mix_temp, dim=-1))
-                    comp = Independent(Normal(temp[:, :, :, 0:2], temp[:, :, :, 2:4].exp()), 1)
-                    gmm = MixtureSameFamily(mix, comp)
-                    dest_s_list.append(gmm.sample((self.n_smpl,)).squeeze(dim=1))  # NVC
-
-                dest_s_list = torch.stack(dest_s_list, dim=3)
-                endpoint_set_prune.append(dest_s_list.mean(dim=3))
-
-            endpoint_set_prune = torch.stack(endpoint_set_prune, dim=0)
-            argmax_index = (endpoint_set_prune.unsqueeze(dim=2) - endpoint_set_prune.unsqueeze(dim=1))
-            argmax_index = argmax_index.norm(p=2, dim=-1).kthvalue(k=2, dim=2)[0].sum(dim=1).argmax(dim=0)
-            endpoint_set = endpoint_set_prune[argmax_index, :, torch.arange(V_init.size(2))].transpose(0, 1)
-            valid_mask = torch.ones(self.n_smpl, Gamma.size(0), device='cuda')
-
-        # Initial trajectory prediction
-        # Linear interpolation NVC -> NTVC
-        V_pred = endpoint_set.unsqueeze(dim=1).repeat_interleave(repeats=self.pred_seq_len, dim=1)
-        V_pred_abs = (V_pred.cumsum(dim=1) + V_obs_abs.squeeze(dim=0)[-1, :, :]).detach().clone()
-
-        # repeat to sampled times (batch size)
-        V_obs_rept = V_obs_rel.repeat_interleave(V_pred.size(0), dim=0)
-        A_obs = A_obs.repeat_interleave(V_pred.size(0), dim=0)
-
-        # Graph Trajectory Refinement
-        # make adjacency matrix for predicted 12 frames (will be iteratively change)
-        A_pred = generate_adjacency_matrix(torch.stack([V_pred_abs, V_pred], dim=1))
-
-        # concatenate to make full 20 frame sequences
-        V = torch.cat([V_obs_rept, V_pred], dim=1).detach()
-        A = torch.cat([A_obs, A_pred], dim=2).detach()
-
-        # NTVC -> NCTV
-        V_corr = V.permute(0, 3, 1, 2).contiguous()
-
-        for k in range(self.n_trgcn):
-            V_corr, A = self.st_mrgcns[k](V_corr, A)
-
-        # NCTV -> NTCV
-        V_corr = V_corr.permute(0, 2, 1, 3).contiguous()
-
-        for k in range(self.n_trcnn):
-            V_corr = self.trcnns[k](V_corr)
-
-        # NTCV -> NTVC
-        V_corr = V_corr.transpose(2, 3).contiguous()
-
-        # Refine initial trajectory
-        V_refi = V_pred_abs
-        V_refi[:, :-1] += V_corr[:, :-1]
-
+            # n_smpl candidate sets of n_smpl samples each [n_repeat, n_smpl, n_smpl, V, C]
+            endpoint_set_prune = sample_endpoints(V_init, self.n_ways, (n_repeat, self.n_smpl, self.n_smpl), pruning)
+            argmax_index = (endpoint_set_prune.unsqueeze(dim=-3) - endpoint_set_prune.unsqueeze(dim=-4))
+            argmax_index = argmax_index.norm(p=2, dim=-1).kthvalue(k=2, dim=-2)[0].sum(dim=-2).argmax(dim=-2)
+            argmax_index = argmax_index[:, None, None, :, None].expand(-1, 1, *endpoint_set_prune.shape[2:])
+            endpoint_set = endpoint_set_prune.gather(1, argmax_index).flatten(0, 2)
+            valid_mask = torch.ones(n_repeat * self.n_smpl, Gamma.size(0), device=S_obs.device)
+
+        V_pred, V_refi = self.refine(S_obs, A_obs, endpoint_set, batch)
         return V_init, V_pred, V_refi, valid_mask
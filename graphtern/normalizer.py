@@ -1,34 +1,42 @@
 # Adjacency matrix normalization implementation in PyTorch.
 # The original code is based on Networkx library.
+# Diagonal degree matrices are applied by broadcasting row / column scaling instead of matmuls.
 
 import torch
 
 
-def normalized_adjacency_matrix(A):
+def normalized_adjacency_matrix(A, inplace=False):
     r"""Returns the normalized Adjacency matrix. D^-1/2 @ A @ D^-1/2"""
 
-    node_degrees = A.sum(-1).unsqueeze(dim=-1)
-    degs_inv_sqrt = torch.pow(node_degrees, -0.5)
-    degs_inv_sqrt[torch.isinf(degs_inv_sqrt)] = 0
-    norm_degs_matrix = torch.eye(A.size(-1)).cuda() * degs_inv_sqrt
-    return norm_degs_matrix @ A @ norm_degs_matrix
+    degs_inv_sqrt = A.sum(-1).pow_(-0.5)
+    degs_inv_sqrt.masked_fill_(torch.isinf(degs_inv_sqrt), 0)
+    A_norm = A.mul_(degs_inv_sqrt.unsqueeze(dim=-1)) if inplace else A * degs_inv_sqrt.unsqueeze(dim=-1)
+    return A_norm.mul_(degs_inv_sqrt.unsqueeze(dim=-2))
 
 
-def normalized_adjacency_tilde_matrix(A):
+def normalized_adjacency_tilde_matrix(A, inplace=False):
     r"""Returns the normalized Adjacency tilde (A~) matrix."""
 
-    A_t = A + torch.eye(A.size(-1)).cuda()
-    return normalized_adjacency_matrix(A_t)
+    if inplace:
+        A_t = A
+        A_t.diagonal(dim1=-2, dim2=-1).add_(1)
+    else:
+        # Out-of-place identity add, the in-place diagonal view write is lost by the ONNX exporter
+        A_t = A + torch.eye(A.size(-1), device=A.device, dtype=A.dtype)
+    return normalized_adjacency_matrix(A_t, inplace=True)
 
 
 def normalized_laplacian_matrix(A):
     r"""Returns the normalized Laplacian matrix."""
 
-    return torch.eye(A.size(-1)).cuda() - normalized_adjacency_matrix(A)
+    L = normalized_adjacency_matrix(A).neg_()
+    L.diagonal(dim1=-2, dim2=-1).add_(1)
+    return L
 
 
 def normalized_laplacian_tilde_matrix(A):
     r"""Returns the normalized Laplacian tilde (L~) matrix."""
 
-    A_t = A + torch.eye(A.size(-1)).cuda()
-    return torch.eye(A_t.size(-1)).cuda() - normalized_adjacency_matrix(A_t)
+    L = normalized_adjacency_tilde_matrix(A).neg_()
+    L.diagonal(dim1=-2, dim2=-1).add_(1)
+    return L
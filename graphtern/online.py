@@ -0,0 +1,164 @@
+import time
+from collections import deque
+import numpy as np
+import torch
+from .model import generate_adjacency_matrix
+
+
+class OnlinePredictor:
+    r"""Streaming Graph-TERN inference over frame-by-frame detections.
+
+    Every tracked pedestrian owns a slot of a ring buffer holding its last obs_len absolute and
+    relative positions, next to the per-frame dense adjacency [T, 4, C, C] of all slots. A tick
+    only computes the distances of the new frame, plus the rows of the pedestrians entering the
+    scene, whose history is padded with their first position. Pedestrians missing for more than
+    max_missing ticks leave the scene, their last position is held meanwhile.
+    Preallocating max_peds slots avoids growing the buffers while streaming.
+    The tick latency is dominated by the endpoint reducer, so the deterministic 'quantile'
+    reducer is used by default, 'kmeans' iterates until convergence on every tick.
+    """
+
+    def __init__(self, model, max_peds=64, max_missing=0, min_history=1, pruning=4, clustering='quantile',
+                 latency_window=1000):
+        self.model = model.eval()
+        self.device = next(model.parameters()).device
+        self.obs_len = model.obs_seq_len
+        self.max_missing = max_missing
+        self.min_history = min_history
+        self.pruning = pruning
+        self.clustering = clustering
+        self.dense = model.sparse_radius is None and model.sparse_knn is None
+        self.latencies = deque(maxlen=latency_window)
+
+        # Chronological frame order of the ring buffer for each head position
+        T = self.obs_len
+        self.orders = (torch.arange(T).unsqueeze(dim=0) + torch.arange(T).unsqueeze(dim=1)).remainder(T).to(self.device)
+        self.allocate(max_peds)
+        self.reset()
+
+    def allocate(self, capacity):
+        r"""Allocates buffers for capacity pedestrian slots, keeping the content of the current ones."""
+
+        T = self.obs_len
+        pos = torch.zeros(T, capacity, 2, device=self.device)
+        rel = torch.zeros(T, capacity, 2, device=self.device)
+        A = torch.zeros(T, 4, capacity, capacity, device=self.device)
+        missing = np.zeros(capacity, dtype=np.int64)
+        history = np.zeros(capacity, dtype=np.int64)
+        if hasattr(self, 'pos'):
+            C = self.capacity
+            pos[:, :C], rel[:, :C], A[:, :, :C, :C] = self.pos, self.rel, self.A
+            missing[:C], history[:C] = self.missing, self.history
+            self.free += list(range(capacity - 1, C - 1, -1))
+        self.pos, self.rel, self.A = pos, rel, A
+        self.missing, self.history = missing, history
+        self.capacity = capacity
+
+    def reset(self):
+        r"""Forgets every tracked pedestrian."""
+
+        self.slots = {}
+        self.free = list(range(self.capacity - 1, -1, -1))
+        self.head = 0
+        self.latencies.clear()
+
+    def push(self, ped_ids, positions):
+        r"""Adds the detections positions[V, 2] of the pedestrians ped_ids as a new frame."""
+
+        positions = torch.as_tensor(positions, dtype=torch.float, device=self.device).view(-1, 2)
+        assert len(ped_ids) == positions.size(0), "one position per pedestrian id"
+
+        # Leaving pedestrians free their slot
+        seen = set(ped_ids)
+        for ped_id in [ped_id for ped_id in self.slots if ped_id not in seen]:
+            slot = self.slots[ped_id]
+            self.missing[slot] += 1
+            if self.missing[slot] > self.max_missing:
+                del self.slots[ped_id]
+                self.free.append(slot)
+
+        # Entering pedestrians take a free slot
+        new_slots, new_rows = [], []
+        for i, ped_id in enumerate(ped_ids):
+            if ped_id not in self.slots:
+                if not self.free:
+                    self.allocate(self.capacity * 2)
+                self.slots[ped_id] = self.free.pop()
+                self.history[self.slots[ped_id]] = 0
+                new_slots.append(self.slots[ped_id])
+                new_rows.append(i)
+            self.missing[self.slots[ped_id]] = 0
+        for slot in self.slots.values():
+            self.history[slot] += 1
+
+        index = torch.tensor([self.slots[ped_id] for ped_id in ped_ids], dtype=torch.long, device=self.device)
+        if new_slots:
+            # Pad the history of entering pedestrians with their first position
+            new_slots = torch.tensor(new_slots, dtype=torch.long, device=self.device)
+            self.pos[:, new_slots] = positions[new_rows]
+            self.rel[:, new_slots] = 0
+
+        # Overwrite the oldest frame, held pedestrians keep their last position
+        last = self.pos[self.head - 1]
+        frame = last.clone()
+        frame[index] = positions
+        torch.sub(frame, last, out=self.rel[self.head])
+        self.pos[self.head] = frame
+
+        if self.dense:
+            # Adjacency of the new frame, then of the entering pedestrians over the whole history
+            V = torch.stack([self.pos[self.head], self.rel[self.head]]).view(1, 2, 1, self.capacity, 2)
+            generate_adjacency_matrix(V, out=self.A[self.head].view(1, 4, 1, self.capacity, self.capacity))
+            if len(new_slots):
+                V = torch.stack([self.pos, self.rel], dim=1)  # [T, 2, C, 2]
+                A = torch.cdist(V[:, :, new_slots], V, compute_mode='donot_use_mm_for_euclid_dist')
+                A = torch.cat([A, A.reciprocal().nan_to_num_(nan=float('nan'), posinf=0.)], dim=1)
+                self.A[:, :, new_slots] = A
+                self.A[:, :, :, new_slots] = A.transpose(-1, -2)
+
+        self.head = (self.head + 1) % self.obs_len
+
+    def predict(self):
+        r"""Returns the ids of the pedestrians observed for at least min_history frames and
+        their n_smpl forecast trajectories V_refi[n_smpl, pred_len, V, 2] in absolute coordinates."""
+
+        ped_ids = [ped_id for ped_id, slot in self.slots.items() if self.history[slot] >= self.min_history]
+        if not ped_ids:
+            return ped_ids, torch.zeros(self.model.n_smpl, self.model.pred_seq_len, 0, 2, device=self.device)
+
+        index = torch.tensor([self.slots[ped_id] for ped_id in ped_ids], dtype=torch.long, device=self.device)
+        order = self.orders[self.head]
+
+        # S_obs[1, 2, T, V, 2] and A_obs[1, 4, T, V, V] of the tracked pedestrians in chronological order
+        S_obs = torch.stack([self.pos, self.rel]).index_select(1, order).index_select(2, index).unsqueeze(dim=0)
+        # The window starts at rest as in the dataset, the oldest displacement is dropped with its adjacency
+        S_obs[:, 1, 0] = 0
+        A_obs = None
+        if self.dense:
+            A_obs = self.A.index_select(0, order).index_select(2, index).index_select(3, index)
+            A_obs = A_obs.transpose(0, 1).unsqueeze(dim=0)
+            generate_adjacency_matrix(S_obs[:, :, :1], out=A_obs[:, :, :1])
+
+        with torch.no_grad():
+            V_refi = self.model(S_obs, pruning=self.pruning, clustering=self.clustering, A_obs=A_obs)[2]
+        return ped_ids, V_refi
+
+    def step(self, ped_ids, positions):
+        r"""Pushes a new frame of detections and returns the forecasts of predict(), recording the tick latency."""
+
+        start = time.perf_counter()
+        self.push(ped_ids, positions)
+        out = self.predict()
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        self.latencies.append(time.perf_counter() - start)
+        return out
+
+    def latency(self):
+        r"""Returns the p50, p99 and max latency (ms) of the recent ticks."""
+
+        latencies = np.array(self.latencies) * 1000
+        if len(latencies) == 0:
+            return {'p50': float('nan'), 'p99': float('nan'), 'max': float('nan')}
+        return {'p50': float(np.percentile(latencies, 50)), 'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max())}
@@ -0,0 +1,68 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert
+
+
+# Reduced precision modes of graph_tern.precision, int8 is applied by quantize_int8() instead
+precision_modes = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+class QuantConv2d(nn.Module):
+    r"""Conv2d quantized to int8 weights and activations by quantize_int8().
+
+    Quantized convolutions only support zero padding, so replicate padding is applied in
+    float32 beforehand and the quantized convolution runs unpadded.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.padding = None
+        if conv.padding_mode != 'zeros':
+            self.padding = conv._reversed_padding_repeated_twice
+            self.padding_mode = conv.padding_mode
+            conv.padding, conv.padding_mode = (0, 0), 'zeros'
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        if self.padding is not None:
+            x = F.pad(x, self.padding, mode=self.padding_mode)
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def wrap_convs(module):
+    r"""Replaces every Conv2d below module with a QuantConv2d in place."""
+
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv2d):
+            setattr(module, name, QuantConv2d(child))
+        else:
+            wrap_convs(child)
+
+
+def quantize_int8(model, calibration, backend='x86', **kwargs):
+    r"""Statically quantizes the convolutions of graph_tern to int8 in place, for CPU inference.
+
+    Activation ranges are calibrated by running the model on calibration, an iterable of
+    (S_obs, seq_start_end) mini-batches, with the test-time kwargs of graph_tern.forward.
+    The residual lambdas of the blocks refer to their module, so model is modified in place."""
+
+    torch.backends.quantized.engine = backend
+    model.eval()
+    for blocks in [model.tp_mrgcns, model.tpcnns, model.st_mrgcns, model.trcnns]:
+        wrap_convs(blocks)
+
+    # Observers are only attached to the quantized convolutions
+    qconfig = get_default_qconfig(backend)
+    for module in model.modules():
+        if isinstance(module, QuantConv2d):
+            module.qconfig = qconfig
+    prepare(model, inplace=True)
+
+    with torch.no_grad():
+        for S_obs, seq_start_end in calibration:
+            model(S_obs, seq_start_end=seq_start_end, **kwargs)
+
+    return convert(model, inplace=True)
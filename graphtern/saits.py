@@ -1,34 +1,58 @@
 # Install PyPOTS first: pip install pypots==0.1.1
-import numpy as np
-from sklearn.preprocessing import StandardScaler
-from pypots.data import load_specific_dataset, mcar, masked_fill
-from pypots.utils.metrics import cal_mae
 import torch
+from pypots.imputation import SAITS
 
 
+def mcar_mask(X, rate, generator=None):
+    r"""Returns a boolean mask marking each element of X as missing completely at random with probability rate."""
 
-def saits_model(X, saits, n_steps=8, n_features=2, n_layers=2, d_model=256, d_inner=128, n_heads=4, d_k=64, d_v=64, dropout=0.1, epochs=10):
-    # Reshape the tensor to 2D (40 x 2)
-    # tensor_2d = X.reshape(-1, 2).cpu().numpy()
+    return torch.rand(X.shape, generator=generator, device=X.device) < rate
 
-    # # Create a StandardScaler object and fit it to the data
-    # scaler = StandardScaler()
-    # scaled_tensor_2d = scaler.fit_transform(tensor_2d)
 
-    # # Reshape the scaled NumPy array back to the original shape (5 x 8 x 2)
-    # X = torch.tensor(scaled_tensor_2d, dtype=torch.float32).view(*X.shape)
+class SaitsImputer:
+    r"""Imputation stage of the observed trajectories, a SAITS model trained once and shared by every scene.
 
-    X_intact, X, missing_mask, indicating_mask = mcar(
-        X, 0.03)  # hold out 10% observed values as ground truth
-    X = masked_fill(X, 1 - missing_mask, np.nan)
+    Trajectories X[N, obs_len, 2] are centered per pedestrian on their observed mean, so that
+    scenes at any location share one model. Imputation runs as one batched pass on the device of
+    the model, without refitting or a round-trip through numpy.
+    """
 
-    dataset = {"X": X}
-    # train the model. Here I use the whole dataset as the training set, because ground truth is not visible to the model.
-    saits.fit(dataset)
-    imputation = saits.impute(dataset)
-    imputation = torch.from_numpy(imputation)
-    imputation = imputation.cuda()
-    X_intact = X_intact.cuda()
-    indicating_mask = indicating_mask.cuda()
-    mae = cal_mae(imputation, X_intact, indicating_mask)
-    return imputation, mae
+    def __init__(self, n_steps=8, n_features=2, n_layers=2, d_model=256, d_inner=128, n_heads=4, d_k=64, d_v=64,
+                 dropout=0.1, epochs=10, batch_size=256, device='cpu'):
+        self.saits = SAITS(n_steps=n_steps, n_features=n_features, n_layers=n_layers, d_model=d_model,
+                           d_inner=d_inner, n_heads=n_heads, d_k=d_k, d_v=d_v, dropout=dropout, epochs=epochs,
+                           batch_size=batch_size, device=device)
+        self.module = self.saits.model
+
+    @staticmethod
+    def center(X, missing):
+        r"""Returns X with missing elements as nan, centered on the observed mean of each pedestrian, and the offset."""
+
+        X = X.masked_fill(missing, float('nan'))
+        offset = X.nanmean(dim=1, keepdim=True).nan_to_num(0.)
+        return X - offset, offset
+
+    def fit(self, X, rate=0.2, generator=None):
+        r"""Trains SAITS on the trajectories X[N, obs_len, 2] with a fraction rate of elements missing."""
+
+        X, _ = self.center(X, mcar_mask(X, rate, generator))
+        self.saits.fit({'X': X.cpu().numpy()})
+        self.module.eval()
+        return self
+
+    def impute(self, X, missing):
+        r"""Returns the trajectories X[N, obs_len, 2] with the elements of the boolean mask missing imputed."""
+
+        X_centered, offset = self.center(X, missing)
+        inputs = {'X': X_centered.nan_to_num(0.), 'missing_mask': (~missing).float()}
+        with torch.no_grad():
+            imputed = self.module(inputs, training=False)['imputed_data']
+        return torch.where(missing, imputed + offset, X)
+
+    def save(self, path):
+        torch.save(self.module.state_dict(), path)
+
+    def load(self, path):
+        self.module.load_state_dict(torch.load(path, map_location=next(self.module.parameters()).device))
+        self.module.eval()
+        return self
@@ -0,0 +1,54 @@
+import torch
+from .dropedge import drop_edge
+
+
+class SparseAdjacency:
+    r"""Multi-relational adjacency stored as an edge list, A[n, r, t, w, v] = values[r, e].
+
+    index[4, E] holds the (n, t, w, v) coordinates of every edge and values[R, E] its weight
+    for each relation. The diagonal is implicit, so memory scales with the number of edges.
+    """
+
+    def __init__(self, index, values, shape):
+        self.index = index
+        self.values = values
+        self.shape = torch.Size(shape)
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def detach(self):
+        return SparseAdjacency(self.index, self.values.detach(), self.shape)
+
+    def clamp(self, max):
+        return SparseAdjacency(self.index, self.values.clamp(max=max), self.shape)
+
+    def to(self, dtype):
+        return SparseAdjacency(self.index, self.values.to(dtype), self.shape)
+
+    def drop_edge(self, percent, training=True):
+        r"""Returns the adjacency with randomly dropped edges, as drop_edge()."""
+
+        return SparseAdjacency(self.index, drop_edge(self.values, percent, training), self.shape)
+
+    def propagate(self, x):
+        r"""Returns the messages x[N, R, C, T, V] aggregated with the normalized adjacency tilde (A~) matrix."""
+
+        N, R, C, T, V = x.shape
+        n, t, w, v = self.index
+        key_w = (n * T + t) * V + w
+        key_v = (n * T + t) * V + v
+
+        # D^-1/2 (A + I) D^-1/2 without materializing the V x V matrix
+        degree = torch.ones(R, N * T * V, device=x.device, dtype=x.dtype).index_add_(1, key_w, self.values)
+        degree_inv_sqrt = degree.pow(-0.5)
+        norm = self.values * degree_inv_sqrt[:, key_w] * degree_inv_sqrt[:, key_v]  # [R, E]
+
+        # x[N, R, C, T, V] -> x[NTV, R, C]
+        x = x.permute(0, 3, 4, 1, 2).reshape(N * T * V, R, C)
+        out = (x * degree_inv_sqrt.pow(2).t().unsqueeze(dim=-1)).sum(dim=1)
+        message = (x[key_v] * norm.t().unsqueeze(dim=-1)).sum(dim=1)  # [E, C]
+        out = out.index_add(0, key_w, message)
+
+        # x[NTV, C] -> x[N, C, T, V]
+        return out.view(N, T, V, C).permute(0, 3, 1, 2)
@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 from .dropedge import drop_edge
 from .normalizer import normalized_adjacency_tilde_matrix
+from .batching import scene_apply
+from .sparse import SparseAdjacency
+from .adjacency import SharedAdjacency
 
 
 class MultiRelationalGCN(nn.Module):
@@ -12,14 +15,39 @@ class MultiRelationalGCN(nn.Module):
         self.out_channels = out_channels
         self.conv = nn.Conv2d(in_channels, out_channels * relation, kernel_size=(t_kernel_size, 1), padding=(t_padding, 0), stride=(t_stride, 1), dilation=(t_dilation, 1), bias=bias)
 
-    def forward(self, x, A):
+    def propagate(self, x, A, batch=None):
+        r"""Aggregates x[N, R, C, T, V] over the edge-dropped and normalized adjacency A."""
+
+        if isinstance(A, SparseAdjacency):
+            # Sparse message passing, scenes of a batch never share an edge
+            return A.drop_edge(0.8, self.training).propagate(x)
+
+        # drop_edge returns a fresh buffer in training, which is then normalized in place
+        A_norm = normalized_adjacency_tilde_matrix(drop_edge(A, 0.8, self.training), inplace=self.training)
+        if batch is None:
+            return torch.einsum('nrtwv,nrctv->nctw', A_norm, x)
+
+        # Block-diagonal message passing over the padded scene layout
+        x = torch.einsum('nrtbwv,nrctbv->nctbw', A_norm, batch.to_padded(x))
+        return batch.from_padded(x)
+
+    def forward(self, x, A, batch=None):
         assert A.size(0) == x.size(0)
         assert A.size(1) == self.relation
         assert A.size(2) == self.kernel_size
 
         x = self.conv(x)
         x = x.view(x.size(0), self.relation, self.out_channels, x.size(-2), x.size(-1))
-        x = torch.einsum('nrtwv,nrctv->nctw', normalized_adjacency_tilde_matrix(drop_edge(A, 0.8, self.training)), x)
+        if isinstance(A, SharedAdjacency):
+            # The observed graph is normalized once, samples are folded into channels to share it
+            N, R, C, T, V = x.shape
+            T_obs = A.obs.size(2)
+            x_obs = x[:, :, :, :T_obs].transpose(0, 1).reshape(1, R, N * C, T_obs, V)
+            x_obs = self.propagate(x_obs, A.obs, batch).view(N, C, T_obs, V)
+            x_pred = self.propagate(x[:, :, :, T_obs:], A.pred, batch)
+            x = torch.cat([x_obs, x_pred], dim=2)
+        else:
+            x = self.propagate(x, A, batch)
         return x.contiguous(), A
 
 
@@ -46,9 +74,9 @@ class st_mrgcn(nn.Module):
         else:
             self.residual = nn.Sequential(nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=(stride, 1)),)
 
-    def forward(self, x, A):
+    def forward(self, x, A, batch=None):
         res = self.residual(x)
-        x, A = self.gcn(x, A)
+        x, A = self.gcn(x, A, batch)
         x = self.tcn(x) + res
 
         if not self.use_mdn:
@@ -96,18 +124,18 @@ class epcnn(nn.Module):
             self.restconv = nn.Sequential(nn.Conv2d(obs_seq_len, pred_seq_len, kernel_size=1),)
             self.residual = lambda x: self.rescconv(self.restconv(x).permute(0, 2, 1, 3).contiguous()).permute(0, 2, 1, 3).contiguous()
 
-    def forward(self, x):
+    def forward(self, x, batch=None):
         # residual
         res = self.residual(x)
 
         # time-wise
         for i in range(len(self.tpcns)):
-            x = self.tpcns[i](x)
+            x = scene_apply(self.tpcns[i], x, batch)
 
         # channel-wise
         x = x.permute(0, 2, 1, 3).contiguous()
         for i in range(len(self.cpcns)):
-            x = self.cpcns[i](x)
+            x = scene_apply(self.cpcns[i], x, batch)
         x = x.permute(0, 2, 1, 3).contiguous()
 
         return x + res
@@ -146,18 +174,18 @@ class trcnn(nn.Module):
             self.resconv = nn.Sequential(nn.Conv2d(in_channels, out_channels, kernel_size=(k_size, 1)),)
             self.residual = lambda x: self.resconv(x.permute(0, 2, 1, 3).contiguous()).permute(0, 2, 1, 3).contiguous()
 
-    def forward(self, x):
+    def forward(self, x, batch=None):
         # residual
         res = self.residual(x)
 
         # time-wise
         for i in range(len(self.tpcns)):
-            x = self.tpcns[i](x)
+            x = scene_apply(self.tpcns[i], x, batch)
 
         # channel-wise
         x = x.permute(0, 2, 1, 3).contiguous()
         for i in range(len(self.cpcns)):
-            x = self.cpcns[i](x)
+            x = scene_apply(self.cpcns[i], x, batch)
         x = x.permute(0, 2, 1, 3).contiguous()
 
         return x + res
@@ -0,0 +1,61 @@
+import os
+import argparse
+import torch
+from graphtern.saits import SaitsImputer, mcar_mask
+from utils import TrajectoryDataset, save_imputed
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dataset', default='zara1', help='Dataset name(eth,hotel,univ,zara1,zara2)')
+parser.add_argument('--splits', nargs='+', default=['train'], help='Dataset splits to precompute')
+parser.add_argument('--obs_seq_len', type=int, default=8)
+parser.add_argument('--pred_seq_len', type=int, default=12)
+parser.add_argument('--realizations', type=int, default=8, help='Number of missing-data realizations per split')
+parser.add_argument('--missing_rate', type=float, default=0.2, help='Fraction of observed coordinates dropped')
+parser.add_argument('--seed', type=int, default=0, help='Random seed of the missing-data masks')
+parser.add_argument('--saits_path', default=None,
+                    help='Pretrained SAITS imputer, trained once on the train split to <output_dir>/saits.pth if missing')
+parser.add_argument('--saits_epochs', type=int, default=10, help='Number of epochs to train the SAITS imputer')
+parser.add_argument('--output_dir', default=None, help='Output directory, ./datasets/<dataset>/.cache/ by default')
+parser.add_argument('--batch_size', type=int, default=4096, help='Number of pedestrians per imputation pass')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help='Device to run on (cuda, cuda:1, cpu)')
+
+
+def load_split(args, split):
+    return TrajectoryDataset('./datasets/' + args.dataset + '/' + split + '/', obs_len=args.obs_seq_len,
+                             pred_len=args.pred_seq_len, skip=1)
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    output_dir = args.output_dir or './datasets/' + args.dataset + '/.cache/'
+
+    saits_path = args.saits_path or os.path.join(output_dir, 'saits.pth')
+    imputer = SaitsImputer(n_steps=args.obs_seq_len, epochs=args.saits_epochs, device=device)
+    if not os.path.exists(saits_path):
+        X = load_split(args, 'train').obs_traj.permute(0, 2, 1).to(device)
+        imputer.fit(X, rate=args.missing_rate, generator=torch.Generator(device).manual_seed(args.seed))
+        os.makedirs(os.path.dirname(saits_path) or '.', exist_ok=True)
+        imputer.save(saits_path)
+    imputer.load(saits_path)
+
+    for split in args.splits:
+        X = load_split(args, split).obs_traj.permute(0, 2, 1).to(device)
+        generator = torch.Generator(device).manual_seed(args.seed)
+        missing = torch.stack([mcar_mask(X, args.missing_rate, generator) for _ in range(args.realizations)])
+        imputed = torch.empty(missing.shape, device=device)
+        for start in range(0, X.size(0), args.batch_size):
+            end = start + args.batch_size
+            for r in range(args.realizations):
+                imputed[r, start:end] = imputer.impute(X[start:end], missing[r, start:end])
+
+        prefix = os.path.join(output_dir, split + '_imputed')
+        save_imputed(prefix, missing, torch.round(imputed, decimals=4), missing_rate=args.missing_rate,
+                     seed=args.seed)
+        print('Wrote {0} realizations of {1} pedestrians to {2}'.format(args.realizations, X.size(0), prefix))
+
+
+if __name__ == "__main__":
+    main()
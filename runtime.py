@@ -0,0 +1,56 @@
+import json
+import numpy as np
+
+
+class ExportedPredictor:
+    r"""Runs a Graph-TERN exported by export.py (.onnx or TorchScript .pt) without the training code.
+
+    Only numpy and onnxruntime, or torch for TorchScript, are imported.
+    """
+
+    def __init__(self, path, num_threads=None, seed=None):
+        if path.endswith('.onnx'):
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.meta = {key: int(value) for key, value in self.session.get_modelmeta().custom_metadata_map.items()}
+            self.module = None
+        else:
+            import torch
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            extra_files = {'meta.json': ''}
+            self.module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+            self.meta = json.loads(extra_files['meta.json'])
+            self.session = None
+        self.rng = np.random.default_rng(seed)
+
+    def sample_noise(self, num_peds, n_samples=None):
+        r"""Returns random sampling noise[n_samples, n_ways, num_peds, 3], a uniform number and two standard
+        normals per way, drawn independently for every pedestrian."""
+
+        shape = (n_samples or self.meta['n_samples'], self.meta['n_ways'], num_peds)
+        return np.concatenate([self.rng.random((*shape, 1)), self.rng.standard_normal((*shape, 2))],
+                              axis=-1).astype(np.float32)
+
+    def predict(self, obs, noise=None):
+        r"""Returns the refined trajectories [n_samples, pred_len, V, 2] of the absolute observations obs[obs_len, V, 2].
+
+        noise[n_samples, n_ways, V, 3] is drawn by sample_noise() if not given, noise[n_samples, n_ways, 1, 3] is
+        shared by every pedestrian."""
+
+        obs = np.asarray(obs, dtype=np.float32)
+        assert obs.ndim == 3 and obs.shape[0] == self.meta['obs_len'] and obs.shape[2] == 2, \
+            "obs must be [{}, V, 2]".format(self.meta['obs_len'])
+        rel = np.concatenate([np.zeros_like(obs[:1]), obs[1:] - obs[:-1]])
+        S_obs = np.stack([obs, rel])[None]
+        noise = self.sample_noise(obs.shape[1]) if noise is None else np.asarray(noise, dtype=np.float32)
+
+        if self.session is not None:
+            return self.session.run(None, {'S_obs': S_obs, 'noise': noise})[0]
+
+        import torch
+        with torch.no_grad():
+            return self.module(torch.from_numpy(S_obs), torch.from_numpy(noise)).numpy()
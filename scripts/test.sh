@@ -15,7 +15,7 @@ do
     s) suffix=${OPTARG};;
     d) dataset_array=(${OPTARG});;
     i) device_id_array=(${OPTARG});;
-    *) echo "usage: $0 [-p PREFIX] [-s SUFFIX] [-d \"eth hotel univ zara1 zara2\"] [-i \"0 1 2 3 4\"]" >&2
+    *) echo "usage: $0 [-p PREFIX] [-s SUFFIX] [-d \"eth hotel univ zara1 zara2\"] [-i \"0 1 2 3 4\" or \"cpu cpu cpu cpu cpu\"]" >&2
       exit 1 ;;
   esac
 done
@@ -27,31 +27,21 @@ then
     exit 1
 fi
 
-# Signal handler
-PID_array=()
-
-sighdl ()
-{
-  echo "Kill evaluation processes"
-  for (( i=0; i<${#dataset_array[@]}; i++ ))
-  do
-    kill ${PID_array[$i]}
-  done
-  echo "Done."
-  exit 0
-}
-
-trap sighdl SIGINT SIGTERM
-
-# Start testing tasks
+# Evaluate every dataset in parallel in one process pool
+tag_array=()
+device_array=()
 for (( i=0; i<${#dataset_array[@]}; i++ ))
 do
-  printf "Testing ${dataset_array[$i]}"
-  CUDA_VISIBLE_DEVICES=${device_id_array[$i]} python3 test.py \
-  --tag "${prefix}""${dataset_array[$i]}""${suffix}" &
-  PID_array[$i]=$!
-  printf " job ${#PID_array[@]} pid ${PID_array[$i]}\n"
-  wait ${PID_array[$i]}
+  tag_array+=("${prefix}""${dataset_array[$i]}""${suffix}")
+  if [ "${device_id_array[$i]}" == "cpu" ]
+  then
+    device_array+=("cpu")
+  else
+    device_array+=("cuda:${device_id_array[$i]}")
+  fi
 done
 
+printf "Testing ${tag_array[*]}\n"
+python3 evaluate.py --tags "${tag_array[@]}" --devices "${device_array[@]}"
+
 echo "Done."
@@ -6,16 +6,18 @@ dataset_array=("eth" "hotel" "univ" "zara1" "zara2")
 device_id_array=(0 1 2 3 4)
 prefix="graph-tern_"
 suffix="_experiment"
+nproc=1
 
 # Arguments
-while getopts p:s:d:i: flag
+while getopts p:s:d:i:n: flag
 do
   case "${flag}" in
     p) prefix=${OPTARG};;
     s) suffix=${OPTARG};;
     d) dataset_array=(${OPTARG});;
     i) device_id_array=(${OPTARG});;
-    *) echo "usage: $0 [-p PREFIX] [-s SUFFIX] [-d \"eth hotel univ zara1 zara2\"] [-i \"0 1 2 3 4\"]" >&2
+    n) nproc=${OPTARG};;
+    *) echo "usage: $0 [-p PREFIX] [-s SUFFIX] [-d \"eth hotel univ zara1 zara2\"] [-i \"0 1 2 3 4\"] [-n NPROC]" >&2
       exit 1 ;;
   esac
 done
@@ -43,11 +45,18 @@ sighdl ()
 
 trap sighdl SIGINT SIGTERM
 
+# Distributed data-parallel training with nproc processes per task
+launcher="python3"
+if [ ${nproc} -gt 1 ]
+then
+    launcher="torchrun --standalone --nproc_per_node=${nproc}"
+fi
+
 # Start training tasks
 for (( i=0; i<${#dataset_array[@]}; i++ ))
 do
   printf "Training ${dataset_array[$i]}"
-  CUDA_VISIBLE_DEVICES=${device_id_array[$i]} python3 train.py \
+  CUDA_VISIBLE_DEVICES=${device_id_array[$i]} ${launcher} train.py \
   --dataset "${dataset_array[$i]}" --tag "${prefix}""${dataset_array[$i]}""${suffix}" &
   PID_array[$i]=$!
   printf " job ${#PID_array[@]} pid ${PID_array[$i]}\n"
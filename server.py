@@ -0,0 +1,183 @@
+import json
+import time
+import queue
+import signal
+import argparse
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+from graphtern.endpoint import endpoint_reducers
+from test import load_model
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--tag', default='graph-tern_eth_experiment', help='Checkpoint tag of the served model')
+parser.add_argument('--host', default='127.0.0.1', help='Address to listen on')
+parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+parser.add_argument('--n_samples', type=int, default=20, help='Number of samples')
+parser.add_argument('--clustering', default='kmeans', choices=list(endpoint_reducers.keys()),
+                    help='Reducer of the pruned endpoint GMMs to n_samples endpoints')
+parser.add_argument('--max_wait', type=float, default=5., help='Maximum time (ms) a request waits for a batch to fill')
+parser.add_argument('--max_nodes', type=int, default=256, help='Maximum number of pedestrians per forward pass')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help='Device to run on (cuda, cuda:1, cpu)')
+
+
+class DynamicBatcher:
+    r"""Coalesces concurrent scene requests into batched graph_tern forward passes.
+
+    A batch is closed when max_wait seconds have passed since its first request, or when the
+    next request would exceed max_nodes pedestrians. Scenes of a batch are concatenated along
+    the pedestrian axis and kept apart by seq_start_end, as in the test loader.
+    """
+
+    def __init__(self, model, device, max_wait=0.005, max_nodes=256, pruning=4, clustering='kmeans'):
+        self.model = model.eval()
+        self.device = device
+        self.max_wait = max_wait
+        self.max_nodes = max_nodes
+        self.pruning = pruning
+        self.clustering = clustering
+        self.requests = queue.Queue()
+        self.latencies = defaultdict(list)  # batch size -> forward latencies (s)
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, obs):
+        r"""Queues the observed absolute trajectories obs[T, V, 2] of a scene and waits for
+        its forecasts V_refi[n_smpl, pred_len, V, 2]."""
+
+        request = {'obs': obs, 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['pred']
+
+    def run(self):
+        pending = None
+        while True:
+            batch = [pending if pending is not None else self.requests.get()]
+            pending = None
+            n_nodes = batch[0]['obs'].size(1)
+            deadline = time.perf_counter() + self.max_wait
+            while n_nodes < self.max_nodes:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if n_nodes + request['obs'].size(1) > self.max_nodes:
+                    pending = request
+                    break
+                batch.append(request)
+                n_nodes += request['obs'].size(1)
+            self.forward(batch)
+
+    def forward(self, batch):
+        r"""Runs one forward pass over the scenes of batch and hands each request its forecasts."""
+
+        try:
+            start = time.perf_counter()
+            # S_obs[1, 2, T, V, 2] of the concatenated scenes, relative displacements start at zero
+            V_abs = torch.cat([request['obs'] for request in batch], dim=1).to(self.device)
+            V_rel = torch.cat([torch.zeros_like(V_abs[:1]), V_abs[1:] - V_abs[:-1]])
+            S_obs = torch.stack([V_abs, V_rel]).unsqueeze(dim=0)
+            num_peds = torch.tensor([request['obs'].size(1) for request in batch])
+            seq_start_end = torch.stack([num_peds.cumsum(dim=0) - num_peds, num_peds.cumsum(dim=0)], dim=1)
+
+            with torch.no_grad():
+                V_refi = self.model(S_obs, pruning=self.pruning, clustering=self.clustering,
+                                    seq_start_end=seq_start_end)[2]
+            V_refi = V_refi.cpu()
+
+            with self.lock:
+                self.latencies[len(batch)].append(time.perf_counter() - start)
+            for request, (first, last) in zip(batch, seq_start_end.tolist()):
+                request['pred'] = V_refi[:, :, first:last]
+                request['done'].set()
+        except Exception as error:
+            for request in batch:
+                request['error'] = error
+                request['done'].set()
+
+    def stats(self):
+        r"""Returns the number of batches, throughput (scenes/s) and p50/p99 latency (ms) per batch size."""
+
+        with self.lock:
+            latencies = {size: np.array(value) for size, value in self.latencies.items()}
+        return {size: {'batches': len(value), 'scenes_per_sec': size * len(value) / value.sum(),
+                       'p50': float(np.percentile(value, 50) * 1000), 'p99': float(np.percentile(value, 99) * 1000)}
+                for size, value in sorted(latencies.items())}
+
+
+def make_handler(batcher, obs_len):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        r"""POST /predict with {"obs": [obs_len][V][2]} returns {"pred": [n_smpl][pred_len][V][2]},
+        GET /stats returns the batching statistics."""
+
+        def reply(self, code, body):
+            body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            self.reply(200, {str(size): stats for size, stats in batcher.stats().items()})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self.reply(404, {'error': 'unknown path {}'.format(self.path)})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                obs = torch.tensor(body['obs'], dtype=torch.float)
+                assert obs.dim() == 3 and obs.size(0) == obs_len and obs.size(1) > 0 and obs.size(2) == 2, \
+                    "obs must be [{}, V, 2]".format(obs_len)
+                assert obs.isfinite().all(), "obs must be finite"
+            except Exception as error:
+                return self.reply(400, {'error': str(error)})
+            # A failed forward pass is reported to every request of its batch
+            try:
+                pred = batcher.submit(obs)
+            except Exception as error:
+                return self.reply(500, {'error': '{0}: {1}'.format(type(error).__name__, error)})
+            self.reply(200, {'pred': pred.tolist()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictionHandler
+
+
+def main():
+    server_args = parser.parse_args()
+    device = torch.device(server_args.device)
+    model, args = load_model(server_args.tag, device)
+    model.n_smpl = server_args.n_samples
+
+    batcher = DynamicBatcher(model, device, max_wait=server_args.max_wait / 1000, max_nodes=server_args.max_nodes,
+                             clustering=server_args.clustering)
+    server = ThreadingHTTPServer((server_args.host, server_args.port), make_handler(batcher, args.obs_seq_len))
+    # serve_forever() returns on SIGTERM, shutdown() has to be called from another thread
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print('Serving {0} on http://{1}:{2}'.format(server_args.tag, server_args.host, server_args.port), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    print('{0:>10s} {1:>8s} {2:>12s} {3:>10s} {4:>10s}'.format('batch', 'batches', 'scenes/s', 'p50 ms', 'p99 ms'))
+    for size, stats in batcher.stats().items():
+        print('{0:10d} {1:8d} {2:12.1f} {3:10.3f} {4:10.3f}'.format(
+            size, stats['batches'], stats['scenes_per_sec'], stats['p50'], stats['p99']))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
+import csv
 import pickle
+import itertools
 import argparse
+from functools import partial
 import torch
 import numpy as np
 from tqdm import tqdm
 from graphtern.model import graph_tern
-from utils.dataloader import TrajectoryDataset
+from graphtern.endpoint import endpoint_reducers
+from graphtern.batching import SceneBatch
+from graphtern.quantization import precision_modes, quantize_int8
+from utils.dataloader import TrajectoryDataset, scene_collate
+from utils.sampler import BucketBatchSampler
+from utils.prefetcher import DevicePrefetcher
 from torch.utils.data import DataLoader
 
 
@@ -12,73 +20,181 @@ from torch.utils.data import DataLoader
 parser = argparse.ArgumentParser()
 parser.add_argument('--tag', default='tag', help='Personal tag for the model')
 parser.add_argument('--n_samples', type=int, default=20, help='Number of samples')
-test_args = parser.parse_args()
+parser.add_argument('--clustering', default='kmeans', choices=list(endpoint_reducers.keys()),
+                    help='Reducer of the pruned endpoint GMMs to n_samples endpoints')
+parser.add_argument('--repeat', type=int, default=10, help='Number of evaluation repeats, run in a single pass')
+parser.add_argument('--seed', type=int, default=None, help='Random seed for a reproducible evaluation')
+parser.add_argument('--export', default=None, help='Export per-scene metrics to a .csv or .parquet file')
+parser.add_argument('--batch_size', type=int, default=16, help='Number of scenes per forward pass')
+parser.add_argument('--max_nodes', type=int, default=None, help='Maximum number of padded pedestrian nodes per batch')
+parser.add_argument('--max_edges', type=int, default=65536,
+                    help='Maximum number of padded pedestrian edges per forward pass, counting every repeat')
+parser.add_argument('--sparse_radius', type=float, default=None, help='Only connect pedestrians within this radius')
+parser.add_argument('--sparse_knn', type=int, default=None, help='Only connect each pedestrian to its k nearest neighbours')
+parser.add_argument('--precision', default='fp32', choices=list(precision_modes.keys()) + ['int8'],
+                    help='Inference precision, int8 quantizes the convolutions for CPU inference')
+parser.add_argument('--calibration', type=int, default=32, help='Number of training batches calibrating int8')
+parser.add_argument('--num_workers', type=int, default=0, help='Number of DataLoader worker processes')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='Number of batches prefetched by each worker and sent ahead to the device')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help='Device to run on (cuda, cuda:1, cpu)')
+
+
+def load_args(tag):
+    r"""Returns the training arguments of the checkpoint tag."""
+
+    args_path = './checkpoint/' + tag + '/args.pkl'
+    with open(args_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_model(tag, device, sparse_radius=None, sparse_knn=None):
+    r"""Returns the best Graph-TERN model of the checkpoint tag and its training arguments."""
+
+    # Get arguments for training
+    checkpoint_dir = './checkpoint/' + tag + '/'
+    args = load_args(tag)
+
+    model_path = checkpoint_dir + args.dataset + '_best.pth'
+
+    # Model preparation
+    model = graph_tern(n_epgcn=args.n_epgcn, n_epcnn=args.n_epcnn, n_trgcn=args.n_trgcn, n_trcnn=args.n_trcnn,
+                       seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, n_ways=args.n_ways, n_smpl=args.n_smpl,
+                       sparse_radius=sparse_radius or getattr(args, 'sparse_radius', None),
+                       sparse_knn=sparse_knn or getattr(args, 'sparse_knn', None))
+    model = model.to(device)
+    model.load_state_dict(torch.load(model_path, map_location=device), strict=False)
+    return model, args
+
+
+def load_test_dataset(args):
+    r"""Returns the test split of the dataset a model was trained for."""
+
+    dataset_path = './datasets/' + args.dataset + '/'
+    return TrajectoryDataset(dataset_path + 'test/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1,
+                             fields=['S_obs', 'S_trgt'])
+
+
+def set_precision(model, args, precision, n_batches=32, batch_size=16):
+    r"""Switches the model to a reduced precision inference mode, int8 is calibrated on the training split."""
+
+    if precision != 'int8':
+        model.precision = precision_modes[precision]
+        return model
+
+    dataset_path = './datasets/' + args.dataset + '/'
+    dataset = TrajectoryDataset(dataset_path + 'train/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1,
+                                fields=['S_obs'])
+    sampler = BucketBatchSampler(dataset.seq_start_end, batch_size=batch_size, shuffle=True, seed=0)
+    loader = DataLoader(dataset, batch_sampler=sampler, num_workers=0,
+                        collate_fn=partial(scene_collate, fields=dataset.fields))
+    calibration = list(itertools.islice(loader, n_batches))
+    return quantize_int8(model, calibration, pruning=4, clustering='quantile')
+
+
+def test(model, test_dataset, device, KSTEPS=20, repeat=10, clustering='kmeans', batch_size=16, max_nodes=None,
+         max_edges=None, scene_metrics=False, desc='Testing', progress=True, num_workers=0, prefetch=2):
+    r"""Evaluates every repeat in one pass over the test set, with repeats as an extra sample dimension.
+
+    The test_dataset yields the 'S_obs' and 'S_trgt' fields, collated by num_workers processes and sent
+    to the device prefetch batches ahead. Returns the ADE and FDE averaged over the repeats, and the
+    per-scene metric rows when scene_metrics is set."""
+
+    # Data preparation, the repeats multiply the size of each forward pass
+    test_sampler = BucketBatchSampler(test_dataset.seq_start_end, batch_size=batch_size, max_nodes=max_nodes,
+                                      max_edges=max_edges // repeat if max_edges else None, shuffle=False)
+    test_loader = DataLoader(test_dataset, batch_sampler=test_sampler, num_workers=num_workers,
+                             collate_fn=partial(scene_collate, fields=test_dataset.fields),
+                             pin_memory=device.type == 'cuda', prefetch_factor=prefetch if num_workers > 0 else None)
+    test_loader = DevicePrefetcher(test_loader, device, depth=prefetch)
 
-# Get arguments for training
-checkpoint_dir = './checkpoint/' + test_args.tag + '/'
+    model.eval()
+    model.n_smpl = KSTEPS
 
-args_path = checkpoint_dir + '/args.pkl'
-with open(args_path, 'rb') as f:
-    args = pickle.load(f)
+    # Running sums of the best-of-KSTEPS errors of each repeat, kept on the device
+    ade_sum = torch.zeros(repeat, device=device)
+    fde_sum = torch.zeros(repeat, device=device)
+    n_peds = 0
+    scene_ade, scene_fde = [], []
 
-dataset_path = './datasets/' + args.dataset + '/'
-model_path = checkpoint_dir + args.dataset + '_best.pth'
+    progressbar = tqdm(range(len(test_loader)), disable=not progress)
+    progressbar.set_description(desc)
 
-# Data preparation
-test_dataset = TrajectoryDataset(dataset_path + 'test/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1)
-test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False, num_workers=0, pin_memory=True)
+    with torch.no_grad():
+        for batch_idx, batch in enumerate(test_loader):
+            S_obs, S_trgt, seq_start_end = batch
 
-# Model preparation
-model = graph_tern(n_epgcn=args.n_epgcn, n_epcnn=args.n_epcnn, n_trgcn=args.n_trgcn, n_trcnn=args.n_trcnn,
-                   seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, n_ways=args.n_ways, n_smpl=args.n_smpl)
-model = model.cuda()
-model.load_state_dict(torch.load(model_path), strict=False)
+            # Run Graph-TERN model, all repeats draw independent samples in the same forward pass
+            V_init, V_pred, V_refi, valid_mask = model(S_obs, pruning=4, clustering=clustering,
+                                                       seq_start_end=seq_start_end, n_repeat=repeat)
 
+            # Calculate ADEs and FDEs for each refined trajectory [repeat, KSTEPS, T, V]
+            V_trgt_abs = S_trgt[:, 0].squeeze(dim=0)
+            temp = (V_refi.unflatten(0, (repeat, KSTEPS)) - V_trgt_abs).norm(p=2, dim=-1)
+            ADEs = temp.mean(dim=2).min(dim=1)[0]
+            FDEs = temp[:, :, -1, :].min(dim=1)[0]
+            ade_sum += ADEs.sum(dim=-1)
+            fde_sum += FDEs.sum(dim=-1)
+            n_peds += ADEs.size(-1)
 
-def test(KSTEPS=20):
-    model.eval()
-    model.n_smpl = KSTEPS
-    ade_refi_all = []
-    fde_refi_all = []
+            if scene_metrics:
+                # Per-scene mean over repeats and pedestrians
+                scene_batch = SceneBatch(seq_start_end, device=device)
+                scene_ade.append(scene_batch.mean(ADEs))
+                scene_fde.append(scene_batch.mean(FDEs))
 
-    progressbar = tqdm(range(len(test_loader)))
-    progressbar.set_description('Testing {}'.format(test_args.tag))
+            progressbar.update(1)
 
-    for batch_idx, batch in enumerate(test_loader):
-        S_obs, S_trgt = [tensor.cuda() for tensor in batch[-2:]]
+    progressbar.close()
 
-        # Run Graph-TERN model
-        V_init, V_pred, V_refi, valid_mask = model(S_obs, pruning=4, clustering=True)
+    ade_refi = (ade_sum / n_peds).mean().item()
+    fde_refi = (fde_sum / n_peds).mean().item()
+    if not scene_metrics:
+        return ade_refi, fde_refi, None
 
-        # Calculate ADEs and FDEs for each refined trajectory
-        V_trgt_abs = S_trgt[:, 0].squeeze(dim=0)
-        temp = (V_refi - V_trgt_abs).norm(p=2, dim=-1)
-        ADEs = temp.mean(dim=1).min(dim=0)[0]
-        FDEs = temp[:, -1, :].min(dim=0)[0]
-        ade_refi_all.extend(ADEs.tolist())
-        fde_refi_all.extend(FDEs.tolist())
+    # The bucketing sampler groups scenes by size, map the metrics back to the dataset order
+    scenes = [index for batch in test_sampler for index in batch]
+    rows = []
+    for i, ade, fde in sorted(zip(scenes, torch.cat(scene_ade).tolist(), torch.cat(scene_fde).tolist())):
+        start, end = test_dataset.seq_start_end[i]
+        rows.append([i, start, end, end - start, ade, fde])
+    return ade_refi, fde_refi, rows
 
-        progressbar.update(1)
 
-    progressbar.close()
+def export(path, rows, header=('scene', 'start', 'end', 'num_peds', 'ade', 'fde')):
+    r"""Writes metric rows to a .csv or .parquet file."""
 
-    ade_refi = sum(ade_refi_all) / len(ade_refi_all)
-    fde_refi = sum(fde_refi_all) / len(fde_refi_all)
-    return ade_refi, fde_refi
+    if path.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows, columns=list(header)).to_parquet(path, index=False)
+    else:
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
 
 
 def main():
-    ade_refi, fde_refi = [], []
+    test_args = parser.parse_args()
+    device = torch.device(test_args.device)
+    model, args = load_model(test_args.tag, device, test_args.sparse_radius, test_args.sparse_knn)
+    assert test_args.precision != 'int8' or device.type == 'cpu', "int8 inference runs on CPU"
+    set_precision(model, args, test_args.precision, test_args.calibration)
+    test_dataset = load_test_dataset(args)
 
-    # Repeat the evaluation to reduce randomness
-    repeat = 10
-    for i in range(repeat):
-        temp = test(KSTEPS=test_args.n_samples)
-        ade_refi.append(temp[0])
-        fde_refi.append(temp[1])
+    if test_args.seed is not None:
+        torch.manual_seed(test_args.seed)
+        np.random.seed(test_args.seed)
 
-    ade_refi = np.mean(ade_refi)
-    fde_refi = np.mean(fde_refi)
+    # Repeat the evaluation to reduce randomness
+    ade_refi, fde_refi, scene_metrics = test(model, test_dataset, device, KSTEPS=test_args.n_samples,
+                                             repeat=test_args.repeat, clustering=test_args.clustering,
+                                             batch_size=test_args.batch_size, max_nodes=test_args.max_nodes,
+                                             max_edges=test_args.max_edges,
+                                             scene_metrics=test_args.export is not None,
+                                             desc='Testing {}'.format(test_args.tag),
+                                             num_workers=test_args.num_workers, prefetch=test_args.prefetch)
 
     result_lines = ["Evaluating model: {}".format(test_args.tag),
                     "Refined_ADE: {0:.8f}, Refined_FDE: {1:.8f}".format(ade_refi, fde_refi)]
@@ -86,6 +202,9 @@ def main():
     for line in result_lines:
         print(line)
 
+    if scene_metrics is not None:
+        export(test_args.export, scene_metrics)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,38 @@
+import torch
+from graphtern import graph_tern
+from utils import scene_collate
+
+
+def random_scenes(sizes, obs_len=8, pred_len=12):
+    r"""Returns dataset items (S_obs[2, obs_len, V, 2], S_trgt[2, pred_len, V, 2]) of random walks."""
+
+    torch.manual_seed(0)
+    scenes = []
+    for n_peds in sizes:
+        V_abs = torch.randn(obs_len + pred_len, n_peds, 2).cumsum(dim=0) * 0.3 + torch.randn(n_peds, 2) * 3
+        V_rel = torch.cat([torch.zeros_like(V_abs[:1]), V_abs[1:] - V_abs[:-1]])
+        S = torch.stack([V_abs, V_rel])
+        scenes.append((S[:, :obs_len], S[:, obs_len:]))
+    return scenes
+
+
+def test_scene_collate():
+    scenes = random_scenes([3, 1, 4])
+    S_obs, S_trgt, seq_start_end = scene_collate(scenes, fields=['S_obs', 'S_trgt'])
+    assert S_obs.shape == (1, 2, 8, 8, 2) and S_trgt.shape == (1, 2, 12, 8, 2)
+    assert seq_start_end.tolist() == [[0, 3], [3, 4], [4, 8]]
+    for (start, end), (obs, trgt) in zip(seq_start_end.tolist(), scenes):
+        assert torch.equal(S_obs[0, :, :, start:end], obs)
+        assert torch.equal(S_trgt[0, :, :, start:end], trgt)
+
+
+def test_batched_forward_matches_single_scenes():
+    scenes = random_scenes([3, 1, 4, 2])
+    model = graph_tern(seq_len=8, pred_seq_len=12, n_smpl=6).eval()
+    S_obs, _, seq_start_end = scene_collate(scenes, fields=['S_obs', 'S_trgt'])
+    with torch.no_grad():
+        V_init, _, V_refi, _ = model(S_obs, pruning=4, clustering='quantile', seq_start_end=seq_start_end)
+        for (start, end), (obs, _) in zip(seq_start_end.tolist(), scenes):
+            V_init_scene, _, V_refi_scene, _ = model(obs.unsqueeze(dim=0), pruning=4, clustering='quantile')
+            assert torch.allclose(V_init[..., start:end, :], V_init_scene, atol=1e-5)
+            assert torch.allclose(V_refi[..., start:end, :], V_refi_scene, atol=1e-5)
@@ -0,0 +1,50 @@
+import torch
+from torch.distributions import Categorical, Independent, Normal, MixtureSameFamily
+from graphtern.loss import gaussian_mixture_nll, GaussianMixtureNLL, gaussian_mixture_loss
+
+
+def random_gmm(shape=(3, 1, 5), n_mix=6, dtype=torch.double):
+    torch.manual_seed(0)
+    W_pred = torch.randn(*shape, n_mix, 5, dtype=dtype, requires_grad=True)
+    W_trgt = torch.randn(*shape, 2, dtype=dtype, requires_grad=True)
+    return W_pred, W_trgt
+
+
+def test_nll_matches_distributions():
+    W_pred, W_trgt = random_gmm()
+    gmm = MixtureSameFamily(Categorical(logits=W_pred[..., 4]),
+                            Independent(Normal(W_pred[..., :2], W_pred[..., 2:4].exp()), 1))
+    assert torch.allclose(gaussian_mixture_nll(W_pred, W_trgt), -gmm.log_prob(W_trgt))
+
+
+def test_fused_backward_matches_autograd():
+    W_pred, W_trgt = random_gmm()
+    grad_output = torch.randn(W_trgt.shape[:-1], dtype=W_pred.dtype)
+    expected = torch.autograd.grad(gaussian_mixture_nll(W_pred, W_trgt), (W_pred, W_trgt), grad_output)
+    fused = torch.autograd.grad(GaussianMixtureNLL.apply(W_pred, W_trgt), (W_pred, W_trgt), grad_output)
+    for a, b in zip(fused, expected):
+        assert torch.allclose(a, b)
+    assert torch.autograd.gradcheck(GaussianMixtureNLL.apply, (W_pred, W_trgt))
+
+
+def test_fused_backward_with_bounded_log_std():
+    W_pred, W_trgt = random_gmm()
+    with torch.no_grad():
+        W_pred[0, ..., 2:4] = -40.
+        W_pred[1, ..., 2] = 40.
+    expected = torch.autograd.grad(gaussian_mixture_nll(W_pred, W_trgt).sum(), W_pred)[0]
+    fused = torch.autograd.grad(GaussianMixtureNLL.apply(W_pred, W_trgt).sum(), W_pred)[0]
+    assert fused.isfinite().all()
+    assert torch.allclose(fused, expected)
+
+
+def test_scene_losses():
+    torch.manual_seed(0)
+    W_pred = torch.randn(1, 8, 7, 15, dtype=torch.double)
+    S_trgt = torch.randn(1, 12, 7, 2, dtype=torch.double)
+    seq_start_end = torch.tensor([[0, 3], [3, 7]])
+    loss = gaussian_mixture_loss(W_pred, S_trgt, 3, seq_start_end)
+    for scene, (start, end) in zip(loss, seq_start_end.tolist()):
+        alone = gaussian_mixture_loss(W_pred[:, :, start:end], S_trgt[:, :, start:end], 3)
+        assert torch.allclose(scene, alone)
+    assert torch.allclose(gaussian_mixture_loss(W_pred, S_trgt, 3, seq_start_end, fused=True), loss)
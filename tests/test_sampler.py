@@ -0,0 +1,56 @@
+import torch
+from utils import BucketBatchSampler
+
+
+def scenes_of(sizes):
+    ends = torch.tensor(sizes).cumsum(dim=0)
+    return torch.stack([ends - torch.tensor(sizes), ends], dim=1).tolist()
+
+
+SIZES = [1, 5, 2, 9, 3, 3, 1, 7, 2, 4, 6, 1, 8, 2, 30]
+
+
+def test_every_scene_once():
+    sampler = BucketBatchSampler(scenes_of(SIZES), batch_size=4, shuffle=True, seed=0)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(SIZES)))
+
+
+def test_budgets():
+    for budget in [dict(batch_size=3), dict(max_nodes=16), dict(max_edges=64), dict(batch_size=4, max_edges=100)]:
+        for batch in BucketBatchSampler(scenes_of(SIZES), shuffle=True, seed=0, **budget):
+            num_scenes, max_peds = len(batch), max(SIZES[i] for i in batch)
+            if num_scenes == 1:
+                continue  # a scene over budget on its own runs alone
+            assert num_scenes <= budget.get('batch_size', num_scenes)
+            assert num_scenes * max_peds <= budget.get('max_nodes', num_scenes * max_peds)
+            assert num_scenes * max_peds ** 2 <= budget.get('max_edges', num_scenes * max_peds ** 2)
+
+
+def test_oversized_scene_runs_alone():
+    batches = list(BucketBatchSampler(scenes_of(SIZES), max_edges=64, shuffle=False))
+    assert [SIZES.index(30)] in batches
+
+
+def test_seeded_shuffle_changes_with_epoch():
+    sampler = BucketBatchSampler(scenes_of(SIZES), batch_size=2, shuffle=True, seed=0)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+def test_sharding():
+    for num_replicas in [2, 3, 4]:
+        shards = [list(BucketBatchSampler(scenes_of(SIZES), batch_size=3, shuffle=True, seed=0,
+                                          num_replicas=num_replicas, rank=rank)) for rank in range(num_replicas)]
+        # Padded shards have as many batches on every rank and cover every scene
+        assert len({len(shard) for shard in shards}) == 1
+        assert {i for shard in shards for batch in shard for i in batch} == set(range(len(SIZES)))
+
+        # Without padding, every batch is yielded exactly once across the ranks
+        shards = [list(BucketBatchSampler(scenes_of(SIZES), batch_size=3, shuffle=True, seed=0,
+                                          num_replicas=num_replicas, rank=rank, pad=False))
+                  for rank in range(num_replicas)]
+        assert sorted(i for shard in shards for batch in shard for i in batch) == list(range(len(SIZES)))
@@ -0,0 +1,55 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import torch
+from server import make_handler
+
+
+class FailingBatcher:
+    def submit(self, obs):
+        raise RuntimeError('forward pass failed')
+
+
+class EchoBatcher:
+    def submit(self, obs):
+        return obs.unsqueeze(dim=0)
+
+
+def post(server, body):
+    request = urllib.request.Request('http://127.0.0.1:{}/predict'.format(server.server_address[1]),
+                                     data=json.dumps(body).encode(), method='POST')
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def serve(batcher):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(batcher, obs_len=8))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_predict():
+    server = serve(EchoBatcher())
+    try:
+        obs = torch.randn(8, 3, 2).tolist()
+        assert post(server, {'obs': obs}) == (200, {'pred': [obs]})
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_errors_are_replied():
+    server = serve(FailingBatcher())
+    try:
+        code, body = post(server, {'obs': torch.randn(8, 3, 2).tolist()})
+        assert code == 500 and 'forward pass failed' in body['error']
+        assert post(server, {'obs': torch.randn(5, 3, 2).tolist()})[0] == 400
+        assert post(server, {'obs': [[[float('nan'), 0.]]] * 8})[0] == 400
+    finally:
+        server.shutdown()
+        server.server_close()
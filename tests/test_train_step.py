@@ -0,0 +1,68 @@
+import torch
+from graphtern import graph_tern, gaussian_mixture_loss, mse_loss, scene_mask
+
+
+def diverged_prediction(n_peds=6, diverged=(2, 3)):
+    r"""Returns GMM parameters W_pred[1, 8, V, 15] of two scenes, the second with exploded log deviations."""
+
+    torch.manual_seed(0)
+    W_pred = torch.randn(1, 8, n_peds, 15, dtype=torch.double)
+    W_pred.view(1, 8, n_peds, 3, 5)[:, :, diverged[0], :, 2:4] = -400.
+    W_pred.view(1, 8, n_peds, 3, 5)[:, :, diverged[1], :, 2:4] = 300.
+    return W_pred.requires_grad_(), torch.randn(1, 12, n_peds, 2, dtype=torch.double)
+
+
+def test_scene_mask():
+    loss = torch.tensor([1., float('nan'), float('inf'), 1e3, 50.])
+    assert scene_mask(loss).tolist() == [True, False, False, True, True]
+    assert scene_mask(loss, max_loss=100.).tolist() == [True, False, False, False, True]
+
+
+def test_diverged_scene_leaves_gradients_finite():
+    W_pred, S_trgt = diverged_prediction()
+    seq_start_end = torch.tensor([[0, 2], [2, 6]])
+    for fused in (False, True):
+        loss = gaussian_mixture_loss(W_pred, S_trgt, 3, seq_start_end, fused=fused)
+        valid = scene_mask(loss.detach(), max_loss=100.)
+        assert valid.tolist() == [True, False]
+        grad, = torch.autograd.grad(torch.where(valid, loss, 0.).sum(), W_pred)
+        assert grad.isfinite().all()
+        assert grad[:, :, 2:].eq(0).all()
+
+        # The valid scene gets the gradient it has on its own
+        alone, = torch.autograd.grad(gaussian_mixture_loss(W_pred[:, :, :2], S_trgt[:, :, :2], 3, fused=fused),
+                                     W_pred)
+        assert torch.allclose(grad, alone)
+
+
+def test_nan_step_is_skipped_without_scale_decay():
+    torch.manual_seed(0)
+    model = graph_tern(seq_len=8, pred_seq_len=12, n_smpl=4)
+    scaler = torch.amp.GradScaler('cpu', init_scale=1.)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3, fused=True)
+    S_obs = torch.randn(1, 2, 8, 5, 2).cumsum(dim=2) * 0.1
+    S_trgt = torch.randn(1, 2, 12, 5, 2).cumsum(dim=2) * 0.1
+    seq_start_end = torch.tensor([[0, 2], [2, 5]])
+
+    def step(S_trgt):
+        optimizer.zero_grad(set_to_none=True)
+        V_init, _, V_refi, valid_mask = model(S_obs, S_trgt, seq_start_end=seq_start_end)
+        loss = (gaussian_mixture_loss(V_init, S_trgt[:, 1], model.n_ways, seq_start_end)
+                + mse_loss(V_refi, S_trgt[:, 0], valid_mask, seq_start_end=seq_start_end))
+        loss = torch.where(scene_mask(loss.detach(), 100.), loss, 0.).sum()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update(1.)
+
+    # A nan target still makes every gradient nan, the step is skipped and the scale stays at 1
+    S_nan = S_trgt.clone()
+    S_nan[..., 2:, :] = float('nan')
+    params = [param.detach().clone() for param in model.parameters()]
+    for _ in range(20):
+        step(S_nan)
+    assert scaler.get_scale() == 1.
+    assert all(torch.equal(param, before) for param, before in zip(model.parameters(), params))
+
+    step(S_trgt)
+    assert all(param.isfinite().all() for param in model.parameters())
+    assert any(not torch.equal(param, before) for param, before in zip(model.parameters(), params))
@@ -4,23 +4,16 @@ import argparse
 import torch
 import random
 import sys
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 from graphtern import *
 from utils import *
+from functools import partial
 from torch.utils.data import DataLoader
 
 
-# Reproducibility
-torch.manual_seed(42)
-random.seed(42)
-np.random.seed(42)
-torch.backends.cudnn.benchmark = False
-torch.backends.cudnn.deterministic = True
-torch.backends.cuda.matmul.allow_tf32 = False
-torch.backends.cudnn.allow_tf32 = False
-
 # Argument parsing
 parser = argparse.ArgumentParser()
 
@@ -40,16 +33,37 @@ parser.add_argument('--n_ways', type=int, default=3,
 parser.add_argument('--n_smpl', type=int, default=20,
                     help='Number of samples for refine')
 parser.add_argument('--kernel_size', type=int, default=3)
+parser.add_argument('--sparse_radius', type=float, default=None,
+                    help='Only connect pedestrians within this radius (sparse graph)')
+parser.add_argument('--sparse_knn', type=int, default=None,
+                    help='Only connect each pedestrian to its k nearest neighbours (sparse graph)')
 
 # Data specifc paremeters
 parser.add_argument('--obs_seq_len', type=int, default=8)
 parser.add_argument('--pred_seq_len', type=int, default=12)
 parser.add_argument('--dataset', default='zara1',
                     help='Dataset name(eth,hotel,univ,zara1,zara2)')
+parser.add_argument('--missing_rate', type=float, default=0.03,
+                    help='Fraction of observed coordinates dropped and imputed by SAITS')
+parser.add_argument('--saits_path', default=None,
+                    help='Pretrained SAITS imputer, trained once to <checkpoint_dir>/saits.pth if missing')
+parser.add_argument('--saits_epochs', type=int, default=10, help='Number of epochs to train the SAITS imputer')
+parser.add_argument('--imputed', default=None,
+                    help='Missing-data realizations of the training set precomputed by impute.py, one per epoch')
 
 # Training specifc parameters
 parser.add_argument('--batch_size', type=int,
-                    default=128, help='Mini batch size')
+                    default=128, help='Maximum number of scenes per forward pass, no longer per optimizer step')
+parser.add_argument('--max_nodes', type=int, default=None,
+                    help='Maximum number of padded pedestrian nodes per mini batch')
+parser.add_argument('--max_edges', type=int, default=2048,
+                    help='Maximum number of padded pedestrian edges per mini batch, which bounds its memory')
+parser.add_argument('--stream', action="store_true", default=False,
+                    help='Stream the training files in chunks instead of loading them, for datasets larger than memory')
+parser.add_argument('--shuffle_buffer', type=int, default=1024, help='Number of streamed scenes shuffled in memory')
+parser.add_argument('--num_workers', type=int, default=2, help='Number of DataLoader worker processes')
+parser.add_argument('--prefetch', type=int, default=2,
+                    help='Number of mini-batches prefetched by each worker and sent ahead to the device')
 parser.add_argument('--num_epochs', type=int,
                     default=512, help='Number of epochs')
 parser.add_argument('--clip_grad', type=float,
@@ -59,9 +73,43 @@ parser.add_argument('--lr_sh_rate', type=int, default=128,
                     help='Number of steps to drop the lr')
 parser.add_argument('--use_lrschd', action="store_true",
                     default=False, help='Use lr rate scheduler')
+parser.add_argument('--max_scene_loss', type=float, default=100.,
+                    help='Scenes with a larger or non-finite loss are skipped as outliers')
+parser.add_argument('--fused_loss', action="store_true",
+                    default=False, help='Use the closed-form backward of the gaussian mixture loss')
+parser.add_argument('--amp', default=None, choices=['fp16', 'bf16'],
+                    help='Mixed precision training of the network, fp16 with gradient scaling')
+parser.add_argument('--log_every', type=int, default=50, help='Number of steps between loss logs')
+parser.add_argument('--grad_flow_every', type=int, default=None,
+                    help='Plot the gradient flow every this many steps (disabled by default)')
 parser.add_argument('--tag', default='tag', help='Personal tag for the model')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                    help='Device to run on (cuda, cuda:1, cpu)')
+parser.add_argument('--dist_backend', default=None,
+                    help='Distributed backend when launched with torchrun, nccl on cuda and gloo otherwise')
 
 args = parser.parse_args()
+device = torch.device(args.device)
+
+# Distributed data-parallel training, when launched with torchrun
+distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+rank, world_size = 0, 1
+if distributed:
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+    torch.distributed.init_process_group(args.dist_backend or ('nccl' if device.type == 'cuda' else 'gloo'))
+    rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+# Reproducibility, every process draws its own augmentations
+torch.manual_seed(42 + rank)
+random.seed(42 + rank)
+np.random.seed(42 + rank)
+torch.backends.cudnn.benchmark = False
+torch.backends.cudnn.deterministic = True
+torch.backends.cuda.matmul.allow_tf32 = False
+torch.backends.cudnn.allow_tf32 = False
+aug_generator = torch.Generator(device).manual_seed(42 + rank)
 
 
 def plot_grad_flow(named_parameters):
@@ -101,49 +149,119 @@ def plot_grad_flow(named_parameters):
     plt.ylabel("average gradient")
     plt.title("Gradient flow")
     plt.grid(True)
-    plt.savefig(f"img/gradient-hotel")
+    plt.savefig(f"img/gradient-{args.dataset}")
 
 
 # Data preparation
-# Batch size set to 1 because vertices vary by humans in each scene sequence.
-# Use mini batch working like batch.
+# Scenes have a varying number of pedestrians, so a mini-batch of scenes is
+# concatenated along the pedestrian axis and run as one block-diagonal graph.
+# Scenes of similar size are bucketed together to keep the padded graph small.
+# In distributed training, every process runs its own share of the mini-batches.
+# Workers collate the mini-batches, which are sent to the device ahead of the compute.
 dataset_path = './datasets/' + args.dataset + '/'
 checkpoint_dir = './checkpoint/' + args.tag + '/'
 
-train_dataset = TrajectoryDataset(
-    dataset_path + 'train/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1)
-train_loader = DataLoader(train_dataset, batch_size=1,
-                          shuffle=True, num_workers=0, pin_memory=True)
+
+def prefetch_loader(dataset, sampler=None):
+    batching = {'batch_sampler': sampler} if sampler is not None else {'batch_size': args.batch_size}
+    loader = DataLoader(dataset, collate_fn=partial(scene_collate, fields=dataset.fields), **batching,
+                        num_workers=args.num_workers, pin_memory=device.type == 'cuda',
+                        prefetch_factor=args.prefetch if args.num_workers > 0 else None)
+    return DevicePrefetcher(loader, device, depth=args.prefetch)
+
+
+if args.stream:
+    # Streamed scenes are batched in arrival order, through a bounded shuffle buffer.
+    # The number of mini-batches per process is unknown, so they could not stay in step.
+    assert not distributed and args.imputed is None, \
+        "streaming runs in a single process, without precomputed imputations"
+    train_dataset = TrajectoryStream(
+        dataset_path + 'train/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1,
+        fields=['obs_traj', 'S_obs', 'S_trgt'], shuffle_buffer=args.shuffle_buffer, seed=42)
+    train_sampler = None
+else:
+    train_dataset = TrajectoryDataset(
+        dataset_path + 'train/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1, imputed=args.imputed,
+        fields=['obs_traj', 'S_obs', 'S_trgt'])
+    train_sampler = BucketBatchSampler(train_dataset.seq_start_end, batch_size=args.batch_size,
+                                       max_nodes=args.max_nodes, max_edges=args.max_edges, shuffle=True, seed=42,
+                                       num_replicas=world_size, rank=rank)
+train_loader = prefetch_loader(train_dataset, train_sampler)
 
 val_dataset = TrajectoryDataset(
-    dataset_path + 'val/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1)
-val_loader = DataLoader(val_dataset, batch_size=1,
-                        shuffle=False, num_workers=0, pin_memory=True)
+    dataset_path + 'val/', obs_len=args.obs_seq_len, pred_len=args.pred_seq_len, skip=1, fields=['S_obs', 'S_trgt'])
+val_sampler = BucketBatchSampler(val_dataset.seq_start_end, batch_size=args.batch_size,
+                                 max_nodes=args.max_nodes, max_edges=args.max_edges, shuffle=False,
+                                 num_replicas=world_size, rank=rank, pad=False)
+val_loader = prefetch_loader(val_dataset, val_sampler)
 
 plt.figure(figsize=(20, 20))
 
 
 # Model preparation
 model = graph_tern(n_epgcn=args.n_epgcn, n_epcnn=args.n_epcnn, n_trgcn=args.n_trgcn, n_trcnn=args.n_trcnn,
-                   seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, n_ways=args.n_ways, n_smpl=args.n_smpl)
-model = model.cuda()
-
+                   seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, n_ways=args.n_ways, n_smpl=args.n_smpl,
+                   sparse_radius=args.sparse_radius, sparse_knn=args.sparse_knn)
+model = model.to(device)
+
+# Gradients of the mini-batches of every process are all-reduced in backward.
+# The unused prelu of the last graph convolution is skipped on every step, so the graph is static.
+train_model = model
+if distributed:
+    train_model = torch.nn.parallel.DistributedDataParallel(
+        model, device_ids=[device] if device.type == 'cuda' else None, static_graph=True)
+
+# Mixed precision runs the graph and network in reduced precision, sampling and losses stay in float32
+amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(args.amp)
+model.precision = amp_dtype
+# The scaler also skips every step whose gradients are still nan or inf, on device.
+# Without float16 its scale is reset to 1 at every update, so skipped steps never make it decay.
+scaler = torch.amp.GradScaler(device.type, init_scale=2.**16 if amp_dtype == torch.float16 else 1.)
+
+# The fused optimizer takes the gradient scale and inf checks on device, without a host sync per step
 optimizer = torch.optim.Adam(
-    model.parameters(), lr=args.lr, weight_decay=args.lr/10)
+    model.parameters(), lr=args.lr, weight_decay=args.lr/10, fused=True)
 if args.use_lrschd:
     scheduler = torch.optim.lr_scheduler.StepLR(
         optimizer, step_size=args.lr_sh_rate, gamma=0.8)
 
-# Train logging
-if not os.path.exists(checkpoint_dir):
-    os.makedirs(checkpoint_dir)
-with open(checkpoint_dir + 'args.pkl', 'wb') as f:
-    pickle.dump(args, f)
+# Train logging, only the first process writes checkpoints
+if rank == 0:
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    with open(checkpoint_dir + 'args.pkl', 'wb') as f:
+        pickle.dump(args, f)
+
+# Imputation stage, SAITS is trained once on the observed training trajectories, or loaded.
+# With precomputed realizations, the dataset yields the imputed observations instead.
+imputer = None
+if args.imputed is None:
+    saits_path = args.saits_path or checkpoint_dir + 'saits.pth'
+    imputer = SaitsImputer(n_steps=args.obs_seq_len, epochs=args.saits_epochs, device=device)
+    if rank == 0 and not os.path.exists(saits_path):
+        if args.stream:
+            # Fitted on the pedestrians of the first streamed scenes
+            fit_obs = torch.cat([obs for obs, _, _ in itertools.islice(iter(train_dataset), 4096)])
+        else:
+            fit_obs = train_dataset.obs_traj
+        imputer.fit(fit_obs.permute(0, 2, 1).to(device), rate=args.missing_rate)
+        imputer.save(saits_path)
+    if distributed:
+        torch.distributed.barrier()
+    imputer.load(saits_path)
 
 metrics = {'train_loss': [], 'val_loss': []}
 constant_metrics = {'min_val_epoch': -1, 'min_val_loss': 1e10}
 
 
+def reduce_sum(tensor):
+    r"""Returns the sum of tensor over the distributed processes."""
+
+    if distributed:
+        torch.distributed.all_reduce(tensor)
+    return tensor
+
+
 def transform_imputed(X):
 
     X = torch.round(X, decimals=4)
@@ -151,7 +269,7 @@ def transform_imputed(X):
 
     X = X.permute(0, 1, 3, 2)
 
-    X_rel = torch.zeros(*X.shape).cuda()
+    X_rel = torch.zeros(*X.shape, device=X.device)
     X_rel[:, :, :, 1:] = X[:, :, :, 1:]-X[:, :, :, :-1]
 
     S_obs = torch.stack((X, X_rel), dim=1).permute(0, 1, 4, 2, 3)
@@ -159,141 +277,119 @@ def transform_imputed(X):
     return S_obs
 
 
-def saits_loader(original_tensor):
-    nelems = original_tensor.numel()
-    ne_nan = int(0.0 * nelems)
-    nan_indices = random.sample(range(nelems), ne_nan)
-    new_tensor = original_tensor.clone().reshape(-1)
-    new_tensor[nan_indices] = float('nan')
-    assert torch.any(new_tensor.isnan()) == False
-    return new_tensor.reshape(*original_tensor.shape)
-
-
 def train(epoch):
     global metrics, model
     model.train()
-    loss_batch = 0.
-    r_loss_batch, m_loss_batch = 0., 0.
-    loader_len = len(train_loader)
-
-    progressbar = tqdm(range(loader_len), file=sys.stdout)
+    # Metrics are accumulated on the device and only read back at logging intervals
+    loss_batch = torch.zeros((), device=device)
+    mae_batch = torch.zeros((), device=device)
+    scene_batch = torch.zeros((), device=device)
+    loader_len = len(train_loader) if train_sampler is not None else None
+    if train_sampler is not None:
+        train_sampler.set_epoch(epoch)
+    train_dataset.set_epoch(epoch)
+
+    progressbar = tqdm(total=loader_len, file=sys.stdout, disable=rank != 0)
     progressbar.set_description(
         'Train Epoch: {0} Loss: {1:.8f}'.format(epoch, 0))
-    optimizer.zero_grad()
     for batch_idx, batch in enumerate(train_loader):
-        # sum gradients till idx reach to batch_size
-        if batch_idx % args.batch_size == 0:
-            optimizer.zero_grad()
-
-        S_obs, S_trgt = [tensor.cuda() for tensor in batch[-2:]]
+        optimizer.zero_grad(set_to_none=True)
 
-        X_obs, X_trgt = [tensor.cuda() for tensor in batch[2:4]]
+        X_obs, S_obs, S_trgt, seq_start_end = batch
 
-        _, npeds, _, step_size = X_obs.shape
-        X_obs_saits = X_obs.permute(0, 1, 3, 2).reshape(npeds, step_size, -1)
-
-        for i in range(npeds):
-            X_i = X_obs_saits[i]
-            X_obs_saits[i] = saits_loader(X_i)
-
-        _, npeds, _, step_size = X_trgt.shape
-
-        X_obs_saits, mae_saits_loss = saits_model(X_obs_saits)
-
-        S_obs_imputed = transform_imputed(X_obs_saits)
-        diff = torch.abs(S_obs - S_obs_imputed)
-        mae_loss = torch.mean(diff)
-        max_value = torch.max(diff)
-        print("Maximum value:", max_value.item())
-
-        max_value = torch.max(S_obs)
-        print("Maximum value S_obs:", max_value.item())
-        # print(f"{mae_loss=}")
+        # Drop observed coordinates at random and impute every scene of the mini-batch at once
+        X_obs = X_obs[0].permute(0, 2, 1)
+        if imputer is not None:
+            S_obs_imputed = transform_imputed(imputer.impute(X_obs, mcar_mask(X_obs, args.missing_rate)))
+        else:
+            S_obs, S_obs_imputed = transform_imputed(X_obs), S_obs
+        mae_loss = torch.abs(S_obs - S_obs_imputed).mean()
         S_obs = S_obs_imputed
 
         # Data augmentation
         aug = True
         if aug:
-            S_obs, S_trgt = data_sampler(S_obs, S_trgt, batch=1)
+            S_obs, S_trgt = data_sampler(S_obs, S_trgt, batch=1, generator=aug_generator,
+                                         seq_start_end=seq_start_end)
 
-        # Run Graph-TERN model
-        V_init, V_pred, V_refi, valid_mask = model(S_obs, S_trgt)
+        # Run Graph-TERN model on the whole mini-batch of scenes
+        V_init, V_pred, V_refi, valid_mask = train_model(S_obs, S_trgt, seq_start_end=seq_start_end)
 
-        # Loss calculation
-        r_loss = gaussian_mixture_loss(V_init, S_trgt[:, 1], args.n_ways)
-        m_loss = mse_loss(V_refi, S_trgt[:, 0], valid_mask)
+        # Loss calculation per scene
+        r_loss = gaussian_mixture_loss(V_init, S_trgt[:, 1], args.n_ways, seq_start_end, fused=args.fused_loss)
+        m_loss = mse_loss(V_refi, S_trgt[:, 0], valid_mask, seq_start_end=seq_start_end)
         loss = r_loss + m_loss
 
-        if torch.isnan(loss):
-            pass
-        else:
-            loss.backward()
+        # Gradients are summed over the scenes of the mini-batch, scenes with a non-finite or outlier loss
+        # are dropped. The predicted deviations are bounded, so the dropped scenes backpropagate zeros.
+        valid_scenes = scene_mask(loss.detach(), args.max_scene_loss)
+        loss = torch.where(valid_scenes, loss, 0.).sum()
+        scaler.scale(loss).backward()
+
+        # Gradient flow diagnostics are sampled, they read every gradient back to the host
+        plot_step = args.grad_flow_every is not None and batch_idx % args.grad_flow_every == 0 and rank == 0
+        if args.clip_grad is not None or plot_step:
+            scaler.unscale_(optimizer)
+        if args.clip_grad is not None:
+            torch.nn.utils.clip_grad_norm_(
+                model.parameters(), args.clip_grad)
+        if plot_step:
             plot_grad_flow(model.named_parameters())
-            loss_batch += loss.item()
-
-        r_loss_batch += r_loss.item()
-        m_loss_batch += m_loss.item()
-
-        if batch_idx % args.batch_size + 1 == args.batch_size or batch_idx + 1 == loader_len:
-            if args.clip_grad is not None:
-                torch.nn.utils.clip_grad_norm_(
-                    model.parameters(), args.clip_grad)
-            optimizer.step()
-
-            r_loss_batch = 0.
-            m_loss_batch = 0.
-
-        progressbar.set_description('Train Epoch: {0} Loss: {1:.8f} Mae_Loss: {2: .8f}'.format(
-            epoch, loss.item() / args.batch_size , mae_loss.item()))
+        scaler.step(optimizer)
+        scaler.update(None if amp_dtype == torch.float16 else 1.)
+
+        loss_batch += loss.detach()
+        scene_batch += valid_scenes.sum()
+        mae_batch += mae_loss.detach()
+        if (batch_idx + 1) % args.log_every == 0 or batch_idx + 1 == loader_len:
+            progressbar.set_description('Train Epoch: {0} Loss: {1:.8f} Mae_Loss: {2: .8f}'.format(
+                epoch, loss.item() / max(valid_scenes.sum().item(), 1), mae_batch.item() / (batch_idx + 1)))
         progressbar.update(1)
 
     progressbar.close()
-    metrics['train_loss'].append(loss_batch / loader_len)
+    # Mean over the scenes that contributed a gradient, outliers excluded.
+    # Scenes repeated to pad the shards of the processes count in both sums.
+    metrics['train_loss'].append(reduce_sum(loss_batch).item() / max(reduce_sum(scene_batch).item(), 1))
 
 
 def valid(epoch):
     global metrics, constant_metrics, model
     model.eval()
-    loss_batch = 0.
-    r_loss_batch, m_loss_batch = 0., 0.
+    loss_batch = torch.zeros((), device=device)
     loader_len = len(val_loader)
 
-    progressbar = tqdm(range(loader_len))
+    progressbar = tqdm(range(loader_len), disable=rank != 0)
     progressbar.set_description(
         'Valid Epoch: {0} Loss: {1:.8f}'.format(epoch, 0))
 
     for batch_idx, batch in enumerate(val_loader):
-        S_obs, S_trgt = [tensor.cuda() for tensor in batch[-2:]]
+        S_obs, S_trgt, seq_start_end = batch
 
         # Run Graph-TERN model
-        V_init, V_pred, V_refi, valid_mask = model(S_obs)
-
-        # Loss calculation
-        r_loss = gaussian_mixture_loss(V_init, S_trgt[:, 1], args.n_ways)
-        m_loss = mse_loss(V_refi, S_trgt[:, 0], valid_mask, training=False)
-        loss = r_loss + m_loss
-
-        loss_batch += loss.item()
-        r_loss_batch += r_loss.item()
-        m_loss_batch += m_loss.item()
-
-        if batch_idx % args.batch_size + 1 == args.batch_size or batch_idx + 1 == loader_len:
-            r_loss_batch = 0.
-            m_loss_batch = 0.
-
-        progressbar.set_description('Valid Epoch: {0} Loss: {1:.8f}'.format(
-            epoch, loss.item() / args.batch_size))
+        with torch.no_grad():
+            V_init, V_pred, V_refi, valid_mask = model(S_obs, seq_start_end=seq_start_end)
+
+        # Loss calculation per scene
+        r_loss = gaussian_mixture_loss(V_init, S_trgt[:, 1], args.n_ways, seq_start_end)
+        m_loss = mse_loss(V_refi, S_trgt[:, 0], valid_mask, training=False, seq_start_end=seq_start_end)
+        loss = (r_loss + m_loss).sum()
+
+        loss_batch += loss
+        if (batch_idx + 1) % args.log_every == 0 or batch_idx + 1 == loader_len:
+            progressbar.set_description('Valid Epoch: {0} Loss: {1:.8f}'.format(
+                epoch, loss.item() / len(seq_start_end)))
         progressbar.update(1)
 
     progressbar.close()
-    metrics['val_loss'].append(loss_batch / loader_len)
+    metrics['val_loss'].append(reduce_sum(loss_batch).item() / len(val_dataset))
 
     # Save model
     if metrics['val_loss'][-1] < constant_metrics['min_val_loss']:
         constant_metrics['min_val_loss'] = metrics['val_loss'][-1]
         constant_metrics['min_val_epoch'] = epoch
-        torch.save(model.state_dict(), checkpoint_dir +
-                   args.dataset + '_best.pth')
+        if rank == 0:
+            torch.save(model.state_dict(), checkpoint_dir +
+                       args.dataset + '_best.pth')
 
 
 def main():
@@ -304,6 +400,9 @@ def main():
         if args.use_lrschd:
             scheduler.step()
 
+        if rank != 0:
+            continue
+
         print(" ")
         print("Dataset: {0}, Epoch: {1}".format(args.tag, epoch))
         print("Train_loss: {0}, Val_los: {1}".format(
@@ -318,6 +417,9 @@ def main():
         with open(checkpoint_dir + 'constant_metrics.pkl', 'wb') as f:
             pickle.dump(constant_metrics, f)
 
+    if distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == "__main__":
     main()
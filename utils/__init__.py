@@ -1,3 +1,5 @@
-from .dataloader import TrajectoryDataset
+from .dataloader import TrajectoryDataset, TrajectoryStream, scene_collate, save_imputed
+from .sampler import BucketBatchSampler
+from .prefetcher import DevicePrefetcher
 from .augmentor import data_sampler
 from .visualizer import trajectory_visualizer, controlpoint_visualizer
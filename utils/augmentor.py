@@ -3,33 +3,62 @@ import random
 import torch
 
 
-def data_sampler(S_obs, S_trgt, batch=4, scale=True, stretch=False, flip=True, rotation=True, noise=False):
-    r"""Returns the Trajectories with batch size."""
-
-    aug_So, aug_Sg = [], []
-
-    for i in range(batch):
-        S_obs_t, S_tr_t = S_obs.clone(), S_trgt.clone()
-        if scale:
-            S_obs_t, S_tr_t = random_scale(S_obs_t, S_tr_t, min=0.8, max=1.2)
-        if stretch:
-            S_obs_t, S_tr_t = random_stretch(S_obs_t, S_tr_t, min=0.8, max=1.2)
-        if flip:
-            S_obs_t, S_tr_t = random_flip(S_obs_t, S_tr_t)
-        if rotation:
-            S_obs_t, S_tr_t = random_rotation(S_obs_t, S_tr_t)
-        if noise:
-            S_obs_t, S_tr_t = random_noise(S_obs_t, S_tr_t)
-
-        aug_So.append(S_obs_t.squeeze(dim=0))
-        aug_Sg.append(S_tr_t.squeeze(dim=0))
-
-    S_obs = torch.stack(aug_So).detach()
-    S_trgt = torch.stack(aug_Sg).detach()
+def data_sampler(S_obs, S_trgt, batch=4, scale=True, stretch=False, flip=True, rotation=True, noise=False,
+                 generator=None, seq_start_end=None):
+    r"""Returns the Trajectories with batch size.
+
+    The scale, stretch, flip and rotation of every copy are composed into one 2x2 affine, and all
+    copies are applied in a single batched matmul on the device of S_obs. Parameters are drawn
+    from generator, a torch.Generator on that device, or from the global generator.
+    For a mini-batch of scenes concatenated along the pedestrian axis, every scene of seq_start_end
+    draws its own affine, expanded to its pedestrians."""
+
+    n_scenes = 1 if seq_start_end is None else len(seq_start_end)
+    affine = random_affine(batch * n_scenes, scale=scale, stretch=stretch, flip=flip, rotation=rotation,
+                           generator=generator, device=S_obs.device, dtype=S_obs.dtype)
+
+    S = torch.cat([S_obs, S_trgt], dim=2).detach()
+    if seq_start_end is None:
+        # S[n, abs/rel, seq_len, ped, xy] @ affine^T -> S[batch, n, abs/rel, seq_len, ped, xy]
+        S = S.unsqueeze(dim=0) @ affine.transpose(1, 2).view(batch, 1, 1, 1, 2, 2)
+    else:
+        # S[n, abs/rel, seq_len, ped, 1, xy] @ affine^T[batch, ped] -> S[batch, n, abs/rel, seq_len, ped, xy]
+        seq_start_end = torch.as_tensor(seq_start_end)
+        counts = (seq_start_end[:, 1] - seq_start_end[:, 0]).to(S.device)
+        affine = affine.view(batch, n_scenes, 2, 2).repeat_interleave(counts, dim=1, output_size=S.size(-2))
+        S = (S.unsqueeze(dim=0).unsqueeze(dim=-2) @ affine.transpose(-1, -2).view(batch, 1, 1, 1, -1, 2, 2)).squeeze(dim=-2)
+    if noise:
+        S = S + torch.randn(S.shape, generator=generator, device=S.device, dtype=S.dtype) * 0.01
+    S_obs, S_trgt = S.squeeze(dim=1).split([S_obs.size(2), S_trgt.size(2)], dim=-3)
 
     return S_obs, S_trgt
 
 
+def random_affine(batch, scale=True, stretch=False, flip=True, rotation=True, generator=None, device=None,
+                  dtype=torch.float):
+    r"""Returns random affines[batch, 2, 2], rotating the scaled, stretched and flipped Trajectories."""
+
+    def uniform(size, min, max):
+        return torch.rand(size, generator=generator, device=device, dtype=dtype) * (max - min) + min
+
+    diag = torch.ones(batch, 2, device=device, dtype=dtype)
+    if scale:
+        diag = diag * uniform((batch, 1), 0.8, 1.2)
+    if stretch:
+        diag = diag * uniform((batch, 2), 0.8, 1.2)
+    if flip:
+        diag = diag * (torch.randint(2, (batch, 2), generator=generator, device=device) * 2 - 1)
+    affine = torch.diag_embed(diag)
+
+    if rotation:
+        # for 90 degree augmentation
+        theta = torch.randint(-2, 2, (batch,), generator=generator, device=device).to(dtype) * (math.pi / 2)
+        cos, sin = theta.cos(), theta.sin()
+        affine = torch.stack([cos, -sin, sin, cos], dim=-1).view(batch, 2, 2) @ affine
+
+    return affine
+
+
 def random_scale(S_obs, S_trgt, min=0.8, max=1.2):
     r"""Returns the randomly scaled Trajectories."""
 
@@ -41,7 +70,7 @@ def random_stretch(S_obs, S_trgt, min=0.9, max=1.1):
     r"""Returns the randomly stretched Trajectories."""
 
     scale = [random.uniform(min, max), random.uniform(min, max)]
-    scale = torch.tensor(scale).cuda()
+    scale = torch.tensor(scale, device=S_obs.device)
     scale_a = torch.sqrt(scale[0] * scale[1])
     return S_obs * scale, S_trgt * scale
 
@@ -50,7 +79,7 @@ def random_flip(S_obs, S_trgt):
     r"""Returns the randomly flipped Trajectories."""
 
     flip = random.choice([[-1, -1], [-1, 1], [1, -1], [1, 1]])
-    flip = torch.tensor(flip).cuda()
+    flip = torch.tensor(flip, device=S_obs.device)
     return S_obs * flip, S_trgt * flip
 
 
@@ -63,7 +92,7 @@ def random_rotation(S_obs, S_trgt):
 
     r_mat = [[math.cos(theta), -math.sin(theta)],
              [math.sin(theta), math.cos(theta)]]
-    r = torch.tensor(r_mat, dtype=torch.float, requires_grad=False).cuda()
+    r = torch.tensor(r_mat, dtype=S_obs.dtype, device=S_obs.device, requires_grad=False)
 
     S_obs = torch.einsum('rc,natvc->natvr', r, S_obs)
     S_trgt = torch.einsum('rc,natvc->natvr', r, S_trgt)
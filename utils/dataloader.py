@@ -2,50 +2,176 @@
 # Sourcecode directly referred from Social-GAN at https://github.com/agrimgupta92/sgan/blob/master/sgan/data/trajectories.py
 
 import os
-import math
 import random
+import hashlib
 import torch
 import numpy as np
-from tqdm import tqdm
-from torch.utils.data import Dataset
+from collections import deque
+from itertools import islice
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+
+# Bump when the on-disk cache layout changes
+CACHE_VERSION = 2
+
+# Fields of TrajectoryDataset items and their pedestrian axis, along which scenes are concatenated
+FIELDS = {'obs_traj_missing': 0, 'pred_traj_missing': 0, 'obs_traj': 0, 'pred_traj': 0, 'obs_traj_rel': 0,
+          'pred_traj_rel': 0, 'non_linear_ped': 0, 'loss_mask': 0, 'S_obs': 2, 'S_trgt': 2}
 
 
 def poly_fit(traj, traj_len, threshold):
     """
     Input:
-    - traj: Numpy array of shape (2, traj_len)
+    - traj: Numpy array of shape (2, traj_len) or (num_peds, 2, traj_len)
     - traj_len: Len of trajectory
     - threshold: Minimum error to be considered for non linear traj
     Output:
-    - int: 1 -> Non Linear 0-> Linear
+    - float or Numpy array of shape (num_peds,): 1 -> Non Linear 0-> Linear
     """
+    # Batched quadratic least squares fit over every pedestrian and coordinate at once
     t = np.linspace(0, traj_len - 1, traj_len)
-    res_x = np.polyfit(t, traj[0, -traj_len:], 2, full=True)[1]
-    res_y = np.polyfit(t, traj[1, -traj_len:], 2, full=True)[1]
-    if res_x + res_y >= threshold:
-        return 1.0
-    else:
-        return 0.0
+    vander = np.vander(t, 3)
+    y = traj[..., -traj_len:].reshape(-1, traj_len).T
+    coef = np.linalg.lstsq(vander, y, rcond=None)[0]
+    res = ((vander @ coef - y) ** 2).sum(axis=0).reshape(traj.shape[:-1]).sum(axis=-1)
+    non_linear = (res >= threshold).astype(float)
+    return float(non_linear) if traj.ndim == 2 else non_linear
 
 
 def read_file(_path, delim='\t'):
-    data = []
     if delim == 'tab':
         delim = '\t'
     elif delim == 'space':
         delim = ' '
-    with open(_path, 'r') as f:
-        for line in f:
-            line = line.strip().split(delim)
-            line = [float(i) for i in line]
-            data.append(line)
-    return np.asarray(data)
+    return np.loadtxt(_path, delimiter=delim, ndmin=2)
+
+
+def seq_windows(data, seq_len, skip):
+    """
+    Input:
+    - data: Numpy array of shape (num_rows, 4) with <frame_id> <ped_id> <x> <y>
+    - seq_len: Number of frames in a sequence
+    - skip: Number of frames to skip while making the dataset
+    Output:
+    - start: Numpy array of shape (num_tracks,), first frame index of each sequence
+    - rows: Numpy array of shape (num_tracks, seq_len), rows of data for each track
+    Tracks are ordered by sequence start frame, then by pedestrian id.
+    """
+    frames = np.unique(data[:, 0])
+    frame_idx = np.searchsorted(frames, data[:, 0])
+
+    # Sort by (ped, frame) so that a complete track is a run of seq_len consecutive rows
+    order = np.lexsort((frame_idx, data[:, 1]))
+    ped, fidx = data[order, 1], frame_idx[order]
+    head = np.arange(max(len(order) - seq_len + 1, 0))
+    tail = head + seq_len - 1
+    valid = (ped[head] == ped[tail]) & (fidx[tail] - fidx[head] == seq_len - 1) & (fidx[head] % skip == 0)
+    head = head[valid]
+
+    # Regroup tracks by (frame, ped)
+    head = head[np.lexsort((ped[head], fidx[head]))]
+    rows = order[head[:, None] + np.arange(seq_len)]
+    return fidx[head], rows
+
+
+def read_chunks(_path, delim='\t', chunk_size=65536):
+    r"""Yields the rows of a dataset file in arrays of at most chunk_size rows."""
+
+    if delim == 'tab':
+        delim = '\t'
+    elif delim == 'space':
+        delim = ' '
+    with open(_path) as f:
+        while True:
+            lines = [line for line in islice(f, chunk_size) if line.strip()]
+            if not lines:
+                return
+            yield np.loadtxt(lines, delimiter=delim, ndmin=2)
+
+
+def stream_frames(_path, delim='\t', chunk_size=65536):
+    r"""Yields the (ped_ids, xy) of each frame of a dataset file sorted by frame, reading it in chunks."""
+
+    pending = np.empty((0, 4))
+    for chunk in read_chunks(_path, delim, chunk_size):
+        data = np.concatenate([pending, chunk])
+        if np.any(np.diff(data[:, 0]) < 0):
+            raise ValueError("{} must be sorted by frame to be streamed".format(_path))
+
+        # The last frame may continue in the next chunk
+        bounds = np.flatnonzero(np.diff(data[:, 0])) + 1
+        for rows in np.split(data[:bounds[-1]] if len(bounds) else data[:0], bounds[:-1]):
+            yield rows[:, 1], rows[:, 2:4]
+        pending = data[bounds[-1]:] if len(bounds) else data
+    if len(pending):
+        yield pending[:, 1], pending[:, 2:4]
+
+
+def max_peds_in_window(data, seq_len, skip):
+    r"""Returns the maximum number of pedestrians appearing in any sequence window."""
+
+    frames = np.unique(data[:, 0])
+    frame_idx = np.searchsorted(frames, data[:, 0])
+    order = np.lexsort((frame_idx, data[:, 1]))
+    ped, fidx = data[order, 1], frame_idx[order]
+
+    # Frame f is seen by the windows starting in [f - seq_len + 1, f], merge overlapping ranges per ped
+    new_ped = np.r_[True, ped[1:] != ped[:-1]]
+    run_begin = new_ped | np.r_[True, np.diff(fidx) > seq_len]
+    run_end = np.r_[run_begin[1:], True]
+    counts = np.zeros(len(frames) + 1, dtype=np.int64)
+    np.add.at(counts, np.maximum(fidx[run_begin] - seq_len + 1, 0), 1)
+    np.add.at(counts, fidx[run_end] + 1, -1)
+    counts = counts.cumsum()[:len(frames)]
+    return int(counts[::skip].max(initial=0))
+
+
+def cache_key(files, **params):
+    r"""Returns a hash over the content of the dataset files and the preprocessing parameters."""
+
+    h = hashlib.sha1(repr(sorted(params.items())).encode())
+    for path in files:
+        h.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def scene_collate(batch, fields=tuple(FIELDS)):
+    r"""Collates scenes into one graph by concatenating them along the pedestrian axis.
+
+    Returns the fields of TrajectoryDataset.__getitem__ with a leading batch dimension of one,
+    followed by seq_start_end[B, 2] locating each scene on the pedestrian axis. fields names the
+    fields of the items, use functools.partial(scene_collate, fields=dataset.fields) for a lean dataset."""
+
+    items = list(zip(*batch))
+    out = [torch.cat(field, dim=FIELDS[name]).unsqueeze(dim=0) for name, field in zip(fields, items)]
+    num_peds = torch.tensor([item.size(FIELDS[fields[0]]) for item in items[0]])
+    cum_end_idx = num_peds.cumsum(dim=0)
+    out.append(torch.stack([cum_end_idx - num_peds, cum_end_idx], dim=1))
+    return out
+
+
+def save_imputed(prefix, missing, obs, **meta):
+    r"""Writes missing-data realizations for TrajectoryDataset(imputed=prefix).
+
+    The boolean masks missing[R, N, obs_len, 2] are bit-packed per pedestrian into <prefix>.mask.bin,
+    the imputed observations obs[R, N, obs_len, 2] go to <prefix>.obs.bin and meta to <prefix>.pt."""
+
+    num_realizations, num_peds, obs_len, _ = obs.shape
+    os.makedirs(os.path.dirname(prefix) or '.', exist_ok=True)
+    np.packbits(missing.reshape(num_realizations, num_peds, -1).cpu().numpy(), axis=-1).tofile(prefix + '.mask.bin.tmp')
+    obs.float().cpu().numpy().tofile(prefix + '.obs.bin.tmp')
+    torch.save(dict(meta, num_realizations=num_realizations, num_peds=num_peds, obs_len=obs_len), prefix + '.pt.tmp')
+    for extension in ['.mask.bin', '.obs.bin', '.pt']:
+        os.replace(prefix + extension + '.tmp', prefix + extension)
 
 
 class TrajectoryDataset(Dataset):
     """Dataloder for the Trajectory datasets"""
 
-    def __init__(self, data_dir, obs_len=8, pred_len=8, skip=1, threshold=0.002, min_ped=1, delim='\t'):
+    def __init__(self, data_dir, obs_len=8, pred_len=8, skip=1, threshold=0.002, min_ped=1, delim='\t', cache_dir=None,
+                 missing_rate=0.2, imputed=None, fields=None):
         """
         Args:
         - data_dir: Directory containing dataset files in the format
@@ -57,6 +183,12 @@ class TrajectoryDataset(Dataset):
         when using a linear predictor
         - min_ped: Minimum number of pedestrians that should be in a seqeunce
         - delim: Delimiter in the dataset files
+        - cache_dir: Directory for the preprocessed tensor cache, defaults to
+        <data_dir>/../.cache. Set to False to disable caching.
+        - missing_rate: Probability of an observed coordinate to be missing
+        - imputed: Prefix of the missing-data realizations written by impute.py. The observed
+        scene is then the imputed one of the realization selected by set_epoch().
+        - fields: Names of the FIELDS returned for each scene, every field by default
         """
         super(TrajectoryDataset, self).__init__()
 
@@ -67,137 +199,294 @@ class TrajectoryDataset(Dataset):
         self.skip = skip
         self.seq_len = self.obs_len + self.pred_len
         self.delim = delim
+        self.missing_rate = missing_rate
+        self.fields = tuple(FIELDS) if fields is None else tuple(fields)
+        assert all(name in FIELDS for name in self.fields), "fields must be in {}".format(list(FIELDS))
 
         all_files = sorted(os.listdir(self.data_dir))
-        all_files = [os.path.join(self.data_dir, _path) for _path in all_files]
+        all_files = [os.path.join(self.data_dir, _path) for _path in all_files if not _path.startswith('.')]
+        all_files = [_path for _path in all_files if os.path.isfile(_path)]
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.normpath(self.data_dir)), '.cache')
+        cache_path = None
+        if cache_dir:
+            key = cache_key(all_files, version=CACHE_VERSION, obs_len=obs_len, pred_len=pred_len, skip=skip,
+                            threshold=threshold, min_ped=min_ped, delim=delim)
+            cache_path = os.path.join(cache_dir, key)
+
+        if cache_path is not None and os.path.exists(cache_path + '.pt'):
+            cache = torch.load(cache_path + '.pt')
+        else:
+            cache = self.preprocess(all_files, threshold, min_ped)
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                cache['scenes'].numpy().tofile(cache_path + '.bin.tmp')
+                os.replace(cache_path + '.bin.tmp', cache_path + '.bin')
+                torch.save({k: v for k, v in cache.items() if k != 'scenes'}, cache_path + '.pt.tmp')
+                os.replace(cache_path + '.pt.tmp', cache_path + '.pt')
+
+        self.max_peds_in_frame = cache['max_peds_in_frame']
+        self.num_seq = len(cache['num_peds_in_seq'])
+        num_peds = sum(cache['num_peds_in_seq'])
+        cum_start_idx = [0] + np.cumsum(cache['num_peds_in_seq']).tolist()
+        self.seq_start_end = [(start, end) for start, end in zip(
+            cum_start_idx, cum_start_idx[1:])]
+
+        # Columnar scene store scenes[abs/rel, seq_len, ped, xy], memory-mapped from the cache
+        # so that DataLoader workers and concurrent jobs share one page-cached copy
+        if 'scenes' in cache:
+            self.scenes = cache['scenes']
+        else:
+            self.scenes = torch.from_file(cache_path + '.bin', shared=False, size=2 * self.seq_len * num_peds * 2,
+                                          dtype=torch.float).view(2, self.seq_len, num_peds, 2)
+
+        # Zero-copy views into the scene store
+        self.obs_traj = self.scenes[0, :self.obs_len].permute(1, 2, 0)
+        self.pred_traj = self.scenes[0, self.obs_len:].permute(1, 2, 0)
+        self.obs_traj_rel = self.scenes[1, :self.obs_len].permute(1, 2, 0)
+        self.pred_traj_rel = self.scenes[1, self.obs_len:].permute(1, 2, 0)
+        self.loss_mask = torch.ones(1).expand(num_peds, self.seq_len)
+        self.non_linear_ped = cache['non_linear_ped']
+
+        # Precomputed missing-data realizations, memory-mapped and read per scene
+        self.imputed = None
+        self.realization = 0
+        if imputed is not None:
+            self.imputed = torch.load(imputed + '.pt')
+            assert self.imputed['num_peds'] == num_peds and self.imputed['obs_len'] == self.obs_len, \
+                "imputed realizations do not match the dataset"
+            num_realizations = self.imputed['num_realizations']
+            mask_bytes = -(-self.obs_len * 2 // 8)
+            self.imputed_mask = torch.from_file(imputed + '.mask.bin', shared=False, dtype=torch.uint8,
+                                                size=num_realizations * num_peds * mask_bytes
+                                                ).view(num_realizations, num_peds, mask_bytes)
+            self.imputed_obs = torch.from_file(imputed + '.obs.bin', shared=False, dtype=torch.float,
+                                               size=num_realizations * num_peds * self.obs_len * 2
+                                               ).view(num_realizations, num_peds, self.obs_len, 2)
+
+    def preprocess(self, all_files, threshold, min_ped):
+        r"""Returns the scene store and metadata of every sequence in all_files."""
+
         num_peds_in_seq = []
         seq_list = []
-        seq_list_rel = []
-        loss_mask_list = []
         non_linear_ped = []
         for path in all_files:
             print(path)
-            data = read_file(path, delim)
-            frames = np.unique(data[:, 0]).tolist()
-            frame_data = []
-            for frame in frames:
-                frame_data.append(data[frame == data[:, 0], :])
-            num_sequences = int(
-                math.ceil((len(frames) - self.seq_len + 1) / skip))
-
-            for idx in range(0, num_sequences * self.skip + 1, skip):
-                curr_seq_data = np.concatenate(
-                    frame_data[idx:idx + self.seq_len], axis=0)
-                peds_in_curr_seq = np.unique(curr_seq_data[:, 1])
-                self.max_peds_in_frame = max(
-                    self.max_peds_in_frame, len(peds_in_curr_seq))
-
-                curr_seq = np.zeros((len(peds_in_curr_seq), 2, self.seq_len))
-                curr_seq_rel = np.zeros(
-                    (len(peds_in_curr_seq), 2, self.seq_len))
-
-                curr_loss_mask = np.zeros(
-                    (len(peds_in_curr_seq), self.seq_len))
-
-                num_peds_considered = 0
-                _non_linear_ped = []
-                for _, ped_id in enumerate(peds_in_curr_seq):
-                    curr_ped_seq = curr_seq_data[curr_seq_data[:, 1]
-                                                 == ped_id, :]
-                    curr_ped_seq = np.around(curr_ped_seq, decimals=4)
-                    pad_front = frames.index(curr_ped_seq[0, 0]) - idx
-                    pad_end = frames.index(curr_ped_seq[-1, 0]) - idx + 1
-                    if pad_end - pad_front != self.seq_len:
-                        continue
-                    curr_ped_seq = np.transpose(curr_ped_seq[:, 2:])
-                    # curr_ped_seq = curr_ped_seq
-                    # Make coordinates relative
-                    rel_curr_ped_seq = np.zeros(curr_ped_seq.shape)
-                    rel_curr_ped_seq[:, 1:] = curr_ped_seq[:,
-                                                           1:] - curr_ped_seq[:, :-1]
-                    _idx = num_peds_considered
-
-                    curr_seq[_idx, :, pad_front:pad_end] = curr_ped_seq
-                    curr_seq_rel[_idx, :, pad_front:pad_end] = rel_curr_ped_seq
-
-                    # Linear vs Non-Linear Trajectory
-                    _non_linear_ped.append(
-                        poly_fit(curr_ped_seq, pred_len, threshold))
-                    curr_loss_mask[_idx, pad_front:pad_end] = 1
-                    num_peds_considered += 1
-
-                if num_peds_considered > min_ped:
-                    non_linear_ped += _non_linear_ped
-                    num_peds_in_seq.append(num_peds_considered)
-                    loss_mask_list.append(curr_loss_mask[:num_peds_considered])
-                    seq_list.append(curr_seq[:num_peds_considered])
-                    seq_list_rel.append(curr_seq_rel[:num_peds_considered])
-
-        self.num_seq = len(seq_list)
-        seq_list = np.concatenate(seq_list, axis=0)
-        seq_list_rel = np.concatenate(seq_list_rel, axis=0)
-        loss_mask_list = np.concatenate(loss_mask_list, axis=0)
-        non_linear_ped = np.asarray(non_linear_ped)
+            data = read_file(path, self.delim)
+            self.max_peds_in_frame = max(
+                self.max_peds_in_frame, max_peds_in_window(data, self.seq_len, self.skip))
 
-        # Convert numpy -> Torch Tensor
-        self.obs_traj = torch.from_numpy(
-            seq_list[:, :, :self.obs_len]).type(torch.float)
-        self.pred_traj = torch.from_numpy(
-            seq_list[:, :, self.obs_len:]).type(torch.float)
-        self.obs_traj_rel = torch.from_numpy(
-            seq_list_rel[:, :, :self.obs_len]).type(torch.float)
-        self.pred_traj_rel = torch.from_numpy(
-            seq_list_rel[:, :, self.obs_len:]).type(torch.float)
-        self.loss_mask = torch.from_numpy(loss_mask_list).type(torch.float)
-        self.non_linear_ped = torch.from_numpy(
-            non_linear_ped).type(torch.float)
-        cum_start_idx = [0] + np.cumsum(num_peds_in_seq).tolist()
-        self.seq_start_end = [(start, end) for start, end in zip(
-            cum_start_idx, cum_start_idx[1:])]
+            start, rows = seq_windows(data, self.seq_len, self.skip)
+            num_peds = np.unique(start, return_counts=True)[1]
+            keep = np.repeat(num_peds > min_ped, num_peds)
+            num_peds_in_seq += num_peds[num_peds > min_ped].tolist()
 
-        self.missing_obs_traj = self.saits_loader(self.obs_traj)
-        self.missing_pred_traj = self.saits_loader(self.pred_traj)
+            # curr_seq[ped, 2, seq_len]
+            curr_seq = np.ascontiguousarray(np.around(data[rows[keep]][:, :, 2:4], decimals=4).transpose(0, 2, 1))
+            seq_list.append(curr_seq)
+            non_linear_ped.append(poly_fit(curr_seq, self.pred_len, threshold))
 
-        # Convert Trajectories to Graphs
-        self.S_obs = []
-        self.S_trgt = []
+        seq_list = np.concatenate(seq_list, axis=0)
+        non_linear_ped = np.concatenate(non_linear_ped, axis=0)
+
+        # Make coordinates relative
+        seq_list_rel = np.zeros(seq_list.shape)
+        seq_list_rel[:, :, 1:] = seq_list[:, :, 1:] - seq_list[:, :, :-1]
 
-        pbar = tqdm(total=len(self.seq_start_end))
-        pbar.set_description('Processing {0} dataset {1}'.format(
-            self.data_dir.split('/')[-3], self.data_dir.split('/')[-2]))
+        # [ped, xy, seq_len] -> [abs/rel, seq_len, ped, xy]
+        scenes = np.stack([seq_list, seq_list_rel], axis=0).transpose(0, 3, 1, 2)
 
-        for i in range(len(self.seq_start_end)):
-            start, end = self.seq_start_end[i]
-            s_obs = torch.stack(
-                [self.obs_traj[start:end, :], self.obs_traj_rel[start:end, :]], dim=0).permute(0, 3, 1, 2)
-            self.S_obs.append(s_obs.clone())
-            s_trgt = torch.stack(
-                [self.pred_traj[start:end, :], self.pred_traj_rel[start:end, :]], dim=0).permute(0, 3, 1, 2)
-            self.S_trgt.append(s_trgt.clone())
-            pbar.update(1)
-        pbar.close()
+        # Convert numpy -> Torch Tensor
+        return {
+            'max_peds_in_frame': self.max_peds_in_frame,
+            'num_peds_in_seq': num_peds_in_seq,
+            'scenes': torch.from_numpy(np.ascontiguousarray(scenes, dtype=np.float32)),
+            'non_linear_ped': torch.from_numpy(non_linear_ped).type(torch.float),
+        }
 
+    def saits_mask(self, original_tensor):
+        r"""Returns a boolean mask marking each element as missing with probability missing_rate."""
+
+        return torch.rand(original_tensor.shape) < self.missing_rate
 
     def saits_loader(self, original_tensor):
-        nelems = original_tensor.numel()
-        ne_nan = int(0.20 * nelems)
-        nan_indices = random.sample(range(nelems), ne_nan)
-        new_tensor = original_tensor.clone()
-        new_tensor.view(-1)[nan_indices] = float('nan')
+        return original_tensor.masked_fill(self.saits_mask(original_tensor), float('nan'))
+
+    def set_epoch(self, epoch):
+        r"""Selects the precomputed missing-data realization of this epoch."""
 
-        return new_tensor
+        if self.imputed is not None:
+            self.realization = epoch % self.imputed['num_realizations']
 
     def __len__(self):
         return self.num_seq
 
+    def missing_obs_mask(self, start, end):
+        r"""Returns the missing mask[ped, xy, obs_len] of the observations of pedestrians start to end."""
+
+        if self.imputed is None:
+            return self.saits_mask(self.obs_traj[start:end])
+        missing = np.unpackbits(self.imputed_mask[self.realization, start:end].numpy(), axis=-1,
+                                count=self.obs_len * 2)
+        return torch.from_numpy(missing).bool().view(-1, self.obs_len, 2).permute(0, 2, 1)
+
+    def observed_scene(self, start, end):
+        r"""Returns the observed scene[abs/rel, obs_len, ped, xy] of pedestrians start to end."""
+
+        if self.imputed is None:
+            return self.scenes[:, :self.obs_len, start:end]
+
+        # Observed scene of the imputed trajectories
+        X = self.imputed_obs[self.realization, start:end].permute(1, 0, 2)
+        return torch.stack([X, torch.cat([torch.zeros_like(X[:1]), X[1:] - X[:-1]])])
+
     def __getitem__(self, index):
         start, end = self.seq_start_end[index]
 
-        out = [
-            self.missing_obs_traj[start:end, :], self.missing_pred_traj[start:end, :],
-            self.obs_traj[start:end, :], self.pred_traj[start:end, :],
-            self.obs_traj_rel[start:end, :], self.pred_traj_rel[start:end, :],
-            self.non_linear_ped[start:end], self.loss_mask[start:end, :],
-            self.S_obs[index], self.S_trgt[index]
-        ]
+        # Only the requested fields are built
+        out = []
+        for name in self.fields:
+            if name == 'obs_traj_missing':
+                out.append(self.obs_traj[start:end].masked_fill(self.missing_obs_mask(start, end), float('nan')))
+            elif name == 'pred_traj_missing':
+                out.append(self.saits_loader(self.pred_traj[start:end]))
+            elif name == 'S_obs':
+                out.append(self.observed_scene(start, end))
+            elif name == 'S_trgt':
+                out.append(self.scenes[:, self.obs_len:, start:end])
+            else:
+                out.append(getattr(self, name)[start:end])
+        return out
+
+
+class TrajectoryStream(IterableDataset):
+    """Streaming dataloader for Trajectory datasets larger than memory"""
+
+    def __init__(self, data_dir, obs_len=8, pred_len=8, skip=1, threshold=0.002, min_ped=1, delim='\t',
+                 missing_rate=0.2, fields=None, chunk_size=65536, shuffle_buffer=0, seed=0, num_replicas=1, rank=0):
+        """
+        Args:
+        - data_dir: Directory containing dataset files in the format
+        <frame_id> <ped_id> <x> <y>, each sorted by frame
+        - obs_len, pred_len, skip, threshold, min_ped, delim, missing_rate, fields: As in TrajectoryDataset
+        - chunk_size: Number of rows read from a file at once
+        - shuffle_buffer: Number of scenes shuffled in memory, scenes are yielded in order if 0
+        - seed: Random seed of the shuffle buffer, combined with the epoch set by set_epoch()
+        - num_replicas: Number of distributed processes, which stream disjoint files
+        - rank: Rank of this process
+        Only seq_len frames per file and the shuffle buffer are held in memory. Files are sharded
+        across the DataLoader workers of every process, and scenes are yielded in the same layout as
+        TrajectoryDataset items, for scene_collate with a DataLoader batch_size.
+        """
+        super(TrajectoryStream, self).__init__()
+
+        self.data_dir = data_dir
+        self.obs_len = obs_len
+        self.pred_len = pred_len
+        self.skip = skip
+        self.seq_len = self.obs_len + self.pred_len
+        self.threshold = threshold
+        self.min_ped = min_ped
+        self.delim = delim
+        self.missing_rate = missing_rate
+        self.fields = tuple(FIELDS) if fields is None else tuple(fields)
+        assert all(name in FIELDS for name in self.fields), "fields must be in {}".format(list(FIELDS))
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+        all_files = sorted(os.listdir(self.data_dir))
+        all_files = [os.path.join(self.data_dir, _path) for _path in all_files if not _path.startswith('.')]
+        self.all_files = [_path for _path in all_files if os.path.isfile(_path)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def scenes(self, _path):
+        r"""Yields the scene[abs/rel, seq_len, ped, xy] of every sequence window of a file."""
+
+        window = deque(maxlen=self.seq_len)
+        prev_ids, prev_run = np.empty(0), np.empty(0, dtype=np.int64)
+        for frame_idx, (ped_ids, xy) in enumerate(stream_frames(_path, self.delim, self.chunk_size)):
+            order = np.argsort(ped_ids, kind='stable')
+            ped_ids, xy = ped_ids[order], xy[order]
+
+            # Number of consecutive frames each pedestrian is present in, up to this one
+            pos = np.searchsorted(prev_ids, ped_ids)
+            seen = pos < len(prev_ids)
+            seen[seen] = prev_ids[pos[seen]] == ped_ids[seen]
+            run = np.ones(len(ped_ids), dtype=np.int64)
+            run[seen] = prev_run[pos[seen]] + 1
+            prev_ids, prev_run = ped_ids, run
+
+            window.append((ped_ids, xy))
+            start = frame_idx - self.seq_len + 1
+            if start < 0 or start % self.skip != 0:
+                continue
+
+            # Pedestrians present in every frame of the window, ordered by id
+            peds = ped_ids[run >= self.seq_len]
+            if len(peds) <= self.min_ped:
+                continue
+
+            # curr_seq[seq_len, ped, xy]
+            curr_seq = [xy[np.searchsorted(ids, peds)] for ids, xy in window]
+            curr_seq = np.around(np.stack(curr_seq), decimals=4)
+            curr_seq_rel = np.zeros(curr_seq.shape)
+            curr_seq_rel[1:] = curr_seq[1:] - curr_seq[:-1]
+            yield torch.from_numpy(np.stack([curr_seq, curr_seq_rel]).astype(np.float32))
+
+    def item(self, scene):
+        r"""Returns the requested fields of a scene, as TrajectoryDataset.__getitem__ does."""
+
+        obs_traj = scene[0, :self.obs_len].permute(1, 2, 0)
+        pred_traj = scene[0, self.obs_len:].permute(1, 2, 0)
+        out = []
+        for name in self.fields:
+            if name == 'obs_traj_missing':
+                out.append(obs_traj.masked_fill(torch.rand(obs_traj.shape) < self.missing_rate, float('nan')))
+            elif name == 'pred_traj_missing':
+                out.append(pred_traj.masked_fill(torch.rand(pred_traj.shape) < self.missing_rate, float('nan')))
+            elif name == 'obs_traj':
+                out.append(obs_traj)
+            elif name == 'pred_traj':
+                out.append(pred_traj)
+            elif name == 'obs_traj_rel':
+                out.append(scene[1, :self.obs_len].permute(1, 2, 0))
+            elif name == 'pred_traj_rel':
+                out.append(scene[1, self.obs_len:].permute(1, 2, 0))
+            elif name == 'non_linear_ped':
+                seq = scene[0].permute(1, 2, 0).numpy()
+                out.append(torch.from_numpy(poly_fit(seq, self.pred_len, self.threshold)).float())
+            elif name == 'loss_mask':
+                out.append(torch.ones(1).expand(scene.size(2), self.seq_len))
+            elif name == 'S_obs':
+                out.append(scene[:, :self.obs_len])
+            else:
+                out.append(scene[:, self.obs_len:])
         return out
+
+    def __iter__(self):
+        # Files are sharded across the workers of every process
+        worker = get_worker_info()
+        num_workers, worker_id = (worker.num_workers, worker.id) if worker is not None else (1, 0)
+        shard = self.rank * num_workers + worker_id
+        files = self.all_files[shard::self.num_replicas * num_workers]
+
+        rng = random.Random(hash((self.seed, self.epoch, shard)))
+        buffer = []
+        for _path in files:
+            for scene in self.scenes(_path):
+                if self.shuffle_buffer <= 0:
+                    yield self.item(scene)
+                    continue
+                buffer.append(scene)
+                if len(buffer) >= self.shuffle_buffer:
+                    yield self.item(buffer.pop(rng.randrange(len(buffer))))
+        rng.shuffle(buffer)
+        for scene in buffer:
+            yield self.item(scene)
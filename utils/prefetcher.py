@@ -0,0 +1,44 @@
+from collections import deque
+import torch
+
+
+class DevicePrefetcher:
+    r"""Iterates over the mini-batches of loader with the next depth mini-batches already sent to device.
+
+    On CUDA, the copies from pinned memory are issued on a side stream so that they overlap the
+    compute of the current mini-batch. seq_start_end, the last field of scene_collate, stays on the host.
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = max(depth, 1)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def transfer(self, batch):
+        *tensors, seq_start_end = batch
+        if self.stream is None:
+            return [tensor.to(self.device) for tensor in tensors] + [seq_start_end]
+        with torch.cuda.stream(self.stream):
+            return [tensor.to(self.device, non_blocking=True) for tensor in tensors] + [seq_start_end]
+
+    def __iter__(self):
+        queue = deque()
+        for batch in self.loader:
+            queue.append(self.transfer(batch))
+            if len(queue) > self.depth:
+                yield self.ready(queue.popleft())
+        while queue:
+            yield self.ready(queue.popleft())
+
+    def ready(self, batch):
+        r"""Makes the compute stream wait for the copies of batch, which it then owns."""
+
+        if self.stream is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            for tensor in batch[:-1]:
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+        return batch
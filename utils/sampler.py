@@ -0,0 +1,99 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping scenes of similar pedestrian count"""
+
+    def __init__(self, seq_start_end, batch_size=None, max_nodes=None, max_edges=None, shuffle=True, seed=None,
+                 num_replicas=1, rank=0, pad=True):
+        """
+        Args:
+        - seq_start_end: List of (start, end) pedestrian indices of each scene,
+        as in TrajectoryDataset.seq_start_end
+        - batch_size: Maximum number of scenes in a batch
+        - max_nodes: Maximum number of padded nodes (scenes x largest scene) in a batch
+        - max_edges: Maximum number of padded edges (scenes x largest scene^2) in a batch
+        - shuffle: Shuffle scenes within each bucket and the order of the batches
+        - seed: Seed for shuffling, combined with the epoch set by set_epoch()
+        - num_replicas: Number of distributed processes sharing the batches
+        - rank: Rank of this process, which only yields every num_replicas-th batch
+        - pad: Repeat batches so that every process runs as many steps, as required by
+        DistributedDataParallel. Without padding, every batch is yielded exactly once.
+        A scene that exceeds the budget on its own is yielded as a single-scene batch.
+        With several replicas, a seed is required so that every process draws the same batches.
+        """
+        super(BucketBatchSampler, self).__init__()
+
+        assert batch_size is not None or max_nodes is not None or max_edges is not None, "no batch budget given"
+        assert num_replicas == 1 or not shuffle or seed is not None, "distributed shuffling requires a seed"
+        self.num_peds = torch.tensor([end - start for start, end in seq_start_end])
+        self.batch_size = batch_size
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+
+        # Batch boundaries only depend on the sorted scene sizes, so they are fixed across epochs
+        self.order = self.num_peds.argsort(stable=True)
+        self.bounds = self.pack(self.num_peds[self.order].tolist())
+
+    def fits(self, num_scenes, max_peds):
+        r"""Returns whether a batch of num_scenes padded to max_peds pedestrians is within the budget."""
+
+        if self.batch_size is not None and num_scenes > self.batch_size:
+            return False
+        if self.max_nodes is not None and num_scenes * max_peds > self.max_nodes:
+            return False
+        if self.max_edges is not None and num_scenes * max_peds ** 2 > self.max_edges:
+            return False
+        return True
+
+    def pack(self, sizes):
+        r"""Returns the (start, end) bounds of greedily packed batches over ascending scene sizes."""
+
+        bounds = []
+        start = 0
+        for end in range(1, len(sizes) + 1):
+            if end == len(sizes) or not self.fits(end + 1 - start, sizes[end]):
+                bounds.append((start, end))
+                start = end
+        return bounds
+
+    def set_epoch(self, epoch):
+        r"""Sets the epoch, so that a seeded sampler reshuffles differently at every epoch."""
+
+        self.epoch = epoch
+
+    def __iter__(self):
+        order = self.order
+        bounds = self.bounds
+        if self.shuffle:
+            generator = torch.Generator()
+            if self.seed is None:
+                generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+            else:
+                generator.manual_seed(self.seed + self.epoch)
+
+            # Shuffle within each bucket of equal pedestrian count, then shuffle the batches
+            perm = torch.randperm(len(order), generator=generator)
+            order = perm[self.num_peds[perm].argsort(stable=True)]
+            bounds = [bounds[i] for i in torch.randperm(len(bounds), generator=generator).tolist()]
+
+        if self.num_replicas > 1:
+            # Pad with the first batches to a multiple of the replicas, then take this rank's share
+            if self.pad:
+                bounds = (bounds * self.num_replicas)[:len(self) * self.num_replicas]
+            bounds = bounds[self.rank::self.num_replicas]
+
+        for start, end in bounds:
+            yield order[start:end].tolist()
+
+    def __len__(self):
+        if self.pad:
+            return -(-len(self.bounds) // self.num_replicas)
+        return len(range(self.rank, len(self.bounds), self.num_replicas))